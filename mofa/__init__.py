@@ -0,0 +1,2 @@
+from .core.api import train, Model
+from .core.reader import load, ModelFile
@@ -13,9 +13,11 @@ import os
 import scipy as s
 import pandas as pd
 import sys
+import tracemalloc
 
 from .variational_nodes import Variational_Node
 from .utils import corr, nans
+from .memory import memorySummary
 
 
 
@@ -43,6 +45,15 @@ class BayesNet(object):
         self.options = options
         self.trial = trial
 
+        # Active factors, inactive factors are kept in the nodes until they are removed by compactFactors()
+        self.active = s.ones(dim['K'], dtype=bool)
+
+        # Peak memory allocated by the update of each node (see updateNodes)
+        self.memory_trace = {}
+
+        # Sampling profiler of the training (see profiler.py)
+        self.profiler = None
+
         # Training flag
         self.trained = False
 
@@ -79,45 +90,12 @@ class BayesNet(object):
         #   Advantages: it takes into account both weights and latent variables, is based on how well the model fits the data
         #   Disadvantages: slow, doesnt work with non-gaussian data
         if by_r2 is not None:
-            Z = self.nodes['Z'].getExpectation()
-            Y = self.nodes["Y"].getExpectation()
-            W = self.nodes["SW"].getExpectation()
-            all_r2 = s.zeros([self.dim['M'], self.dim['K']])
-            for m in range(self.dim['M']):
-
-                # Fetch the mask for missing vlaues
-                mask = self.nodes["Y"].getNodes()[m].getMask()
-
-                # Calculate predictions and mask them
-                Ypred_m = s.dot(Z, W[m].T)
-                Ypred_m[mask] = 0.
-
-                # If there is an intercept term, regress it out, as it greatly decreases the fraction of variance explained by the other factors
-                # (THIS IS NOT IDEAL...)
-                if s.all(Z[:,0]==1.):
-                    Ypred_m_intercept = s.outer(Z[:,0], W[m][:,0].T) 
-                    Ypred_m_intercept[mask] = 0. # DO WE NEED TO DO THIS???
-                    Ypred_m -= Ypred_m_intercept
-                    all_r2[:,0] = 1.
-                    SS = (Ypred_m**2.).sum()
-                    for k in range(1,self.dim['K']):
-                        Ypred_mk = s.outer(Z[:,k], W[m][:,k])
-                        Ypred_mk[mask] = 0.
-                        Res = ((Ypred_m - Ypred_mk)**2.).sum()
-                        all_r2[m,k] = 1. - Res/SS
-                # No intercept term
-                else:
-                    SS = (Ypred_m**2.).sum()
-                    for k in range(self.dim['K']):
-                        Ypred_mk = s.outer(Z[:,k], W[m][:,k])
-                        Ypred_mk[mask] = 0.
-                        Res = ((Ypred_m - Ypred_mk)**2.).sum()
-                        all_r2[m,k] = 1. - Res/SS
-
-            if by_r2 is not None:
-                drop_dic["by_r2"] = s.where( (all_r2>by_r2).sum(axis=0) == 0)[0]
-                if len(drop_dic["by_r2"]) > 0:
-                    drop_dic["by_r2"] = [ s.random.choice(drop_dic["by_r2"]) ]
+            SS, Res = self.calculateR2Terms()
+            all_r2 = 1. - Res/SS[:,None]
+
+            drop_dic["by_r2"] = s.where( (all_r2>by_r2).sum(axis=0) == 0)[0]
+            if len(drop_dic["by_r2"]) > 0:
+                drop_dic["by_r2"] = [ s.random.choice(drop_dic["by_r2"]) ]
 
         # Shut down based on the proportion of residual variance explained by each factor
         # IT DOESNT WORK, THERE IS SOME ERROR TO BE FIXED
@@ -152,16 +130,121 @@ class BayesNet(object):
         # Drop the factors
         drop = s.unique(s.concatenate(list(drop_dic.values())))
         if len(drop) > 0:
-            for node in self.nodes.keys():
-                self.nodes[node].removeFactors(drop)
-        self.dim['K'] -= len(drop)
+            self.removeFactors(drop)
 
-        if self.dim['K']==0:
+        if self.active.sum()==0:
             print("Shut down all components, no structure found in the data.")
             exit()
 
         pass
 
+    def calculateR2Terms(self):
+        """Method to calculate the terms of the coefficient of determination of each factor in each view
+
+        The fraction of variance explained by factor k in view m is 1-Res[m,k]/SS[m]. Both terms are sums over
+        features, so they can be accumulated over subsets of features (see ShardedBayesNet)
+
+        RETURNS
+        -------
+        SS: ndarray with shape (M,)
+            sum of squares of the (masked) predictions in each view
+        Res: ndarray with shape (M,K)
+            sum of squares of the (masked) predictions after removing each factor
+        """
+        Z = self.nodes['Z'].getExpectation()
+        W = self.nodes["SW"].getExpectation()
+        SW = self.nodes["SW"].getNodes()
+        M = len(W)
+        SS = s.zeros(M)
+        Res = s.zeros([M, self.dim['K']])
+        for m in range(M):
+
+            # Fetch the mask for missing vlaues
+            mask = self.nodes["Y"].getNodes()[m].getMask()
+
+            # Calculate predictions and mask them
+            Ypred_m = SW[m].getProduct("ZW").copy()
+            Ypred_m[mask] = 0.
+
+            # If there is an intercept term, regress it out, as it greatly decreases the fraction of variance explained by the other factors
+            # (THIS IS NOT IDEAL...). The residual of the intercept is left to zero, so that its coefficient of determination is one.
+            if s.all(Z[:,0]==1.):
+                Ypred_m_intercept = s.outer(Z[:,0], W[m][:,0].T)
+                Ypred_m_intercept[mask] = 0. # DO WE NEED TO DO THIS???
+                Ypred_m -= Ypred_m_intercept
+                factors = range(1,self.dim['K'])
+            # No intercept term
+            else:
+                factors = range(self.dim['K'])
+
+            SS[m] = (Ypred_m**2.).sum()
+            for k in factors:
+                # Inactive factors are skipped, their residual is left to zero
+                if not self.active[k]: continue
+                Ypred_mk = s.outer(Z[:,k], W[m][:,k])
+                Ypred_mk[mask] = 0.
+                Res[m,k] = ((Ypred_m - Ypred_mk)**2.).sum()
+
+        return SS, Res
+
+    def removeFactors(self, idx):
+        """Method to remove factors from all the nodes of the network
+
+        The factors are switched off but kept in the arrays of the nodes, which are only compacted
+        when the fraction of inactive factors exceeds the 'compactdrop' training option
+
+        PARAMETERS
+        ----------
+        idx: ndarray
+            indices of the factors to be removed
+        """
+        self.deactivateFactors(idx)
+        if (~self.active).mean() > self.options['compactdrop']:
+            self.compactFactors()
+
+    def deactivateFactors(self, idx):
+        """Method to switch off factors in all the nodes of the network, without removing them from the arrays
+
+        PARAMETERS
+        ----------
+        idx: ndarray
+            indices of the factors to be switched off
+        """
+        self.active[idx] = False
+        for node in self.nodes.keys():
+            self.nodes[node].deactivateFactors(idx)
+
+    def compactFactors(self):
+        """Method to physically remove the inactive factors from all the nodes of the network"""
+        idx = s.where(~self.active)[0]
+        if len(idx) == 0: return
+        for node in self.nodes.keys():
+            self.nodes[node].removeFactors(idx)
+        self.active = self.active[self.active]
+        self.dim['K'] -= len(idx)
+        print("Memory held by the nodes after removing %d factor(s):\n%s\n" % (len(idx), memorySummary(self)))
+
+    def updateNodes(self, i):
+        """Method to do a single pass of updates over the nodes in the schedule
+
+        PARAMETERS
+        ----------
+        i: int
+            iteration number
+        """
+        trace = self.options.get('trace_memory', False) and tracemalloc.is_tracing()
+        for node in self.schedule:
+            if node=="Theta" and i<self.options['startSparsity']:
+                continue
+            if trace:
+                tracemalloc.reset_peak()
+                current = tracemalloc.get_traced_memory()[0]
+            if self.profiler is not None: self.profiler.setNode(node)
+            self.nodes[node].update()
+            if trace:
+                self.memory_trace[node] = max(self.memory_trace.get(node,0), tracemalloc.get_traced_memory()[1]-current)
+        if self.profiler is not None: self.profiler.setNode(None)
+
     def iterate(self):
         """Method to start iterating and updating the variables using the VB algorithm"""
 
@@ -169,33 +252,35 @@ class BayesNet(object):
         nodes = list(self.getVariationalNodes().keys())
         elbo = pd.DataFrame(data = nans((self.options['maxiter'], len(nodes)+1 )), columns = nodes+["total"] )
         activeK = nans((self.options['maxiter']))
+        iter_time = nans((self.options['maxiter']))
+
+        # Trace the memory allocated by the updates (it slows down the training)
+        start_trace = self.options.get('trace_memory', False) and not tracemalloc.is_tracing()
+        if start_trace: tracemalloc.start()
+        if self.profiler is not None: self.profiler.start()
         
         # Start training
         for i in range(self.options['maxiter']):
             t = time();
+            if self.profiler is not None: self.profiler.setIteration(i)
 
             # Remove inactive latent variables
             if (i >= self.options["startdrop"]) and (i % self.options['freqdrop']) == 0:
                 if any(self.options['drop'].values()):
                     self.removeInactiveFactors(**self.options['drop'])
-                activeK[i] = self.dim["K"]
+                activeK[i] = self.active.sum()
 
             # Update node by node, with E and M step merged
-            for node in self.schedule:
-                # print("Node: " + str(node))
-                # t = time()
-                if node=="Theta" and i<self.options['startSparsity']:
-                    continue
-                self.nodes[node].update()
-                # print("time: " + str(time()-t))
+            self.updateNodes(i)
 
             # Calculate Evidence Lower Bound
             if (i+1) % self.options['elbofreq'] == 0:
                 elbo.iloc[i] = self.calculateELBO()
+                iter_time[i] = time()-t
 
                 # Print first iteration
                 if i==0:
-                    print("Trial %d, Iteration 1: time=%.2f ELBO=%.2f, Factors=%d, Covariates=%d" % (self.trial, time()-t,elbo.iloc[i]["total"], (~self.nodes["Z"].covariates).sum(), self.nodes["Z"].covariates.sum() ))
+                    print("Trial %d, Iteration 1: time=%.2f ELBO=%.2f, Factors=%d, Covariates=%d" % (self.trial, time()-t,elbo.iloc[i]["total"], len(self.nodes["Z"].getLvIndex()), self.nodes["Z"].covariates[self.active].sum() ))
                     if self.options['verbose']:
                         print("".join([ "%s=%.2f  " % (k,v) for k,v in elbo.iloc[i].drop("total").iteritems() ]) + "\n")
 
@@ -204,7 +289,7 @@ class BayesNet(object):
                     delta_elbo = elbo.iloc[i]["total"]-elbo.iloc[i-self.options['elbofreq']]["total"]
 
                     # Print ELBO monitoring
-                    print("Trial %d, Iteration %d: time=%.2f ELBO=%.2f, deltaELBO=%.4f, Factors=%d, Covariates=%d" % (self.trial, i+1, time()-t, elbo.iloc[i]["total"], delta_elbo, (~self.nodes["Z"].covariates).sum(), self.nodes["Z"].covariates.sum() ))
+                    print("Trial %d, Iteration %d: time=%.2f ELBO=%.2f, deltaELBO=%.4f, Factors=%d, Covariates=%d" % (self.trial, i+1, time()-t, elbo.iloc[i]["total"], delta_elbo, len(self.nodes["Z"].getLvIndex()), self.nodes["Z"].covariates[self.active].sum() ))
                     if self.options['verbose']:
                         print("".join([ "%s=%.2f  " % (k,v) for k,v in elbo.iloc[i].drop("total").iteritems() ]) + "\n")
                     if delta_elbo<0 and self.options['verbose']: print("Warning, lower bound is decreasing..."); print('\a')
@@ -212,19 +297,27 @@ class BayesNet(object):
                     # Assess convergence
                     if (0 <= delta_elbo < self.options['tolerance']) and (not self.options['forceiter']):
                         activeK = activeK[:(i+1)]
+                        iter_time = iter_time[:(i+1)]
                         elbo = elbo[:(i+1)]
                         print ("Converged!\n")
                         break
 
             # Do not calculate lower bound
             else:
-                print("Iteration %d: time=%.2f, K=%d\n" % (i+1,time()-t,self.dim["K"]))
+                iter_time[i] = time()-t
+                print("Iteration %d: time=%.2f, K=%d\n" % (i+1,iter_time[i],self.active.sum()))
 
             # Flush (we need this to print when running on the cluster)
             sys.stdout.flush()
 
+        if start_trace: tracemalloc.stop()
+        if self.profiler is not None: self.profiler.stop()
+
+        # Remove the inactive factors from the nodes
+        self.compactFactors()
+
         # Finish by collecting the training statistics
-        self.train_stats = { 'activeK':activeK, 'elbo':elbo["total"].values, 'elbo_terms':elbo.drop("total",1) }
+        self.train_stats = { 'activeK':activeK, 'elbo':elbo["total"].values, 'elbo_terms':elbo.drop("total",1), 'time':iter_time }
         self.trained = True
 
     def getParameters(self, *nodes):
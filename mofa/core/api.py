@@ -0,0 +1,149 @@
+"""
+Module to train MOFA models from python, without going through the command line and the input files
+
+train: train one (or several) models on a list of matrices
+Model: a trained model, with the expectations of the factors and the weights and the training statistics
+
+Example:
+    import mofa
+    model = mofa.train([Y1, Y2], ["gaussian", "bernoulli"], factors=10, dropR2=0.01)
+    model.Z, model.W, model.stats
+    model.save("model.hdf5")
+
+The options are the same as the ones of the command line (see mofa --help), with the names of the attributes
+of the parsed arguments (i.e. factors, iter, tolerance, dropR2, center_features, learnIntercept, seed, ...)
+"""
+
+import os
+import scipy as s
+import pandas as pd
+
+from .init_asd import getParser, getDataOpts, setCovariates, getModelOpts, getTrainOpts
+from .build_model import runSingleTrial
+from .utils import processData, removeIncompleteSamples, saveModel
+from .projection import projectSamples
+
+class Model(object):
+    """ Class with the results of a trained model """
+
+    def __init__(self, net, data, data_opts, model_opts, train_opts):
+        """
+        PARAMETERS
+        ----------
+        net: a trained BayesNet instance
+        data: list
+            list of DataFrames with the training data of each view
+        data_opts: dic
+        model_opts: dic
+        train_opts: dic
+        """
+        self.net = net
+        self.data_opts = data_opts
+        self.model_opts = model_opts
+        self.train_opts = train_opts
+
+        self.view_names = data_opts['view_names']
+        self.likelihoods = model_opts['likelihood']
+        self.sample_names = data[0].index.tolist()
+        self.feature_names = [ data[m].columns.tolist() for m in range(len(data)) ]
+
+        # Expectations of the factors (samples,factors) and of the weights of each view (features,factors)
+        nodes = net.getNodes()
+        self.Z = nodes["Z"].getExpectation()
+        self.W = [ e["E"] for e in nodes["SW"].getExpectations() ]
+
+        # Training statistics (elbo, elbo_terms and activeK)
+        self.stats = net.getTrainingStats()
+
+    def save(self, outfile):
+        """ Method to save the model in an hdf5 file, in the same format as the command line
+
+        PARAMETERS
+        ----------
+        outfile: str
+        """
+        saveModel(self.net, outfile=outfile, train_opts=self.train_opts, model_opts=self.model_opts,
+            view_names=self.view_names, sample_names=self.sample_names, feature_names=self.feature_names,
+            storage=self.data_opts.get('storage'))
+
+    def project(self, data, **kwargs):
+        """ Method to infer the factors of new samples, keeping the rest of the model fixed (see projection.projectSamples) """
+        return projectSamples(self, data, **kwargs)
+
+def train(views, likelihoods, view_names=None, covariates=None, outfile=None, **options):
+    """ Method to train a MOFA model on data in memory
+
+    PARAMETERS
+    ----------
+    views: list
+        list of ndarrays or DataFrames with the data of each view, with dimensions (samples,features).
+        The names of the samples and features are taken from the index and columns of the DataFrames.
+        The input data is never modified.
+    likelihoods: list
+        likelihood of each view (gaussian, bernoulli or poisson)
+    view_names: list
+        names of the views (by default view0, view1, ...)
+    covariates: ndarray
+        matrix of covariates with dimensions (samples,covariates)
+    outfile: str
+        if given, the model is also saved in this hdf5 file
+    options:
+        any other option of the command line, with the name of the attribute of the parsed arguments
+
+    RETURNS
+    -------
+    a Model instance, or a list of them if ntrials > 1
+    """
+    M = len(views)
+    if view_names is None: view_names = [ "view%d" % m for m in range(M) ]
+    assert len(likelihoods) == M, "Please specify one likelihood for each view"
+    assert len(view_names) == M, "Length of view names and views does not match"
+
+    # Define the options as in the command line
+    args = getParser().parse_args(["--inFiles"] + ["<memory>"]*M + ["--outFile", str(outfile), "--likelihoods"] + list(likelihoods) + ["--views"] + list(view_names))
+    for k,v in options.items():
+        assert hasattr(args,k), "Unknown option '%s', see the command line options (mofa --help)" % k
+        setattr(args,k,v)
+    data_opts = getDataOpts(args)
+    data_opts['outfile'] = outfile
+
+    # Parse the data, the input arrays are used read-only so that the processing writes into new arrays
+    parsed = []
+    for m in range(M):
+        if isinstance(views[m], pd.DataFrame):
+            Y, samples, features = views[m].values, views[m].index.tolist(), views[m].columns.tolist()
+        else:
+            Y = s.asarray(views[m])
+            samples, features = list(range(Y.shape[0])), list(range(Y.shape[1]))
+        assert Y.ndim == 2, "View %d is not a matrix" % m
+        if Y.dtype.kind != "f": Y = Y.astype(s.float32)
+        Y = Y.view()
+        Y.setflags(write=False)
+        parsed.append([Y, samples, features])
+    assert len(set([ Y.shape[0] for Y,_,_ in parsed ])) == 1, "All views must have the same number of samples (rows)"
+
+    data = processData(parsed, data_opts, threads=args.loadThreads)
+    if data_opts['RemoveIncompleteSamples']:
+        data = removeIncompleteSamples(data)
+
+    # Define the covariates, the model options and the training options
+    setCovariates(args, data_opts, data[0].shape[0], covariates=covariates)
+    model_opts = getModelOpts(args, data, data_opts)
+    train_opts = getTrainOpts(args)
+
+    # Train
+    models = []
+    for trial in range(1,train_opts['trials']+1):
+        net = runSingleTrial(data, data_opts, model_opts, train_opts, seed=args.seed, trial=trial)
+        models.append(Model(net, data, data_opts, model_opts, train_opts))
+
+    # Save
+    if outfile is not None:
+        if len(models) == 1:
+            models[0].save(outfile)
+        else:
+            for t in range(len(models)):
+                tmp = os.path.splitext(outfile)
+                models[t].save(tmp[0]+"_"+str(t)+tmp[1])
+
+    return models[0] if len(models) == 1 else models
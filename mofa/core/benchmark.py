@@ -0,0 +1,361 @@
+"""
+Module to benchmark the training of MOFA models on simulated data
+
+Each configuration of a grid of number of samples (N), features per view (D), factors (K), views (M), fraction
+of missing values and likelihoods is simulated with Simulate (see simulate.py) into .npy files, and trained from
+the memory-mapped files with the python API (see api.py) in a new process, so that the peak memory of each run
+is measured independently and does not include the simulated data.
+
+runBenchmark: train the models of a grid of configurations and collect the timings and the memory
+compareResults: compare the results with a baseline and flag the regressions
+checkSharding: check that the sharded training (see parallel.py) gives the same ELBO trace as a single process
+entry_point: command line interface (mofa-benchmark)
+
+Example:
+    mofa-benchmark --N 1000 5000 --D 1000 --K 10 --M 2 --missing 0 0.2 --likelihoods gaussian gaussian,bernoulli --outFile results.json
+    mofa-benchmark --N 1000 5000 --D 1000 --K 10 --M 2 --outFile new.json --baseline results.json
+    mofa-benchmark --N 300 --D 200 --K 5 --M 3 --missing 0.1 --likelihoods gaussian,bernoulli,poisson --checkSharding 2
+"""
+
+from __future__ import division
+import argparse
+import ast
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+from time import time
+import numpy as np
+
+CONFIG_KEYS = ["N", "D", "K", "M", "missing", "likelihoods", "factors", "options"]
+
+def simulateData(N, D, K, M, likelihoods, missing=0., seed=1, outdir=None):
+    """ Method to simulate a dataset from the generative model
+
+    PARAMETERS
+    ----------
+    N: int
+        number of samples
+    D: int
+        number of features of each view
+    K: int
+        number of factors
+    M: int
+        number of views
+    likelihoods: list
+        likelihoods of the views (recycled if there are less likelihoods than views)
+    missing: float
+        fraction of missing values in each view
+    seed: int
+    outdir: str
+        if given, each view is written in blocks to a .npy file in this directory instead of being kept in memory
+
+    RETURNS
+    -------
+    list of DataFrames with the data of each view (or list of .npy files if outdir is given), and the likelihood of each view
+    """
+    from .simulate import Simulate
+
+    likelihoods = [ likelihoods[m % len(likelihoods)] for m in range(M) ]
+    sim = Simulate(M=M, N=N, D=[D]*M, K=K, seed=seed)
+    theta = [ 0.5*np.ones((D,K)) for m in range(M) ]
+    _, W, _, _ = sim.initW_spikeslab(theta=theta)
+    Z = sim.initZ()
+    Tau = sim.initTau()
+    Mu = sim.initMu()
+    if outdir is None:
+        data = sim.generateData(W=W, Z=Z, Tau=Tau, Mu=Mu, likelihood=likelihoods, missingness=missing)
+    else:
+        files = [ os.path.join(outdir, "view%d.npy" % m) for m in range(M) ]
+        data = sim.writeData(files, W=W, Z=Z, Tau=Tau, Mu=Mu, likelihood=likelihoods, missingness=missing, dtype=np.float64)
+    return data, likelihoods
+
+def peakMemory():
+    """ Method to return the peak resident memory of the current process in MB """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/2**20 if sys.platform == "darwin" else rss/2**10
+
+def writeConfiguration(config, outdir, seed=1):
+    """ Method to simulate the data of a configuration into .npy files (see simulateData), it is meant to run in
+    a new process, so that the memory of the simulation is not counted in the peak memory of the training
+
+    PARAMETERS
+    ----------
+    config: dic
+        configuration with the keys of CONFIG_KEYS
+    outdir: str
+        directory of the files
+    seed: int
+
+    RETURNS
+    -------
+    list of files of the views, likelihood of each view and time of the simulation
+    """
+    t = time()
+    files, likelihoods = simulateData(config["N"], config["D"], config["K"], config["M"], config["likelihoods"].split(","),
+        config["missing"], seed=seed, outdir=outdir)
+    return files, likelihoods, time()-t
+
+def runConfiguration(config, files, likelihoods, seed=1, verbose=False):
+    """ Method to train a single configuration from the files of the simulated views (see runBenchmark),
+    it is meant to run in a new process
+
+    PARAMETERS
+    ----------
+    config: dic
+        configuration with the keys of CONFIG_KEYS
+    files: list
+        .npy files with the data of each view, they are memory-mapped read-only
+    likelihoods: list
+        likelihood of each view
+    seed: int
+    verbose: boolean
+        show the output of the training?
+    """
+    from .api import train
+
+    data = [ np.load(f, mmap_mode="r") for f in files ]
+
+    t = time()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+        model = train(data, likelihoods, factors=config["factors"], seed=seed, **config["options"])
+    training_time = time()-t
+
+    iter_time = model.stats["time"][~np.isnan(model.stats["time"])]
+    elbo = model.stats["elbo"][~np.isnan(model.stats["elbo"])]
+    return { 'training_time': training_time,
+        'time_per_iteration': float(np.median(iter_time)),
+        'iterations': int(len(model.stats["time"])),
+        'converged': bool(len(model.stats["time"]) < model.train_opts["maxiter"]),
+        'active_factors': int(model.Z.shape[1]),
+        'elbo': float(elbo[-1]) if len(elbo) > 0 else None,
+        'input_mb': sum([ Y.nbytes for Y in data ])/2**20,
+        'peak_rss_mb': peakMemory() }
+
+def runBenchmark(grid, repeats=1, seed=1, verbose=False, data_dir=None):
+    """ Method to run the benchmark on a grid of configurations. The data of each run is simulated into
+    .npy files in a temporary directory, which are removed after the run. The simulation and the training run in
+    different processes, the peak memory of the training includes the pages of the files that are read
+
+    PARAMETERS
+    ----------
+    grid: dic
+        lists of values of each key of CONFIG_KEYS, all their combinations are benchmarked
+        (factors can be None to train with the simulated number of factors)
+    repeats: int
+        number of runs of each configuration, with different seeds
+    seed: int
+        seed of the first run
+    verbose: boolean
+    data_dir: str
+        directory of the temporary files of the simulated data (by default the temporary directory of the system)
+
+    RETURNS
+    -------
+    list of dictionaries with the configuration and the results of each run
+    """
+    keys = [ k for k in CONFIG_KEYS if k in grid ]
+    configs = [ dict(zip(keys,values)) for values in itertools.product(*[ grid[k] for k in keys ]) ]
+
+    # The simulation and the training of each run are done in fresh processes, so that the peak memory is not
+    # inherited from the previous runs or from the simulation
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for i, config in enumerate(configs):
+        config.setdefault("options", {})
+        if config.get("factors") is None: config["factors"] = config["K"]
+        for r in range(repeats):
+            print("Configuration %d/%d, run %d: %s" % (i+1, len(configs), r+1, configKey(config)))
+            sys.stdout.flush()
+            outdir = tempfile.mkdtemp(dir=data_dir, prefix="benchmark_")
+            pool = ctx.Pool(1, maxtasksperchild=1)
+            try:
+                files, likelihoods, simulation_time = pool.apply(writeConfiguration, (config, outdir, seed+r))
+                result = pool.apply(runConfiguration, (config, files, likelihoods, seed+r, verbose))
+            finally:
+                pool.close()
+                pool.join()
+                shutil.rmtree(outdir, ignore_errors=True)
+            result['simulation_time'] = simulation_time
+            print("  training=%.2fs, time per iteration=%.3fs, iterations=%d, peak memory=%.0fMB (input %.0fMB)" %
+                (result['training_time'], result['time_per_iteration'], result['iterations'], result['peak_rss_mb'], result['input_mb']))
+            results.append(dict(config, run=r, seed=seed+r, **result))
+    return results
+
+def configKey(config):
+    """ Method to return a string that identifies a configuration """
+    return ", ".join([ "%s=%s" % (k, json.dumps(config[k], sort_keys=True)) for k in CONFIG_KEYS if k in config ])
+
+def environment():
+    """ Method to collect the versions of the software and the hardware, to interpret the results """
+    import scipy
+    import pandas
+    return { 'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+        'pandas': pandas.__version__, 'machine': platform.machine(), 'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count() }
+
+def saveResults(results, outfile):
+    """ Method to save the results of the benchmark in a json file
+
+    PARAMETERS
+    ----------
+    results: list
+    outfile: str
+    """
+    with open(outfile, "w") as f:
+        json.dump({ 'environment':environment(), 'results':results }, f, indent=1)
+
+def loadResults(infile):
+    """ Method to load the results of a benchmark saved with saveResults """
+    with open(infile) as f:
+        return json.load(f)['results']
+
+def compareResults(results, baseline, threshold=0.25, metrics=("time_per_iteration", "training_time", "peak_rss_mb")):
+    """ Method to compare the results of the benchmark with a baseline. The runs of the same configuration are
+    summarised with their median, and a regression is flagged when a metric increases by more than the threshold
+
+    PARAMETERS
+    ----------
+    results: list
+        results of runBenchmark
+    baseline: list
+        results of runBenchmark of the reference version
+    threshold: float
+        maximum relative increase of each metric
+    metrics: list
+        metrics to compare (lower is better)
+
+    RETURNS
+    -------
+    list of dictionaries with the configuration, the metric, the values and their ratio, for all the comparisons
+    """
+    def summarise(runs):
+        groups = {}
+        for run in runs: groups.setdefault(configKey(run), []).append(run)
+        return { k:{ m:float(np.median([ run[m] for run in v ])) for m in metrics } for k,v in groups.items() }
+
+    current, reference = summarise(results), summarise(baseline)
+    comparison = []
+    for key in current:
+        if key not in reference:
+            print("Configuration not found in the baseline: %s" % key)
+            continue
+        for m in metrics:
+            ratio = current[key][m] / reference[key][m] if reference[key][m] > 0 else np.inf
+            comparison.append({ 'configuration':key, 'metric':m, 'baseline':reference[key][m], 'current':current[key][m],
+                'ratio':ratio, 'regression':bool(ratio > 1.+threshold) })
+    return comparison
+
+def parseOptions(options):
+    """ Method to parse the options of the model given as key=value (values are parsed as python literals if possible) """
+    parsed = {}
+    for opt in options:
+        k, v = opt.split("=", 1)
+        try:
+            parsed[k] = ast.literal_eval(v)
+        except (ValueError, SyntaxError):
+            parsed[k] = v
+    return parsed
+
+def checkSharding(config, nworkers=2, seed=1, rtol=1e-8, verbose=False):
+    """ Method to train a configuration in a single process and sharded over local workers, and to compare
+    the ELBO traces, which must be the same up to the rounding errors of the reduction of the statistics
+
+    PARAMETERS
+    ----------
+    config: dic
+        configuration with the keys of CONFIG_KEYS (see runBenchmark)
+    nworkers: int
+        number of workers of the sharded training
+    seed: int
+    rtol: float
+        maximum relative difference of the ELBO at any iteration
+    verbose: boolean
+        show the output of the training?
+
+    RETURNS
+    -------
+    dictionary with the ELBO traces of both trainings, the maximum relative difference and whether the check passed
+    """
+    from .api import train
+
+    data, likelihoods = simulateData(config["N"], config["D"], config["K"], config["M"], config["likelihoods"].split(","), config["missing"], seed=seed)
+    options = dict(config.get("options", {}), elbofreq=1, nostop=True)
+    factors = config.get("factors") or config["K"]
+    elbo = {}
+    for n in (1, nworkers):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+            model = train(data, likelihoods, factors=factors, seed=seed, **dict(options, nworkers=n))
+        elbo[n] = model.stats["elbo"]
+    single, sharded = elbo[1], elbo[nworkers]
+    if len(single) != len(sharded):
+        difference = np.inf
+    else:
+        difference = float(np.max(np.abs(sharded-single)/np.abs(single))) if len(single) > 0 else 0.
+        difference = np.inf if np.isnan(difference) else difference
+    return { 'single':single.tolist(), 'sharded':sharded.tolist(), 'difference':difference, 'passed':bool(difference <= rtol) }
+
+def entry_point():
+    p = argparse.ArgumentParser( description='Benchmark of MOFA on simulated data' )
+    p.add_argument( '--N',           type=int, nargs='+', default=[1000],        help='Number of samples' )
+    p.add_argument( '--D',           type=int, nargs='+', default=[1000],        help='Number of features per view' )
+    p.add_argument( '--K',           type=int, nargs='+', default=[10],          help='Number of simulated factors' )
+    p.add_argument( '--M',           type=int, nargs='+', default=[2],           help='Number of views' )
+    p.add_argument( '--missing',     type=float, nargs='+', default=[0.],        help='Fraction of missing values' )
+    p.add_argument( '--likelihoods', type=str, nargs='+', default=["gaussian"],  help='Likelihoods of the views, separated by commas (recycled over the views), i.e. gaussian,bernoulli' )
+    p.add_argument( '--factors',     type=int, nargs='+', default=[None],        help='Number of factors of the model (default: the simulated number)' )
+    p.add_argument( '--options',     type=str, nargs='+', default=[],            help='Other options of the model, as in the python API, i.e. iter=100 dropR2=0.01 nworkers=2' )
+    p.add_argument( '--repeats',     type=int, default=1,                        help='Number of runs of each configuration' )
+    p.add_argument( '--seed',        type=int, default=1,                        help='Random seed of the first run' )
+    p.add_argument( '--outFile',     type=str, default=None,                     help='Output file with the results (json)' )
+    p.add_argument( '--dataDir',     type=str, default=None,                     help='Directory of the temporary files of the simulated data (default: the temporary directory of the system)' )
+    p.add_argument( '--results',     type=str, default=None,                     help='Results of a previous benchmark to compare with the baseline, instead of running the benchmark' )
+    p.add_argument( '--baseline',    type=str, default=None,                     help='Results of the reference version (json), to flag regressions' )
+    p.add_argument( '--threshold',   type=float, default=0.25,                   help='Maximum relative increase of the time and the memory in the comparison with the baseline' )
+    p.add_argument( '--checkSharding', type=int, default=None,                  help='Instead of the benchmark, check that the training sharded over this number of workers gives the same ELBO as a single process' )
+    p.add_argument( '--verbose',     action='store_true',                        help='Show the output of the training?' )
+    args = p.parse_args()
+
+    if args.checkSharding is not None:
+        options = parseOptions(args.options)
+        options.setdefault("iter", 20)
+        failed = 0
+        for config in itertools.product(args.N, args.D, args.K, args.M, args.missing, args.likelihoods, args.factors):
+            config = dict(zip(CONFIG_KEYS, config), options=options)
+            result = checkSharding(config, nworkers=args.checkSharding, seed=args.seed, verbose=args.verbose)
+            print("%s: final ELBO %.2f (single) %.2f (sharded), max relative difference %.2e%s" % (configKey(config),
+                result['single'][-1], result['sharded'][-1], result['difference'], "" if result['passed'] else "  FAILED"))
+            failed += not result['passed']
+        print("%d configuration(s) failed" % failed)
+        if failed > 0:
+            sys.exit(1)
+        return
+
+    if args.results is not None:
+        results = loadResults(args.results)
+    else:
+        options = parseOptions(args.options)
+        options.setdefault("iter", 100)
+        grid = { 'N':args.N, 'D':args.D, 'K':args.K, 'M':args.M, 'missing':args.missing,
+            'likelihoods':args.likelihoods, 'factors':args.factors, 'options':[options] }
+        results = runBenchmark(grid, repeats=args.repeats, seed=args.seed, verbose=args.verbose, data_dir=args.dataDir)
+        if args.outFile is not None:
+            saveResults(results, args.outFile)
+
+    if args.baseline is not None:
+        comparison = compareResults(results, loadResults(args.baseline), threshold=args.threshold)
+        regressions = [ c for c in comparison if c['regression'] ]
+        for c in comparison:
+            print("%s %s: %.3f -> %.3f (x%.2f)%s" % (c['configuration'], c['metric'], c['baseline'], c['current'], c['ratio'], "  REGRESSION" if c['regression'] else ""))
+        print("%d regression(s) found" % len(regressions))
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    entry_point()
@@ -1,7 +1,7 @@
 """
 Module with functions to initialise the model 
 
-runSingleTrial: run a single trial
+runSingleTrial: run a single trial, optionally sharding the features over several workers (see parallel.py)
 runMultipleTrial: run multiple trials, optionally in Parallel (not implemented)
 
 """
@@ -11,11 +11,15 @@ from sys import path
 from time import time,sleep
 import pandas as pd
 import numpy as np
+from multiprocessing.pool import ThreadPool
 #from joblib import Parallel, delayed
 
 from .init_nodes import *
 from .BayesNet import BayesNet
+from .parallel import ShardedBayesNet, startLocalWorkers, connectWorkers
 from .utils import *
+from .memory import memorySummary
+from .profiler import SamplingProfiler
 
 def runSingleTrial(data, data_opts, model_opts, train_opts, seed=None, trial=1, verbose=False):
     """Method to run a single trial of a MOFA model
@@ -42,7 +46,7 @@ def runSingleTrial(data, data_opts, model_opts, train_opts, seed=None, trial=1,
     ###########################
 
     # Create output directory
-    if not os.path.isdir(os.path.dirname(data_opts["outfile"])):
+    if data_opts.get("outfile") is not None and not os.path.isdir(os.path.dirname(data_opts["outfile"])):
         print("Output directory does not exist, creating it...")
         os.makedirs(os.path.dirname(data_opts["outfile"]))
 
@@ -64,7 +68,6 @@ def runSingleTrial(data, data_opts, model_opts, train_opts, seed=None, trial=1,
     print ("## Building the model ##")
     print ("#"*24)
     print ("\n")
-    sleep(1)
 
     # Define dimensionalities
     M = len(data)
@@ -74,67 +77,31 @@ def runSingleTrial(data, data_opts, model_opts, train_opts, seed=None, trial=1,
 
     dim = {'M':M, 'N':N, 'D':D, 'K':K }
 
-    ## Define and initialise the nodes ##
-
-    init = initModel(dim, data, model_opts["likelihood"], seed=seed)
-
-    # Latent variables
-    init.initZ(pmean=model_opts["priorZ"]["mean"], pvar=model_opts["priorZ"]["var"],
-               qmean=model_opts["initZ"]["mean"], qvar=model_opts["initZ"]["var"], qE=model_opts["initZ"]["E"], qE2=model_opts["initZ"]["E2"],
-               covariates=data_opts['covariates'], scale_covariates=data_opts['scale_covariates'])
-
-    # Sparse weights
-    init.initSW(ptheta=model_opts["priorSW"]["Theta"], pmean_S0=model_opts["priorSW"]["mean_S0"], pvar_S0=model_opts["priorSW"]["var_S0"], pmean_S1=model_opts["priorSW"]["mean_S1"], pvar_S1=model_opts["priorSW"]["var_S1"],
-                qtheta=model_opts["initSW"]["Theta"], qmean_S0=model_opts["initSW"]["mean_S0"], qvar_S0=model_opts["initSW"]["var_S0"], qmean_S1=model_opts["initSW"]["mean_S1"], qvar_S1=model_opts["initSW"]["var_S1"],
-                qEW_S0=model_opts["initSW"]["EW_S0"], qEW_S1=model_opts["initSW"]["EW_S1"], qES=model_opts["initSW"]["ES"])
-
-    # ARD on weights
-    init.initAlphaW_mk(pa=model_opts["priorAlphaW"]['a'], pb=model_opts["priorAlphaW"]['b'],
-                       qa=model_opts["initAlphaW"]['a'], qb=model_opts["initAlphaW"]['b'], qE=model_opts["initAlphaW"]['E'])
-
-    # Precision of noise
-    init.initTau(pa=model_opts["priorTau"]['a'], pb=model_opts["priorTau"]['b'],
-                 qa=model_opts["initTau"]['a'], qb=model_opts["initTau"]['b'], qE=model_opts["initTau"]['E'])
-
-    # Sparsity on the weights
-    if len(s.unique(model_opts['learnTheta'])) == 1:
-
-        # All are infered
-        if s.unique(model_opts['learnTheta'])==1.:
-            # init.initThetaLearn(pa=model_opts["priorTheta"]['a'], pb=model_opts["priorTheta"]['b'],
-            #     qa=model_opts["initTheta"]['a'],  qb=model_opts["initTheta"]['b'], qE=model_opts["initTheta"]['E'])
-            init.initThetaMixed(pa=model_opts["priorTheta"]['a'], pb=model_opts["priorTheta"]['b'],
-                qa=model_opts["initTheta"]['a'],  qb=model_opts["initTheta"]['b'], qE=model_opts["initTheta"]['E'],
-                learnTheta=model_opts['learnTheta'])
+    # Initialise the latent variables and the weights from the principal components (shared with the workers)
+    if isinstance(model_opts["initZ"]["mean"], str) and model_opts["initZ"]["mean"] == "pca":
+        model_opts = pcaModelOpts(data, data_opts, model_opts, seed)
 
-        # None are infered
-        elif s.unique(model_opts['learnTheta'])==0.:
-            init.initThetaConst(value=model_opts["initTheta"]['E'])
-
-    # Some are infered
-    else:
-        init.initThetaMixed(pa=model_opts["priorTheta"]['a'], pb=model_opts["priorTheta"]['b'],
-            qa=model_opts["initTheta"]['a'],  qb=model_opts["initTheta"]['b'], qE=model_opts["initTheta"]['E'],
-            learnTheta=model_opts['learnTheta'])
-
-    # Observed data
-    init.initY()
-
-    # Define the markov blanket of each node
-    nodes = init.getNodes()
-    nodes["Z"].addMarkovBlanket(SW=nodes["SW"], Tau=nodes["Tau"], Y=nodes["Y"])
-    nodes["Theta"].addMarkovBlanket(SW=nodes["SW"])
-    nodes["AlphaW"].addMarkovBlanket(SW=nodes["SW"])
-    nodes["SW"].addMarkovBlanket(Z=nodes["Z"], Tau=nodes["Tau"], Alpha=nodes["AlphaW"], Y=nodes["Y"], Theta=nodes["Theta"])
-    nodes["Y"].addMarkovBlanket(Z=nodes["Z"], SW=nodes["SW"], Tau=nodes["Tau"])
-    nodes["Tau"].addMarkovBlanket(Z=nodes["Z"], SW=nodes["SW"], Y=nodes["Y"])
+    ## Define and initialise the nodes ##
+    nodes = buildNodes(dim, data, data_opts, model_opts, seed)
 
     ##################################
     ## Add the nodes to the network ##
     ##################################
 
-    # Initialise Bayesian Network
-    net = BayesNet(dim=dim, trial=trial, schedule=model_opts["schedule"], nodes=init.getNodes(), options=train_opts)
+    # Initialise Bayesian Network, optionally sharding the features over a pool of workers
+    if train_opts.get('nworkers',1) > 1 or train_opts.get('workers') is not None:
+        if train_opts.get('workers') is not None:
+            pool = connectWorkers(train_opts['workers'], train_opts['authkey'])
+        else:
+            pool = startLocalWorkers(train_opts['nworkers'])
+        print("Sharding the features over %d workers..." % pool.size())
+        net = ShardedBayesNet(dim=dim, trial=trial, schedule=model_opts["schedule"], nodes=nodes, options=train_opts, pool=pool)
+        net.setupWorkers(data, model_opts, seed)
+    else:
+        pool = None
+        net = BayesNet(dim=dim, trial=trial, schedule=model_opts["schedule"], nodes=nodes, options=train_opts)
+
+    print("Memory held by the nodes:\n%s\n" % memorySummary(net))
 
     ####################
     ## Start training ##
@@ -145,10 +112,23 @@ def runSingleTrial(data, data_opts, model_opts, train_opts, seed=None, trial=1,
     print ("## Running trial number %d with seed %d ##" % (trial,seed))
     print ("#"*45)
     print ("\n")
-    sleep(1)
     
+    if train_opts.get('profile') is not None:
+        net.profiler = SamplingProfiler(**train_opts['profile'])
+
     net.iterate()
 
+    if pool is not None:
+        pool.close()
+
+    # Write the profile next to the output file
+    if net.profiler is not None:
+        print("Profile of the training:\n%s\n" % net.profiler.summary())
+        if data_opts.get("outfile") is not None:
+            prefix = os.path.splitext(data_opts["outfile"])[0] + "_profile"
+            if train_opts.get('trials',1) > 1: prefix += "_" + str(trial-1)
+            print("Writing the profile in %s..." % ", ".join(net.profiler.write(prefix)))
+
     return net
 
 def runMultipleTrials(data, data_opts, model_opts, train_opts, keep_best_run, seed=None, verbose=True):
@@ -168,7 +148,29 @@ def runMultipleTrials(data, data_opts, model_opts, train_opts, keep_best_run, se
     # trained_models = Parallel(n_jobs=train_opts['cores'], backend="threading")(
     # trained_models = Parallel(n_jobs=train_opts['cores'])(
     #     delayed(runSingleTrial)(data,data_opts,model_opts,train_opts,seed,i) for i in range(1,train_opts['trials']+1))
-    trained_models = [ runSingleTrial(data,data_opts,model_opts,train_opts,seed,i) for i in range(1,train_opts['trials']+1) ]
+
+    # Output files
+    if train_opts['trials'] > 1 and not keep_best_run:
+        tmp = os.path.splitext(data_opts['outfile'])
+        outfiles = [ tmp[0]+"_"+str(t)+tmp[1]for t in range(train_opts['trials']) ]
+    else:
+        outfiles = [ data_opts['outfile'] ]
+
+    sample_names = data[0].index.tolist()
+    feature_names = [  data[m].columns.values.tolist() for m in range(len(data)) ]
+    def save(t, model):
+        print("Saving model %d in %s...\n" % (t,outfiles[t]))
+        saveModel(model, outfile=outfiles[t], view_names=data_opts['view_names'], sample_names=sample_names,
+            feature_names=feature_names, train_opts=train_opts, model_opts=model_opts, storage=data_opts.get('storage'))
+
+    # If all models are kept, each one is saved in a background thread while the next one is trained
+    writer = ThreadPool(1)
+    pending = []
+    trained_models = []
+    for i in range(1,train_opts['trials']+1):
+        trained_models.append( runSingleTrial(data,data_opts,model_opts,train_opts,seed,i) )
+        if not keep_best_run:
+            pending.append( writer.apply_async(save, (i-1,trained_models[-1])) )
 
     print("\n")
     print("#"*43)
@@ -180,27 +182,15 @@ def runMultipleTrials(data, data_opts, model_opts, train_opts, keep_best_run, se
     ## Process results ##
     #####################
 
-    # Select the trial with the best lower bound or keep all models
-    if train_opts['trials'] > 1:
-        if keep_best_run:
-            lb = map(lambda x: x.getTrainingStats()["elbo"][-1], trained_models)
-            save_models = [ trials[s.argmax(lb)] ]
-            outfiles = [ data_opts['outfile'] ]
-        else:
-            save_models = trained_models
-            tmp = os.path.splitext(data_opts['outfile'])
-            outfiles = [ tmp[0]+"_"+str(t)+tmp[1]for t in range(train_opts['trials']) ]
-    else:
-        save_models = trained_models
-        outfiles = [ data_opts['outfile'] ]
+    # Select the trial with the best lower bound
+    if keep_best_run:
+        lb = [ x.getTrainingStats()["elbo"][-1] for x in trained_models ]
+        pending.append( writer.apply_async(save, (0,trained_models[s.nanargmax(lb)])) )
 
     ##################
     ## Save results ##
     ##################
-    
-    sample_names = data[0].index.tolist()
-    feature_names = [  data[m].columns.values.tolist() for m in range(len(data)) ]
-    for t in range(len(save_models)):
-        print("Saving model %d in %s...\n" % (t,outfiles[t]))
-        saveModel(save_models[t], outfile=outfiles[t], view_names=data_opts['view_names'],
-            sample_names=sample_names, feature_names=feature_names, train_opts=train_opts, model_opts=model_opts)
+
+    # Wait for the writes to finish (and raise their errors, if any)
+    for p in pending: p.get()
+    writer.close()
@@ -0,0 +1,141 @@
+from __future__ import division
+import hashlib
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+
+"""
+Module to define an on-disk cache of the parsed data
+
+Every entry of the cache is a directory named after a hash of the content of the input files and of the
+data processing options, which contains one .npy file per view and a json file with the names of the samples
+and features. Entries are loaded as memory-mapped arrays, so a cache hit skips the parsing of the input files.
+When the total size of the cache exceeds its limit the least recently used entries are removed.
+"""
+
+# Increase this number if the format of the cached data changes
+CACHE_VERSION = 1
+
+# Data options that determine the content of the cached data
+CACHE_OPTS = ['delimiter', 'colnames', 'rownames', 'center_features', 'scale_views', 'scale_features', 'RemoveIncompleteSamples']
+
+class DataCache(object):
+    """ Class to store and retrieve the parsed data of a set of input files """
+
+    def __init__(self, directory, max_size=None):
+        """
+        PARAMETERS
+        ----------
+        directory: str
+            directory where the cache is stored
+        max_size: float
+            maximum size of the cache in bytes (None for no limit)
+        """
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(self.directory): os.makedirs(self.directory)
+
+    def key(self, data_opts):
+        """ Method to calculate the key of the data, a hash of the content of the input files
+        (including the sidecar files with the names) and of the data processing options
+
+        PARAMETERS
+        ----------
+        data_opts: dic
+        """
+        h = hashlib.sha1()
+        h.update(str(CACHE_VERSION).encode())
+        h.update(json.dumps([ data_opts.get(k) for k in CACHE_OPTS ], default=str).encode())
+        for file in data_opts['input_files']:
+            h.update(file.encode())
+            path = re.sub(r"(\.(?:h5|hdf5)):.+$", r"\1", file)
+            for f in [path, path + ".rownames", path + ".colnames"]:
+                if not os.path.isfile(f): continue
+                with open(f, "rb") as fh:
+                    for block in iter(lambda: fh.read(2**20), b""):
+                        h.update(block)
+        return h.hexdigest()
+
+    def load(self, key):
+        """ Method to load the data of an entry of the cache, returns None if the entry does not exist
+
+        PARAMETERS
+        ----------
+        key: str
+        """
+        path = os.path.join(self.directory, key)
+        if not os.path.isfile(os.path.join(path, "names.json")):
+            return None
+
+        with open(os.path.join(path, "names.json")) as f:
+            names = json.load(f)
+
+        # Arrays are loaded as copy-on-write memory maps, so they can be modified without changing the cache
+        data = [ pd.DataFrame(np.load(os.path.join(path, "view%d.npy" % m), mmap_mode="c"), index=names['samples'], columns=names['features'][m], copy=False)
+            for m in range(len(names['features'])) ]
+
+        # Mark the entry as recently used
+        os.utime(path, None)
+        self.evict(keep=key)
+        return data
+
+    def store(self, key, data):
+        """ Method to store the data in a new entry of the cache
+
+        PARAMETERS
+        ----------
+        key: str
+        data: list
+            list of DataFrames with the data of each view
+        """
+        path = os.path.join(self.directory, key)
+        if os.path.isdir(path): return
+
+        # Write in a temporary directory first, so that incomplete entries are never loaded
+        tmp = "%s.tmp%d" % (path, os.getpid())
+        if os.path.isdir(tmp): shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for m in range(len(data)):
+            np.save(os.path.join(tmp, "view%d.npy" % m), np.ascontiguousarray(data[m].values))
+        names = { 'samples':data[0].index.tolist(), 'features':[ data[m].columns.tolist() for m in range(len(data)) ] }
+        with open(os.path.join(tmp, "names.json"), "w") as f:
+            json.dump(names, f, default=str)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Another process stored the same entry in the meantime
+            shutil.rmtree(tmp)
+
+        self.evict(keep=key)
+
+    def entries(self):
+        """ Method to list the entries of the cache as (key, size in bytes, last access time), from the least recently used """
+        entries = []
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if not os.path.isfile(os.path.join(path, "names.json")): continue
+            size = sum([ os.path.getsize(os.path.join(path,f)) for f in os.listdir(path) ])
+            entries.append((key, size, os.path.getmtime(path)))
+        return sorted(entries, key=lambda x: x[2])
+
+    def evict(self, keep=None):
+        """ Method to remove the least recently used entries until the size of the cache is below its limit
+
+        PARAMETERS
+        ----------
+        keep: str
+            key of an entry that should not be removed
+        """
+        if self.max_size is None: return
+        entries = self.entries()
+        total = sum([ e[1] for e in entries ])
+        for key, size, _ in entries:
+            if total <= self.max_size: break
+            if key == keep: continue
+            print("Removing %s from the data cache (%.1f MB)..." % (key, size/2**20))
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            total -= size
@@ -17,6 +17,7 @@ import scipy as s
 import numpy.linalg as linalg
 import scipy.special as special
 import scipy.stats as stats
+from collections.abc import Mapping
 
 from .utils import *
 
@@ -386,55 +387,41 @@ class BernoulliGaussian(Distribution):
     p(w,s) = Normal(w|mean,var) * Bernoulli(s|theta)
     FINISH EQUATIONS
 
-    ROOM FOR IMPROVEMENT: i think the current code is inefficient because you have to keep track of the params
-    and expectations in both the factorised distributions and the joint one. I think
-    perhaps is better not to define new Bernoulli and UnivariateGaussian but work directly with the joint model
+    The joint distribution is stored in a compact form: the probability of the slab (theta) and the
+    parameters of the slab (mean_S1 and var_S1) are stored as (D,K) arrays, whereas the parameters of the spike
+    (mean_S0 and var_S0) are shared by all features and are stored as (K,) vectors which are broadcasted on demand.
+    The expectations are not stored but derived from the parameters every time they are requested (see SpikeSlabExpectations),
+    so the only (D,K) arrays that stay in memory are the three parameters of the slab.
 
     """
     def __init__(self, dim, mean_S0, mean_S1, var_S0, var_S1, theta, EW_S0=None, EW_S1=None, ES=None):
+        # EW_S0, EW_S1 and ES are kept for compatibility, the expectations are always calculated from the parameters
         Distribution.__init__(self,dim)
-        self.S = Bernoulli(dim=dim, theta=theta, E=ES)
-        self.W_S0 = UnivariateGaussian(dim=dim, mean=mean_S0, var=var_S0, E=EW_S0)
-        self.W_S1 = UnivariateGaussian(dim=dim, mean=mean_S1, var=var_S1, E=EW_S1)
 
         # Collect parameters
-        self.params = { 'mean_S0':mean_S0, 'mean_S1':mean_S1, 'var_S0':var_S0, 'var_S1':var_S1, 'theta':theta }
-        
+        self.params = {}
+        self.setParameters(mean_S0=mean_S0, mean_S1=mean_S1, var_S0=var_S0, var_S1=var_S1, theta=theta)
+
         # Collect expectations
         self.updateExpectations()
 
     def setParameters(self,**params):
         # Setter function for parameters
-        self.S.setParameters(theta=params['theta'])
-        self.W_S0.setParameters(mean=params['mean_S0'], var=params['var_S0'])
-        self.W_S1.setParameters(mean=params['mean_S1'], var=params['var_S1'])
-        self.params = params
-
-    def updateParameters(self):
-        # Method to update the parameters of the joint distribution based on its constituent distributions
-        self.params = { 'theta':self.S.params["theta"], 
-                        'mean_S0':self.W_S0.params["mean"], 'var_S0':self.W_S0.params["var"],
-                        'mean_S1':self.W_S1.params["mean"], 'var_S1':self.W_S1.params["var"] }
+        for k in ['theta','mean_S1','var_S1']:
+            self.params[k] = params[k] if s.shape(params[k]) == self.dim else s.ones(self.dim)*params[k]
+        for k in ['mean_S0','var_S0']:
+            self.params[k] = self.compactSpike(params[k])
+
+    def compactSpike(self, x):
+        # Method to store a parameter of the spike as a (K,) vector
+        # (D,K) arrays are assumed to be constant across features, as the spike is shared by all of them
+        if s.ndim(x) == 2:
+            return x[0,:].copy()
+        return s.ones(self.dim[1])*x
 
     def updateExpectations(self):
-        # Method to calculate the expectations based on the current estimates for the parameters
-
-        # Update expectations of the constituent distributions
-        self.S.updateExpectations()
-        self.W_S0.updateExpectations()
-        self.W_S1.updateExpectations()
-
-        # Calculate expectations of the joint distribution
-        ES = self.S.getExpectation()
-        EW = self.W_S1.getExpectation()
-        E = ES * EW
-        ESWW = ES * (s.square(EW) + self.params["var_S1"])
-        # ESWW = self.params["theta"] * (self.params["mean_S1"]**2 + self.params["var_S1"])
-        EWW = ES*(s.square(EW)+self.params["var_S1"]) + (1-ES)*self.params["var_S0"]
-        # EWW = self.params["theta"]*(self.params["mean_S1"]**2+self.params["var_S1"]) + (1-self.params["theta"])*self.params["var_S0"]
-
-        # Collect expectations
-        self.expectations = {'E':E, 'ES':ES, 'EW':EW, 'ESWW':ESWW, 'EWW':EWW }
+        # The expectations are calculated on demand from the current estimates of the parameters
+        self.expectations = SpikeSlabExpectations(self.params)
 
     def removeDimensions(self, axis, idx):
         # Method to remove undesired dimensions
@@ -442,20 +429,53 @@ class BernoulliGaussian(Distribution):
         # - idx (numpy array): indices of the elements to remove
         assert axis <= len(self.dim)
         assert s.all(idx < self.dim[axis])
-        self.S.removeDimensions(axis,idx)
-        self.W_S0.removeDimensions(axis,idx)
-        self.W_S1.removeDimensions(axis,idx)
-        self.updateParameters()
+        for k in ['theta','mean_S1','var_S1']:
+            self.params[k] = s.delete(self.params[k], idx, axis)
+        if axis == 1:
+            for k in ['mean_S0','var_S0']:
+                self.params[k] = s.delete(self.params[k], idx, 0)
+        self.updateDim(axis=axis, new_dim=self.dim[axis]-len(idx))
         self.updateExpectations()
 
-    def updateDim(self, axis, new_dim):
-        # Function to update the dimensionality of a particular axis
-        self.S.updateDim(axis,new_dim)
-        self.W_S0.updateDim(axis,new_dim)
-        self.W_S1.updateDim(axis,new_dim)
-        dim = list(self.dim)
-        dim[axis] = new_dim
-        self.dim = tuple(dim)
+class SpikeSlabExpectations(Mapping):
+    """
+    Read-only dictionary with the expectations of a BernoulliGaussian distribution, which are calculated from
+    its parameters every time they are requested instead of being stored. The returned arrays are new arrays,
+    except ES and EW which are the parameters theta and mean_S1 themselves.
+
+    Equations:
+    E[S] = theta
+    E[W|S=1] = mean_S1
+    E[SW] = theta * mean_S1
+    E[(SW)^2] = theta * (mean_S1^2 + var_S1)
+    E[W^2] = E[(SW)^2] + (1-theta) * var_S0
+    """
+    names = ('E', 'ES', 'EW', 'ESWW', 'EWW')
+
+    def __init__(self, params):
+        # params (dic): parameters of the distribution, the dictionary is shared so that the expectations follow its updates
+        self.params = params
+
+    def __getitem__(self, name):
+        theta = self.params["theta"]
+        if name == "ES":
+            return theta
+        elif name == "EW":
+            return self.params["mean_S1"]
+        elif name == "E":
+            return theta * self.params["mean_S1"]
+        elif name == "ESWW":
+            return theta * (s.square(self.params["mean_S1"]) + self.params["var_S1"])
+        elif name == "EWW":
+            return self["ESWW"] + (1.-theta)*self.params["var_S0"][None,:]
+        raise KeyError(name)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
 class Binomial(Distribution):
     """
     Class to define Binomial distributions
@@ -0,0 +1,454 @@
+"""
+Module to estimate the time and the memory of the training of a model without loading the data (dry run)
+
+The dimensions of the views are read from the headers of the input files, and the cost of each node update is
+derived from the update formulas (see updates.py and nongaussian_nodes.py), counting four kinds of operations
+per iteration:
+- gemm: floating point operations of the matrix products with the factors (i.e. the (N,K)x(K,D) products)
+- stream: element-wise passes over arrays (copies, masks, element-wise arithmetic, matrix-vector products)
+- transcendental: element-wise exp, log, tanh and sqrt
+- masked: element-wise divisions of masked arrays (the pseudodata of the non-gaussian views), which check the domain of the result
+Each kind of operation is converted into time with the throughput measured on this machine (see machineRates).
+Optionally, the estimate is calibrated by training a few iterations on a subsample of the data and scaling
+the predicted time by the ratio of the measured and the predicted time of the subsample.
+
+The memory held by the nodes (parameters, expectations, data, cached products and workspace buffers) is measured
+on the same model trained on small random data and scaled to the dimensions of the data (see memory.py), and the
+largest temporary arrays allocated by a single update are added to it.
+
+nodeCosts: operations and temporary memory of each node update for given dimensions
+heldMemory: memory held by each node for given dimensions
+machineRates: throughput of each kind of operation
+calibrate: ratio of the measured and the predicted time per iteration on a subsample
+dryRun: estimate of the training defined by the command line options (--dryRun)
+"""
+
+from __future__ import division
+import contextlib
+import os
+import re
+import resource
+import sys
+import zipfile
+from time import time
+import numpy as np
+import numpy.ma as ma
+import pandas as pd
+import h5py
+
+from .memory import formatBytes
+
+# Options of the command line that define the model that is trained for the calibration
+CALIBRATION_OPTIONS = ["center_features", "scale_features", "scale_views", "learnIntercept", "learnTheta", "initTheta", "schedule", "startSparsity", "seed"]
+
+def viewShape(file, data_opts):
+    """ Method to read the dimensions of a view from the header of its file (see readView), without reading the data
+
+    PARAMETERS
+    ----------
+    file: str
+    data_opts: dic
+
+    RETURNS
+    -------
+    rows, columns and size in bytes of the values of the view once loaded
+    """
+    h5 = re.match(r"^(.*\.(?:h5|hdf5))(?::(.+))?$", file)
+    ext = os.path.splitext(file)[1].lower()
+
+    # Numpy array
+    if ext == ".npy":
+        Y = np.load(file, mmap_mode="r")
+        return Y.shape[0], Y.shape[1], Y.dtype.itemsize if Y.dtype.kind == "f" else 4
+
+    # Numpy archive (the header of the matrix is read from the zip file)
+    if ext == ".npz":
+        with zipfile.ZipFile(file) as archive:
+            names = [ x[:-4] for x in archive.namelist() ]
+            name = "data" if "data" in names else names[0]
+            with archive.open(name + ".npy") as f:
+                version = np.lib.format.read_magic(f)
+                header = np.lib.format.read_array_header_1_0 if version == (1,0) else np.lib.format.read_array_header_2_0
+                shape, _, dtype = header(f)
+        return shape[0], shape[1], dtype.itemsize if dtype.kind == "f" else 4
+
+    # HDF5 dataset
+    if h5 is not None:
+        with h5py.File(h5.group(1), "r") as f:
+            ds = f[h5.group(2) if h5.group(2) is not None else "data"]
+            return ds.shape[0], ds.shape[1], ds.dtype.itemsize if ds.dtype.kind == "f" else 4
+
+    # Parquet table (the metadata is read with pyarrow)
+    if ext == ".parquet":
+        import pyarrow.parquet as pq
+        meta = pq.ParquetFile(file).metadata
+        columns = [ meta.schema.column(i).name for i in range(meta.num_columns) ]
+        return meta.num_rows, len([ c for c in columns if not c.startswith("__index_level_") ]), 8
+
+    # Delimited text: the rows are counted and the columns are read from the first row
+    with open(file, "rb") as f:
+        N = sum([ 1 for line in f if line.strip() ])
+    if data_opts["colnames"] is not None: N -= 1
+    first = pd.read_csv(file, nrows=1, delimiter=data_opts["delimiter"], header=data_opts["colnames"], index_col=data_opts["rownames"])
+    return N, first.shape[1], 4
+
+def dataShapes(data_opts):
+    """ Method to read the dimensions of all views, transposing them if the columns are the shared axis (see loadData)
+
+    RETURNS
+    -------
+    N: int
+        number of samples
+    D: list
+        number of features of each view
+    itemsize: list
+        size in bytes of the values of each view
+    transposed: boolean
+        are the samples stored in the columns of the files?
+    """
+    shapes = [ viewShape(file, data_opts) for file in data_opts['input_files'] ]
+    transposed = len(set([ x[0] for x in shapes ])) != 1
+    if transposed:
+        assert len(set([ x[1] for x in shapes ])) == 1, "Dimensionalities do not match, make sure that either columns or rows are shared!"
+        return shapes[0][1], [ x[0] for x in shapes ], [ x[2] for x in shapes ], True
+    return shapes[0][0], [ x[1] for x in shapes ], [ x[2] for x in shapes ], False
+
+def readHead(file, m, n, data_opts, transposed=False):
+    """ Method to read the first n samples of a view. Only these samples are read from text, .npy and hdf5 files,
+    the other formats are read completely
+
+    PARAMETERS
+    ----------
+    file: str
+    m: int
+        index of the view
+    n: int
+        number of samples
+    data_opts: dic
+    transposed: boolean
+        are the samples stored in the columns of the file?
+    """
+    from .utils import readView
+
+    h5 = re.match(r"^(.*\.(?:h5|hdf5))(?::(.+))?$", file)
+    ext = os.path.splitext(file)[1].lower()
+    if h5 is None and ext not in [".npy", ".npz", ".parquet"]:
+        opts = { 'delimiter':data_opts["delimiter"], 'header':data_opts["colnames"], 'index_col':data_opts["rownames"] }
+        if transposed:
+            Y = pd.read_csv(file, usecols=range(n + (data_opts["rownames"] is not None)), **opts).values.T
+        else:
+            Y = pd.read_csv(file, nrows=n, **opts).values
+    elif h5 is not None:
+        with h5py.File(h5.group(1), "r") as f:
+            ds = f[h5.group(2) if h5.group(2) is not None else "data"]
+            Y = ds[:,:n].T if transposed else ds[:n]
+    else:
+        Y = readView(file, m, data_opts)[0]
+        Y = Y[:,:n].T if transposed else Y[:n]
+    return np.array(Y, dtype=Y.dtype if Y.dtype.kind == "f" else np.float32)
+
+def nodeCosts(N, D, K, likelihoods, covariates=0, elbofreq=1, dropR2=False, freqdrop=1, missing=True):
+    """ Method to calculate the operations per iteration and the temporary memory of each node update from the update formulas
+
+    The operations of the steps that do not run at every iteration (calculateELBO and removeInactiveFactors)
+    are averaged over the iterations. The linear predictor E[Z]E[SW]' (see SW_Node.getProduct) is computed once per
+    iteration and shared by the nodes of each view, so it is accounted for separately. The counts follow the current
+    implementation of the updates, and are checked against the measured time of each update by the microbenchmark
+    (see microbenchmark.KernelBenchmark.checkEstimates). The memory held by the nodes is calculated by heldMemory
+
+    PARAMETERS
+    ----------
+    N: int
+        number of samples
+    D: list
+        number of features of each view
+    K: int
+        number of factors, including the covariates and the intercept
+    likelihoods: list
+        likelihood of each view
+    covariates: int
+        number of covariates (including the intercept), which are not updated
+    elbofreq: int
+        frequency of the calculation of the ELBO
+    dropR2: boolean
+        are the inactive factors removed based on the variance explained?
+    freqdrop: int
+        frequency of the removal of inactive factors
+    missing: boolean
+        are there missing values? (the observed entries are then weighted, see Node.getPrecisionWeights)
+
+    RETURNS
+    -------
+    DataFrame with the node, the view (-1 for single-view nodes), the number of gemm, stream, transcendental and masked
+    operations per iteration and the bytes of the temporary arrays of the update
+    """
+    M = len(D)
+    L = K - covariates
+    w = int(missing)
+    rows = []
+    def add(node, m, gemm=0., stream=0., transcendental=0., masked=0., scratch=0., freq=1.):
+        rows.append((node, m, freq*gemm, freq*stream, freq*transcendental, freq*masked, scratch))
+
+    for m in range(M):
+        nd, DK = N*D[m], D[m]*K
+
+        if likelihoods[m] == "gaussian":
+            # term1 to term4 of Tau_Node.updateParameters: copies, masks, squares and column sums of (N,D) arrays, and the
+            # products E[Z]^2 E[SW]^2' and E[Z^2]E[(SW)^2]' written into the workspace
+            add("Tau", m, gemm=4*nd*K, stream=13*nd + 5*DK)
+        elif likelihoods[m] == "bernoulli":
+            # zeta (sqrt of the second moment of ZW, with the products written into the workspace) and pseudodata
+            # (three masked divisions, two of them in lambdafn)
+            add("Y", m, gemm=4*nd*K, stream=10*nd + 5*DK, transcendental=2*nd, masked=3*nd, scratch=4*nd*8)
+            # Tau_Jaakkola: 2*lambdafn(zeta)
+            add("Tau", m, stream=2*nd, transcendental=nd, masked=2*nd, scratch=2*nd*8)
+            add("ELBO", m, stream=4*nd, transcendental=2*nd, scratch=3*nd*8, freq=1./elbofreq)
+        elif likelihoods[m] == "poisson":
+            # copy of the linear predictor into zeta, the pseudodata uses the sigmoid, the rate function and two masked divisions
+            add("Y", m, stream=7*nd, transcendental=3*nd, masked=2*nd, scratch=4*nd*8)
+            add("ELBO", m, stream=4*nd, transcendental=3*nd, scratch=3*nd*8, freq=1./elbofreq)
+        else:
+            print("Likelihood %s not implemented for the estimates" % likelihoods[m])
+            exit()
+
+        # Linear predictor E[Z]E[SW]', cached for the pseudodata, Tau and the ELBO
+        add("products", m, gemm=2*nd*K, stream=DK)
+
+        # SW: the products of Y and ZZ with Z and, for each factor, a (N,K-1)x(K-1,D) product, the weights and the column sums
+        add("SW", m, gemm=2*nd*K*(K-1) + 2*nd*K + w*2*nd*K, stream=(2+2*w)*nd + (1+w)*nd*K, scratch=N*K*8 + 3*DK*8)
+
+        # Z: the product of the weights with E[SW^2] and, for each latent variable, a (N,K-1)x(K-1,D) product, the residuals,
+        # the weights and the product with E[SW]
+        add("Z", m, gemm=2*nd*L*(K-1) + w*2*nd*K, stream=(2+w)*nd + 6*DK + (2+w)*nd*L, scratch=3*DK*8)
+
+        # Nodes of dimensions (D,K), the expectations of SW are derived from its parameters (see SpikeSlabExpectations),
+        # and nodes of dimensions (K,), which are broadcast to (D,K) without copies
+        add("Theta", m, stream=4*K + DK, scratch=K*8)
+        add("AlphaW", m, stream=6*DK)
+        add("ELBO", m, stream=20*DK, scratch=2*DK*8, freq=1./elbofreq)
+
+        # Predictions after removing each factor (see BayesNet.calculateR2Terms)
+        if dropR2:
+            add("removeInactiveFactors", m, stream=(5*K+7)*nd, scratch=4*nd*8, freq=1./freqdrop)
+
+    # Latent variables: prior and variational parameters and expectations, and the sum of the precisions times E[SW^2]
+    add("Z", -1, stream=10*N*K, scratch=N*K*8)
+    add("ELBO", -1, stream=10*N*K, freq=1./elbofreq)
+
+    return pd.DataFrame(rows, columns=["node", "view", "gemm", "stream", "transcendental", "masked", "scratch"])
+
+def probeDimensions(M, covariates=0):
+    """ Method to choose the dimensions of the model of heldMemory: distinct primes (and a number of latent variables
+    that is larger than the number of covariates), so that every axis of its arrays can be attributed to the samples,
+    the features of a view, the factors or the latent variables
+
+    RETURNS
+    -------
+    number of samples, list with the number of features of each view and number of factors
+    """
+    primes = [ p for p in range(covariates+17, 10*(covariates+M+20)) if all([ p % q for q in range(2, int(p**0.5)+1) ]) ]
+    return primes[M+1], primes[1:M+1], primes[0]
+
+def heldMemory(N, D, K, likelihoods, covariates=0, itemsize=4, **options):
+    """ Method to calculate the memory held by each node during the training from the arrays of the same model
+    (see memory.memoryReport), trained for two iterations on random data of small dimensions (see probeDimensions).
+    The size of each array is scaled to the dimensions of the data by the axes of the samples, features and factors
+
+    PARAMETERS
+    ----------
+    N: int
+        number of samples
+    D: list
+        number of features of each view
+    K: int
+        number of factors, including the covariates and the intercept
+    likelihoods: list
+        likelihood of each view
+    covariates: int
+        number of covariates (including the intercept)
+    itemsize: int or list
+        size in bytes of the values of the data of each view
+    options:
+        other options of the model (see api.train)
+
+    RETURNS
+    -------
+    DataFrame with the node (the loaded data, the nodes of the model and the workspace), the view (-1 for single-view nodes)
+    and the bytes held after the updates
+    """
+    from .api import train
+    from .memory import memoryReport
+
+    M = len(D)
+    if np.isscalar(itemsize): itemsize = [itemsize]*M
+    N0, D0, K0 = probeDimensions(M, covariates)
+    scale = dict([ (N0,N), (K0,K), (K0-covariates,K-covariates) ] + list(zip(D0,D)))
+
+    # Random data of the dimensions of the probe with the type of the data of each view, with a missing value
+    # in each view so that the buffers of the weights of the observed entries are accounted for
+    rng = np.random.default_rng(0)
+    views = []
+    for m in range(M):
+        if likelihoods[m] == "bernoulli":
+            Y = rng.random((N0,D0[m])) > 0.5
+        elif likelihoods[m] == "poisson":
+            Y = rng.poisson(1., (N0,D0[m]))
+        else:
+            Y = rng.standard_normal((N0,D0[m]))
+        views.append(Y.astype(np.float32 if itemsize[m] == 4 else np.float64))
+        views[m][0,0] = np.nan
+    cov = rng.standard_normal((N0,covariates)) if covariates > 0 else None
+
+    options.update({ 'iter':2, 'nostop':True, 'elbofreq':1, 'dropR2':None, 'ntrials':1, 'factors':K0-covariates, 'learnIntercept':False })
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        model = train(views, likelihoods, covariates=cov, **options)
+    report = memoryReport(model.net)
+
+    rows = [ ("data", m, N*D[m]*itemsize[m]) for m in range(M) ]
+    for node, m, nbytes, shape in zip(report["node"], report["view"], report["bytes"], report["shape"]):
+        rows.append((node, m, nbytes*np.prod([ scale.get(x,x)/x for x in shape if x > 0 ])))
+    return pd.DataFrame(rows, columns=["node", "view", "held"])
+
+def machineRates(K=10, size=2048, repeats=3):
+    """ Method to measure the throughput of each kind of operation on this machine
+
+    PARAMETERS
+    ----------
+    K: int
+        number of factors, the gemm throughput is measured with products of the same inner dimension as the updates
+    size: int
+        dimension of the (size,size) arrays of the measurements
+    repeats: int
+        number of measurements, the fastest one is used
+
+    RETURNS
+    -------
+    dictionary with the operations per second of each kind of operation
+    """
+    rng = np.random.default_rng(0)
+    A, B = rng.standard_normal((size,max(K-1,1))), rng.standard_normal((max(K-1,1),size))
+    X, Y, out = rng.random((size,size)), rng.random((size,size)), np.empty((size,size))
+    MX, MY = ma.masked_invalid(X), ma.masked_invalid(Y)
+    def best(f):
+        times = []
+        for r in range(repeats):
+            t = time()
+            f()
+            times.append(time()-t)
+        return max(min(times), 1e-9)
+    return { 'gemm':2.*size*size*A.shape[1] / best(lambda: np.dot(A, B, out=out)),
+        'stream':size*size / best(lambda: np.multiply(X, Y, out=out)),
+        'transcendental':size*size / best(lambda: np.exp(X, out=out)),
+        'masked':size*size / best(lambda: MX / MY) }
+
+def predictTime(costs, rates):
+    """ Method to convert the operations of each row of nodeCosts into seconds per iteration """
+    return sum([ costs[k]/rates[k] for k in ["gemm", "stream", "transcendental", "masked"] ])
+
+def calibrate(views, likelihoods, rates, iterations=5, covariates=None, **options):
+    """ Method to train a model for a few iterations on a subsample of the data and to compare the time per iteration
+    with the prediction. Inactive factors are not dropped, so that the number of factors is constant
+
+    PARAMETERS
+    ----------
+    views: list
+        list of ndarrays with the data of each view (i.e. a subsample of the samples)
+    likelihoods: list
+        likelihood of each view
+    rates: dic
+        throughput of each kind of operation (see machineRates)
+    iterations: int
+        number of iterations (the first one is not timed)
+    covariates: ndarray
+        matrix of covariates with dimensions (samples,covariates)
+    options:
+        other options of the model (see api.train)
+
+    RETURNS
+    -------
+    ratio of the measured and the predicted time per iteration, and the measured time per iteration
+    """
+    from .api import train
+
+    options.update({ 'iter':iterations, 'nostop':True, 'elbofreq':1, 'dropR2':None, 'ntrials':1 })
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        model = train(views, likelihoods, covariates=covariates, **options)
+    iter_time = model.stats["time"][1:]
+    measured = float(np.median(iter_time[~np.isnan(iter_time)]))
+
+    C = (0 if covariates is None else np.asarray(covariates).reshape(views[0].shape[0],-1).shape[1]) + int(options.get("learnIntercept", False))
+    costs = nodeCosts(views[0].shape[0], [ Y.shape[1] for Y in views ], options.get("factors", 10) + C, likelihoods, covariates=C)
+    return measured / predictTime(costs, rates).sum(), measured
+
+def formatTime(t):
+    """ Method to format a number of seconds """
+    if t < 60: return "%.2fs" % t
+    if t < 3600: return "%.1fmin" % (t/60.)
+    return "%.1fh" % (t/3600.)
+
+def baselineMemory():
+    """ Method to return the peak resident memory of the current process (interpreter and libraries) in bytes """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss*1024
+
+def dryRun(args, data_opts, calibration_iterations=5):
+    """ Method to print the estimate of the time and the memory of the training defined by the command line options
+
+    PARAMETERS
+    ----------
+    args: argparse.Namespace
+        command line options (see init_asd.getParser), args.calibrate is the number of samples of the calibration
+    data_opts: dic
+    calibration_iterations: int
+        number of iterations of training of the calibration
+    """
+    from .init_asd import setCovariates
+
+    baseline = baselineMemory()
+    N, D, itemsize, transposed = dataShapes(data_opts)
+    factors = args.factors
+    setCovariates(args, data_opts, N)
+    K = args.factors
+    C = 0 if data_opts['covariates'] is None else data_opts['covariates'].shape[1]
+
+    print("\nDry run: %d samples, %s features, %d factors (%d covariates)\n" % (N, ", ".join([ str(d) for d in D ]), K, C))
+
+    costs = nodeCosts(N, D, K, args.likelihoods, covariates=C, elbofreq=args.elbofreq, dropR2=args.dropR2 is not None, freqdrop=args.freqDrop)
+    options = dict([ (k, getattr(args,k)) for k in CALIBRATION_OPTIONS ])
+    held = heldMemory(N, D, K, args.likelihoods, covariates=C, itemsize=itemsize, **options)
+    rates = machineRates(K)
+    print("Throughput: gemm=%.2f GFLOP/s, stream=%.2f Gelem/s, transcendental=%.2f Gelem/s, masked=%.2f Gelem/s" %
+        (rates['gemm']/1e9, rates['stream']/1e9, rates['transcendental']/1e9, rates['masked']/1e9))
+
+    # Calibration on the first samples
+    factor = 1.
+    if args.calibrate is not None:
+        n = min(args.calibrate, N)
+        views = [ readHead(file, m, n, data_opts, transposed) for m, file in enumerate(data_opts['input_files']) ]
+        options['factors'] = factors
+        covariates = data_opts['covariates'][:n,(1 if args.learnIntercept else 0):] if C > int(args.learnIntercept) else None
+        factor, measured = calibrate(views, args.likelihoods, rates, iterations=calibration_iterations, covariates=covariates, **options)
+        print("Calibration: %.3fs per iteration on %d samples, %.2f times the prediction" % (measured, n, factor))
+
+    # Time and memory of each node
+    costs["time"] = factor * predictTime(costs, rates)
+    table = costs.groupby("node", sort=False)[["gemm","stream","transcendental","masked","time","scratch"]].agg(
+        { 'gemm':"sum", 'stream':"sum", 'transcendental':"sum", 'masked':"sum", 'time':"sum", 'scratch':"max" })
+    nodes = list(table.index) + [ x for x in held["node"].unique() if x not in table.index ]
+    table = table.reindex(nodes, fill_value=0)
+    table["held"] = held.groupby("node")["held"].sum().reindex(nodes, fill_value=0)
+    lines = [ "\n%-22s %12s %12s %12s %12s" % ("Node", "GFLOP/iter", "Time/iter", "Held", "Temporary") ]
+    for node, row in table.sort_values("time", ascending=False).iterrows():
+        lines.append("%-22s %12.2f %12s %12s %12s" % (node, (row["gemm"]+row["stream"]+row["transcendental"]+row["masked"])/1e9,
+            formatTime(row["time"]), formatBytes(row["held"]), formatBytes(row["scratch"])))
+    print("\n".join(lines))
+
+    # Totals: all the iterations of all the trials (the training stops earlier if it converges)
+    per_iteration = costs["time"].sum()
+    held, scratch = held["held"].sum(), costs["scratch"].max()
+    print("\nExpected time per iteration: %s" % formatTime(per_iteration))
+    print("Expected wall time: %s for %d iterations and %d trial(s) (at most, the training stops when it converges)" %
+        (formatTime(per_iteration*args.iter*args.ntrials), args.iter, args.ntrials))
+    print("Expected peak memory (RSS): %s (interpreter %s, model %s, temporary arrays %s)\n" %
+        (formatBytes(baseline+held+scratch), formatBytes(baseline), formatBytes(held), formatBytes(scratch)))
+    return costs
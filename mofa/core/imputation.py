@@ -0,0 +1,183 @@
+"""
+Module to reconstruct and impute the data of a saved model, working in blocks of samples and features
+so that the full matrices are never in memory
+
+predictView: predict (a selection of) a view from the factors and the weights
+imputeView: replace the missing values of (a selection of) a view by their predictions
+
+The results can be written to a numpy array (default), to a memory-mapped .npy file or to an hdf5 dataset.
+
+Example:
+    import mofa
+    from mofa.core.imputation import imputeView
+    model = mofa.load("model.hdf5")
+    imputeView(model, "mRNA", out="imputed.h5:/mRNA")
+"""
+
+from __future__ import division
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import re
+import threading
+import numpy as np
+import h5py
+
+from .reader import ModelFile
+
+def selectIndex(selection, names):
+    """ Method to convert a selection of samples, features or factors into positions
+
+    PARAMETERS
+    ----------
+    selection: None (all), list of names, list of positions or boolean mask
+    names: list
+        names of all the elements
+    """
+    if selection is None:
+        return np.arange(len(names))
+    selection = np.asarray(selection)
+    if selection.dtype == bool:
+        assert len(selection) == len(names), "Boolean selection does not match the number of elements"
+        return np.where(selection)[0]
+    if selection.dtype.kind in "iu":
+        return selection.astype(int)
+    positions = { n:i for i,n in enumerate(names) }
+    missing = [ str(x) for x in selection if str(x) not in positions ]
+    assert len(missing) == 0, "Elements not found: %s" % ", ".join(missing[:10])
+    return np.array([ positions[str(x)] for x in selection ], dtype=int)
+
+def inverseLink(X, likelihood, type="inRange"):
+    """ Method to transform the linear predictions into the scale of the data (in place)
+
+    PARAMETERS
+    ----------
+    X: ndarray
+        linear predictions (Z*W')
+    likelihood: str
+        gaussian, bernoulli or poisson
+    type: str
+        'link' (linear predictions), 'response' (expected values) or 'inRange' (expected values rounded to the range of the data)
+    """
+    if type == "link" or likelihood == "gaussian":
+        return X
+    if likelihood == "bernoulli":
+        np.negative(X, out=X)
+        np.exp(X, out=X)
+        X += 1.
+        np.reciprocal(X, out=X)
+    elif likelihood == "poisson":
+        # Same rate function as in the model (see Poisson_PseudoY_Node)
+        np.logaddexp(0., X, out=X)
+    else:
+        print("Likelihood %s not implemented for imputation" % likelihood)
+        exit()
+    if type == "inRange":
+        np.round(X, out=X)
+    return X
+
+def openOutput(out, shape, dtype):
+    """ Method to create the output matrix
+
+    PARAMETERS
+    ----------
+    out: None (new array), ndarray, h5py dataset, path of a .npy file (memory-mapped) or path of an hdf5 dataset ('file.h5:/dataset')
+    shape: tuple
+    dtype: numpy dtype
+
+    RETURNS
+    -------
+    the output matrix and the hdf5 file that contains it (or None)
+    """
+    if out is None:
+        return np.empty(shape, dtype=dtype), None
+    if not isinstance(out, str):
+        assert tuple(out.shape) == tuple(shape), "The output has shape %s instead of %s" % (out.shape, shape)
+        return out, None
+    if out.endswith(".npy"):
+        return np.lib.format.open_memmap(out, mode="w+", dtype=dtype, shape=shape), None
+    h5 = re.match(r"^(.*\.(?:h5|hdf5))(?::(.+))?$", out)
+    assert h5 is not None, "The output has to be a .npy file or an hdf5 file (file.h5:/dataset)"
+    f = h5py.File(h5.group(1), "a")
+    dataset = h5.group(2) if h5.group(2) is not None else "data"
+    if dataset in f: del f[dataset]
+    chunks = (min(shape[0],256), min(shape[1],1024)) if 0 not in shape else None
+    return f.create_dataset(dataset, shape=shape, dtype=dtype, chunks=chunks), f
+
+def reconstructView(model, view, samples=None, features=None, factors=None, type="inRange", impute=False,
+    out=None, dtype=np.float32, block=(2048,2048), threads=None):
+    """ Method to predict or impute a view of a saved model, in blocks of samples and features
+
+    PARAMETERS
+    ----------
+    model: ModelFile or path of a saved model
+    view: str
+        name of the view
+    samples: list
+        samples to predict (names, positions or boolean mask), all by default
+    features: list
+        features to predict (names, positions or boolean mask), all by default
+    factors: list
+        factors used in the predictions (positions or boolean mask), all by default (including the intercept)
+    type: str
+        'link', 'response' or 'inRange' (see inverseLink)
+    impute: boolean
+        keep the observed values and only predict the missing ones?
+    out: output matrix (see openOutput)
+    dtype: numpy dtype
+        type of the output
+    block: tuple
+        number of samples and features of each block
+    threads: int
+        number of blocks to calculate at the same time (by default the number of cores)
+
+    RETURNS
+    -------
+    matrix with dimensions (samples,features)
+    """
+    if isinstance(model, str): model = ModelFile(model)
+    assert view in model.views, "View %s not found" % view
+    assert type in ["link","response","inRange"], "type has to be 'link', 'response' or 'inRange'"
+
+    samples = selectIndex(samples, model.samples)
+    features = selectIndex(features, model.features[view])
+    factors = selectIndex(factors, model.factors)
+    likelihood = model.likelihoods[view]
+
+    # The factors and the weights are small compared to the data, they are read once
+    Z = np.nan_to_num(np.asarray(model.Z[:,factors], dtype=np.float64)[samples])
+    W = np.nan_to_num(np.asarray(model.W[view][:,factors], dtype=np.float64)[features])
+    Y = model.data[view] if impute else None
+
+    result, handle = openOutput(out, (len(samples),len(features)), dtype)
+    lock = threading.Lock()
+
+    def run(ij):
+        i, j = ij
+        rows, cols = samples[i:i+block[0]], features[j:j+block[1]]
+        X = np.dot(Z[i:i+block[0]], W[j:j+block[1]].T)
+        inverseLink(X, likelihood, type)
+        if impute:
+            obs = Y.read((rows,cols), cache=False)
+            X = np.where(np.isnan(obs), X, obs)
+        if isinstance(result, np.ndarray):
+            result[i:i+block[0], j:j+block[1]] = X
+        else:
+            with lock:
+                result[i:i+block[0], j:j+block[1]] = X
+
+    blocks = [ (i,j) for i in range(0,len(samples),block[0]) for j in range(0,len(features),block[1]) ]
+    pool = ThreadPool(threads if threads is not None else cpu_count())
+    pool.map(run, blocks, chunksize=1)
+    pool.close()
+
+    if isinstance(result, np.memmap): result.flush()
+    if handle is not None: handle.flush()
+    return result
+
+def predictView(model, view, samples=None, features=None, factors=None, type="inRange", out=None, **kwargs):
+    """ Method to predict a view from the factors and the weights (see reconstructView) """
+    return reconstructView(model, view, samples=samples, features=features, factors=factors, type=type, impute=False, out=out, **kwargs)
+
+def imputeView(model, view, samples=None, features=None, factors=None, type="inRange", out=None, **kwargs):
+    """ Method to impute the missing values of a view, the observed values are kept (see reconstructView) """
+    return reconstructView(model, view, samples=samples, features=features, factors=factors, type=type, impute=True, out=out, **kwargs)
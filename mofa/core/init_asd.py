@@ -4,29 +4,26 @@ import scipy as s
 from time import sleep
 
 from .build_model import *
+from .cache import DataCache
+from .estimate import dryRun
 
-def entry_point():
-
-  banner = """
-  ###########################################################
-  ###                 __  __  ___  _____ _                ### 
-  ###                |  \/  |/ _ \|  ___/ \               ### 
-  ###                | |\/| | | | | |_ / _ \              ### 
-  ###                | |  | | |_| |  _/ ___ \             ### 
-  ###                |_|  |_|\___/|_|/_/   \_\            ### 
-  ###                                                     ###
-  ########################################################### """
-
-  print(banner)
-  sleep(2)
+def getParser():
+  """ Method to define the command line options, which are also the options of the python API (see api.py) """
 
-  # Read arguments
   p = argparse.ArgumentParser( description='Run script for MOFA' )
 
   # I/O
-  p.add_argument( '--inFiles',           type=str, nargs='+', required=True,                  help='Input data files (including extension)' )
+  p.add_argument( '--inFiles',           type=str, nargs='+', required=True,                  help='Input data files (including extension): delimited text, .npy, .npz, HDF5 (file.h5 or file.h5:/dataset) or .parquet' )
   p.add_argument( '--outFile',           type=str, required=True,                             help='Output data file (hdf5 format)' )
   p.add_argument( '--delimiter',         type=str, default=" ",                               help='Delimiter for input files' )
+  p.add_argument( '--loadThreads',       type=int, default=None,                              help='Number of views to load in parallel (default: one per view, up to the number of cores)' )
+  p.add_argument( '--mmapDir',           type=str, default=None,                              help='Directory to store the parsed data as memory-mapped files (default: in memory)' )
+  p.add_argument( '--cacheDir',          type=str, default=None,                              help='Directory of the cache of parsed data, to skip parsing the same input files in later runs (default: no cache)' )
+  p.add_argument( '--cacheSize',         type=float, default=10.,                             help='Maximum size of the cache of parsed data in GB' )
+  p.add_argument( '--saveCompression',   type=str, default=None, choices=['gzip','lzf'],      help='Compression of the output file (lzf is faster, but it can only be read with h5py)' )
+  p.add_argument( '--saveFloat32',       action='store_true',                                 help='Save the output in single precision?' )
+  p.add_argument( '--dataFile',          type=str, default=None,                              help='HDF5 file to store the training data once and link it from the output files, instead of copying it in each of them' )
+  p.add_argument( '--saveR2PerFeature',  action='store_true',                                 help='Save the variance explained by the factors in each feature?' )
   p.add_argument( '--covariatesFile',    type=str, default=None,                               help='Input data file for covariates' )
   p.add_argument( '--header_cols',       action='store_true',                                 help='Do the input files contain column names?' )
   p.add_argument( '--header_rows',       action='store_true',                                 help='Do the input files contain row names?' )
@@ -49,6 +46,7 @@ def entry_point():
   p.add_argument( '--learnTheta',        type=int, nargs="+", default=1,                      help='Learn the sparsity parameter from the spike-and-slab (theta)?' )
   p.add_argument( '--initTheta',         type=float, nargs="+", default=1. ,                  help='Initialisation for the sparsity parameter of the spike-and-slab (theta)')
   p.add_argument( '--learnIntercept',    action='store_true',                                 help='Learn the feature-wise mean?' )
+  p.add_argument( '--initZ',             type=str, default="random", choices=['random','orthogonal','pca'], help='Initialisation of the latent variables: random, orthogonal or pca (principal components of the concatenated views, which also initialise the weights)' )
 
   # Training options
   p.add_argument( '--elbofreq',          type=int, default=1,                                 help='Frequency of computation of ELBO' )
@@ -59,12 +57,31 @@ def entry_point():
   p.add_argument( '--startDrop',         type=int, default=1 ,                                help='First iteration to start dropping factors')
   p.add_argument( '--freqDrop',          type=int, default=1 ,                                help='Frequency for dropping factors')
   p.add_argument( '--dropR2',            type=float, default=None ,                           help='Threshold to drop latent variables based on coefficient of determination' )
+  p.add_argument( '--compactDrop',       type=float, default=0.25 ,                           help='Fraction of dropped factors above which they are removed from memory (until then they are only switched off)' )
   p.add_argument( '--nostop',            action='store_true',                                 help='Do not stop when convergence criterion is met' )
   p.add_argument( '--verbose',           action='store_true',                                 help='Use more detailed log messages?')
+  p.add_argument( '--profile',           action='store_true',                                 help='Profile the training with a sampling profiler? (the profile is written next to the output file)')
+  p.add_argument( '--profileIterations', type=int, nargs=2, default=None,                     help='First iteration and end of the window of iterations to profile (default: all)')
+  p.add_argument( '--profileInterval',   type=float, default=5.,                              help='Time between samples of the profiler in milliseconds')
+  p.add_argument( '--traceMemory',       action='store_true',                                 help='Trace the peak memory allocated by the update of each node (slower)?')
   p.add_argument( '--seed',              type=int, default=0 ,                                help='Random seed' )
+  p.add_argument( '--dryRun',            action='store_true',                                 help='Estimate the time and the memory of the training from the dimensions of the input files, without loading the data or training the model')
+  p.add_argument( '--calibrate',         type=int, default=None,                              help='Calibrate the estimate of --dryRun by training a few iterations on this number of samples')
+
+  # Parallel training options
+  p.add_argument( '--nworkers',          type=int, default=1,                                 help='Number of local worker processes to shard the features over' )
+  p.add_argument( '--workers',           type=str, nargs='+', default=None,                   help='Addresses (host:port) of remote workers started with mofa-worker' )
+  p.add_argument( '--authkey',           type=str, default=None,                              help='Authentication key of the remote workers' )
 
+  return p
 
-  args = p.parse_args()
+def getDataOpts(args):
+  """ Method to define the data options
+
+  PARAMETERS
+  ----------
+  args: argparse.Namespace
+  """
 
   #############################
   ## Define the data options ##
@@ -135,28 +152,37 @@ def entry_point():
   # Remove incomplete samples?
   data_opts['RemoveIncompleteSamples'] = args.RemoveIncompleteSamples
 
-  ###############
-  ## Load data ##
-  ###############
+  # Store the parsed data in memory-mapped files?
+  data_opts['mmap_dir'] = args.mmapDir
 
-  # Load observations
-  data = loadData(data_opts)
+  # Storage of the output
+  data_opts['storage'] = { 'compression':args.saveCompression, 'float32':args.saveFloat32, 'data_file':args.dataFile, 'r2_per_feature':args.saveR2PerFeature }
 
-  # Remove samples with missing views
-  if data_opts['RemoveIncompleteSamples']:
-    data = removeIncompleteSamples(data)
+  return data_opts
 
-  # Calculate dimensionalities
-  N = data[0].shape[0]
-  D = [data[m].shape[1] for m in range(M)]
+def setCovariates(args, data_opts, N, covariates=None):
+  """ Method to define the covariates (including the constant covariate of the intercept),
+  increasing the number of factors accordingly
+
+  PARAMETERS
+  ----------
+  args: argparse.Namespace
+  data_opts: dic
+  N: int
+      number of samples
+  covariates: ndarray
+      matrix of covariates with dimensions (samples,covariates), by default they are read from args.covariatesFile
+  """
 
   # Load covariates
-  if args.covariatesFile is not None:
-    data_opts['covariates'] = pd.read_csv(args.covariatesFile, delimiter=" ", header=None).as_matrix()
-    print("Loaded covariates from " + args.covariatesFile + "with shape " + str(data_opts['covariates'].shape) + "...")
-    data_opts['scale_covariates'] = args.scale_covariates
+  if covariates is None and args.covariatesFile is not None:
+    covariates = pd.read_csv(args.covariatesFile, delimiter=" ", header=None).as_matrix()
+    print("Loaded covariates from " + args.covariatesFile + "with shape " + str(covariates.shape) + "...")
+  if covariates is not None:
+    data_opts['covariates'] = s.asarray(covariates, dtype=float).reshape(N,-1)
+    data_opts['scale_covariates'] = args.scale_covariates if type(args.scale_covariates)==list else [args.scale_covariates]
     if len(data_opts['scale_covariates']) == 1 and data_opts['covariates'].shape[1] > 1:
-      data_opts['scale_covariates'] = args.scale_covariates[0] * s.ones(data_opts['covariates'].shape[1])
+      data_opts['scale_covariates'] = data_opts['scale_covariates'][0] * s.ones(data_opts['covariates'].shape[1])
     elif type(data_opts['scale_covariates'])==list:
       assert len(data_opts['scale_covariates']) == data_opts['covariates'].shape[1], "'scale_covariates' has to be the same length as the number of covariates"
     data_opts['scale_covariates'] = [ bool(x) for x in data_opts['scale_covariates'] ]
@@ -176,10 +202,25 @@ def entry_point():
       data_opts['scale_covariates'] = [False]
     args.factors += 1
 
+def getModelOpts(args, data, data_opts):
+  """ Method to define the model options, priors and initialisations
+
+  PARAMETERS
+  ----------
+  args: argparse.Namespace
+  data: list
+      list of DataFrames with the data of each view
+  data_opts: dic
+  """
+
   ##############################
   ## Define the model options ##
   ##############################
 
+  M = len(data)
+  N = data[0].shape[0]
+  D = [data[m].shape[1] for m in range(M)]
+
   model_opts = {}
 
   # Define initial number of latent factors
@@ -241,7 +282,7 @@ def entry_point():
   ##############################################
 
   # Latent variables
-  model_opts["initZ"] = { 'mean':"random", 'var':s.ones((K,)), 'E':None, 'E2':None }
+  model_opts["initZ"] = { 'mean':args.initZ, 'var':s.ones((K,)), 'E':None, 'E2':None }
 
   # Tau
   model_opts["initTau"] = { 'a':[s.nan]*M, 'b':[s.nan]*M, 'E':[s.ones(D[m])*100 for m in range(M)] }
@@ -319,6 +360,15 @@ def entry_point():
       model_opts["initTheta"]["b"][m][0] = s.nan
       model_opts["initTheta"]["E"][m][:,0] = 1.
 
+  return model_opts
+
+def getTrainOpts(args):
+  """ Method to define the training options
+
+  PARAMETERS
+  ----------
+  args: argparse.Namespace
+  """
 
   #################################
   ## Define the training options ##
@@ -335,10 +385,21 @@ def entry_point():
   # Verbosity
   train_opts['verbose'] = args.verbose
 
+  # Trace the memory allocated by the updates
+  train_opts['trace_memory'] = args.traceMemory
+
+  # Sampling profiler
+  if args.profile:
+    window = args.profileIterations if args.profileIterations is not None else (0,None)
+    train_opts['profile'] = { 'start':window[0], 'end':window[1], 'interval':args.profileInterval/1000. }
+  else:
+    train_opts['profile'] = None
+
   # Criteria to drop latent variables while training
   train_opts['drop'] = { "by_norm":None, "by_pvar":None, "by_cor":None, "by_r2":args.dropR2 }
   train_opts['startdrop'] = args.startDrop
   train_opts['freqdrop'] = args.freqDrop
+  train_opts['compactdrop'] = args.compactDrop
 
   # Tolerance level for convergence
   train_opts['tolerance'] = args.tolerance
@@ -352,6 +413,71 @@ def entry_point():
   # Number of trials
   train_opts['trials'] = args.ntrials
 
+  # Workers to shard the features over
+  train_opts['nworkers'] = args.nworkers
+  train_opts['workers'] = args.workers
+  train_opts['authkey'] = args.authkey
+  if args.workers is not None:
+    assert args.authkey is not None, "Please specify the authentication key of the remote workers with --authkey"
+
+  return train_opts
+
+def entry_point():
+
+  banner = """
+  ###########################################################
+  ###                 __  __  ___  _____ _                ### 
+  ###                |  \/  |/ _ \|  ___/ \               ### 
+  ###                | |\/| | | | | |_ / _ \              ### 
+  ###                | |  | | |_| |  _/ ___ \             ### 
+  ###                |_|  |_|\___/|_|/_/   \_\            ### 
+  ###                                                     ###
+  ########################################################### """
+
+  print(banner)
+  sleep(2)
+
+  # Read arguments
+  args = getParser().parse_args()
+
+  # Define the data options
+  data_opts = getDataOpts(args)
+
+  # Estimate the time and the memory of the training without loading the data
+  if args.dryRun:
+    dryRun(args, data_opts)
+    return
+
+  ###############
+  ## Load data ##
+  ###############
+
+  # Load observations from the cache
+  data = None
+  if args.cacheDir is not None:
+    cache = DataCache(args.cacheDir, max_size=args.cacheSize*2**30)
+    key = cache.key(data_opts)
+    data = cache.load(key)
+    if data is not None: print("Loaded the parsed data from the cache (%s)..." % key)
+
+  if data is None:
+    # Load observations
+    data = loadData(data_opts, threads=args.loadThreads)
+
+    # Remove samples with missing views
+    if data_opts['RemoveIncompleteSamples']:
+      data = removeIncompleteSamples(data)
+
+    # Store the parsed data in the cache
+    if args.cacheDir is not None:
+      cache.store(key, data)
+
+  # Define the covariates
+  setCovariates(args, data_opts, data[0].shape[0])
+
+  # Define the model and training options
+  model_opts = getModelOpts(args, data, data_opts)
+  train_opts = getTrainOpts(args)
 
   #####################
   ## Train the model ##
@@ -363,3 +489,7 @@ def entry_point():
   # Go!
   # runSingleTrial(data, data_opts, model_opts, train_opts, seed=None)
   runMultipleTrials(data, data_opts, model_opts, train_opts, keep_best_run, args.seed)
+
+  # Remove the memory-mapped copies of the data
+  if data_opts['mmap_dir'] is not None:
+    removeViews(data_opts['mmap_dir'])
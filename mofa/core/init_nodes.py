@@ -3,6 +3,7 @@
 Module to initalise the nodes
 
 Z: the latent variables can be initialised either randomly, orthogonal or with the PCA solution
+    (see pcaInitialisation, which also initialises the weights of SW in buildNodes)
     MuZ:
 
 SW:
@@ -16,18 +17,124 @@ Theta:
     ThetaConst
     ThetaLearn
     ThetaMixed
+
+buildNodes: initialise all the nodes from the model options and connect their markov blankets
 """
 
+import numpy as np
 import scipy as s
 import scipy.stats as stats
 from sys import path
 import sklearn.decomposition
+from sklearn.utils.extmath import randomized_svd
 
 from .nodes import *
 from .multiview_nodes import *
 from .nongaussian_nodes import *
 from .updates import *
-
+from .utils import Workspace
+
+
+def pcaInitialisation(data, K, likelihoods=None, iterations=10, tolerance=1e-3, seed=None):
+    """ Method to calculate the leading principal components of the concatenated views, with missing values
+
+    The non-gaussian views are fitted through pseudodata, so they are first transformed to the scale of the linear
+    predictor: binary data to the pseudodata of the Jaakkola bound at a zero predictor (4y-2) and counts to log(1+y).
+    The features are centered and each view is scaled to unit total variance, so that all the views have the same
+    weight. The components are calculated with randomized SVD, and the missing values are imputed iteratively
+    with the low-rank reconstruction (starting from the mean) until the imputed values change less than the tolerance.
+
+    PARAMETERS
+    ----------
+    data: list
+        list of ndarrays or DataFrames with the data of each view, with dimensions (samples,features) and missing values as nan
+    K: int
+        number of components
+    likelihoods: list
+        likelihood of each view (by default all the views are gaussian)
+    iterations: int
+        maximum number of iterations of the imputation
+    tolerance: float
+        relative change of the imputed values to stop the imputation
+    seed: int
+
+    RETURNS
+    -------
+    Z: ndarray with the components, with dimensions (samples,K) and unit variance
+    W: list with the weights of each view, with dimensions (features,K), such that Z.dot(W[m].T) approximates the centered
+        (and transformed) view
+    """
+    N = data[0].shape[0]
+    D = [ Y.shape[1] for Y in data ]
+    offsets = np.cumsum([0]+D)
+
+    # Concatenate the centered and scaled views
+    X = np.empty((N,offsets[-1]))
+    scale = np.ones(len(data))
+    rows, cols = [], []
+    for m in range(len(data)):
+        Xm = X[:,offsets[m]:offsets[m+1]]
+        Xm[:] = np.asarray(data[m], dtype=np.float64)
+        if likelihoods is not None and likelihoods[m] == "bernoulli":
+            Xm *= 4.
+            Xm -= 2.
+        elif likelihoods is not None and likelihoods[m] == "poisson":
+            np.log1p(Xm, out=Xm)
+        with np.errstate(invalid="ignore"):
+            Xm -= np.nanmean(Xm, axis=0)
+        missing = np.isnan(Xm)
+        Xm[missing] = 0.
+        scale[m] = np.sqrt(np.square(Xm).sum() / max(1, N*D[m] - missing.sum()) * D[m])
+        if scale[m] > 0: Xm /= scale[m]
+        r, c = np.where(missing)
+        rows.append(r)
+        cols.append(c + offsets[m])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+
+    # Randomized SVD, imputing the missing values with the low-rank reconstruction
+    K = min(K, N, offsets[-1])
+    for i in range(iterations):
+        U, S, Vt = randomized_svd(X, K, random_state=seed)
+        if len(rows) == 0: break
+        imputed = (U[rows]*S * Vt.T[cols]).sum(axis=1)
+        delta = np.linalg.norm(imputed - X[rows,cols]) / max(np.linalg.norm(imputed), 1e-12)
+        X[rows,cols] = imputed
+        if delta < tolerance: break
+
+    # Components with unit variance and the weights of each view in the scale of the data
+    Z = U * np.sqrt(N)
+    W = Vt.T * S / np.sqrt(N)
+    return Z, [ W[offsets[m]:offsets[m+1]] * scale[m] for m in range(len(data)) ]
+
+def pcaModelOpts(data, data_opts, model_opts, seed=None):
+    """ Method to replace the PCA initialisation of the model options by the principal components (see pcaInitialisation):
+    the latent variables after the covariates are initialised with the components and the weights of SW with their loadings
+
+    PARAMETERS
+    ----------
+    data: list
+        observed data, one matrix per view with dimensions (N,D[m])
+    data_opts: dict
+    model_opts: dict
+        model options, they are not modified
+    seed: int
+
+    RETURNS
+    -------
+    a copy of the model options with the initialisations of Z and SW
+    """
+    N, K = data[0].shape[0], model_opts['k']
+    C = data_opts['covariates'].shape[1] if data_opts.get('covariates') is not None else 0
+    Z, W = pcaInitialisation(data, K-C, likelihoods=model_opts['likelihood'], seed=seed)
+
+    opts = dict(model_opts)
+    opts["initZ"], opts["initSW"] = dict(model_opts["initZ"]), dict(model_opts["initSW"])
+    opts["initZ"]["mean"] = s.zeros((N,K))
+    opts["initZ"]["mean"][:,C:C+Z.shape[1]] = Z
+    opts["initSW"]["mean_S1"] = [ s.array(x, dtype=float) for x in model_opts["initSW"]["mean_S1"] ]
+    for m in range(len(data)):
+        opts["initSW"]["mean_S1"][m][:,C:C+Z.shape[1]] = W[m]
+    return opts
 
 class initModel(object):
     def __init__(self, dim, data, lik, seed=None):
@@ -75,15 +182,11 @@ class initModel(object):
                 if qmean == "random": # Random initialisation of latent variables
                     qmean = stats.norm.rvs(loc=0, scale=1, size=(self.N,self.K))
 
-                elif qmean == "orthogonal": # Latent variables are initialised randomly but ensuring orthogonality
-                    pca = sklearn.decomposition.PCA(n_components=self.K, copy=True, whiten=True)
-                    pca.fit(stats.norm.rvs(loc=0, scale=1, size=(self.N,9999)).T)
-                    qmean = pca.components_.T
+                elif qmean == "orthogonal": # Latent variables are initialised randomly but ensuring orthogonality (orthonormal columns)
+                    qmean = np.linalg.qr(stats.norm.rvs(loc=0, scale=1, size=(self.N,self.K)))[0]
 
-                elif qmean == "pca": # Latent variables are initialised from PCA in the concatenated matrix
-                    pca = sklearn.decomposition.PCA(n_components=self.K, copy=True, whiten=True)
-                    pca.fit(s.concatenate(self.data,axis=0).T)
-                    qmean = pca.components_.T
+                elif qmean == "pca": # Latent variables are initialised from PCA in the concatenated matrix (see pcaInitialisation)
+                    qmean = pcaInitialisation(self.data, self.K, likelihoods=self.lik, seed=s.random.randint(2**31-1))[0]
 
             elif isinstance(qmean,s.ndarray):
                 assert qmean.shape == (self.N,self.K)
@@ -208,7 +311,7 @@ class initModel(object):
         tau_list = [None]*self.M
         for m in range(self.M):
             if self.lik[m] == "poisson":
-                tmp = 0.25 + 0.17*s.amax(self.data[m],axis=0)
+                tmp = 0.25 + 0.17*s.nanmax(self.data[m],axis=0)
                 tau_list[m] = Constant_Node(dim=(self.D[m],), value=tmp)
             elif self.lik[m] == "bernoulli":
                 # tmp = s.ones(self.D[m])*0.25
@@ -216,7 +319,7 @@ class initModel(object):
                 # tau_list[m] = Tau_Jaakkola(dim=(self.D[m],), value=0.25)
                 tau_list[m] = Tau_Jaakkola(dim=((self.N,self.D[m])), value=1.)
             elif self.lik[m] == "binomial":
-                tmp = 0.25*s.amax(self.data["tot"][m],axis=0)
+                tmp = 0.25*s.nanmax(self.data["tot"][m],axis=0)
                 tau_list[m] = Constant_Node(dim=(self.D[m],), value=tmp)
             elif self.lik[m] == "gaussian":
                 tau_list[m] = Tau_Node(dim=(self.D[m],), pa=pa[m], pb=pb[m], qa=qa[m], qb=qb[m], qE=qE[m])
@@ -307,3 +410,80 @@ class initModel(object):
 
     def getNodes(self):
         return { k:v for (k,v) in self.nodes.items()}
+
+def buildNodes(dim, data, data_opts, model_opts, seed=None):
+    """Method to define and initialise the nodes of a MOFA model and connect their markov blankets
+
+    PARAMETERS
+    ----------
+    dim: dict
+        keyworded dimensionalities (N, M, D and K)
+    data: list
+        observed data, one matrix per view with dimensions (N,D[m])
+    data_opts: dict
+        data options, only the covariates are used here
+    model_opts: dict
+        model options with the priors and initialisations of the nodes
+    seed: int
+        random seed
+    """
+
+    init = initModel(dim, data, model_opts["likelihood"], seed=seed)
+
+    # Latent variables
+    init.initZ(pmean=model_opts["priorZ"]["mean"], pvar=model_opts["priorZ"]["var"],
+               qmean=model_opts["initZ"]["mean"], qvar=model_opts["initZ"]["var"], qE=model_opts["initZ"]["E"], qE2=model_opts["initZ"]["E2"],
+               covariates=data_opts['covariates'], scale_covariates=data_opts['scale_covariates'])
+
+    # Sparse weights
+    init.initSW(ptheta=model_opts["priorSW"]["Theta"], pmean_S0=model_opts["priorSW"]["mean_S0"], pvar_S0=model_opts["priorSW"]["var_S0"], pmean_S1=model_opts["priorSW"]["mean_S1"], pvar_S1=model_opts["priorSW"]["var_S1"],
+                qtheta=model_opts["initSW"]["Theta"], qmean_S0=model_opts["initSW"]["mean_S0"], qvar_S0=model_opts["initSW"]["var_S0"], qmean_S1=model_opts["initSW"]["mean_S1"], qvar_S1=model_opts["initSW"]["var_S1"],
+                qEW_S0=model_opts["initSW"]["EW_S0"], qEW_S1=model_opts["initSW"]["EW_S1"], qES=model_opts["initSW"]["ES"])
+
+    # ARD on weights
+    init.initAlphaW_mk(pa=model_opts["priorAlphaW"]['a'], pb=model_opts["priorAlphaW"]['b'],
+                       qa=model_opts["initAlphaW"]['a'], qb=model_opts["initAlphaW"]['b'], qE=model_opts["initAlphaW"]['E'])
+
+    # Precision of noise
+    init.initTau(pa=model_opts["priorTau"]['a'], pb=model_opts["priorTau"]['b'],
+                 qa=model_opts["initTau"]['a'], qb=model_opts["initTau"]['b'], qE=model_opts["initTau"]['E'])
+
+    # Sparsity on the weights
+    if len(s.unique(model_opts['learnTheta'])) == 1:
+
+        # All are infered
+        if s.unique(model_opts['learnTheta'])==1.:
+            # init.initThetaLearn(pa=model_opts["priorTheta"]['a'], pb=model_opts["priorTheta"]['b'],
+            #     qa=model_opts["initTheta"]['a'],  qb=model_opts["initTheta"]['b'], qE=model_opts["initTheta"]['E'])
+            init.initThetaMixed(pa=model_opts["priorTheta"]['a'], pb=model_opts["priorTheta"]['b'],
+                qa=model_opts["initTheta"]['a'],  qb=model_opts["initTheta"]['b'], qE=model_opts["initTheta"]['E'],
+                learnTheta=model_opts['learnTheta'])
+
+        # None are infered
+        elif s.unique(model_opts['learnTheta'])==0.:
+            init.initThetaConst(value=model_opts["initTheta"]['E'])
+
+    # Some are infered
+    else:
+        init.initThetaMixed(pa=model_opts["priorTheta"]['a'], pb=model_opts["priorTheta"]['b'],
+            qa=model_opts["initTheta"]['a'],  qb=model_opts["initTheta"]['b'], qE=model_opts["initTheta"]['E'],
+            learnTheta=model_opts['learnTheta'])
+
+    # Observed data
+    init.initY()
+
+    # Define the markov blanket of each node
+    nodes = init.getNodes()
+    nodes["Z"].addMarkovBlanket(SW=nodes["SW"], Tau=nodes["Tau"], Y=nodes["Y"])
+    nodes["Theta"].addMarkovBlanket(SW=nodes["SW"])
+    nodes["AlphaW"].addMarkovBlanket(SW=nodes["SW"])
+    nodes["SW"].addMarkovBlanket(Z=nodes["Z"], Tau=nodes["Tau"], Alpha=nodes["AlphaW"], Y=nodes["Y"], Theta=nodes["Theta"])
+    nodes["Y"].addMarkovBlanket(Z=nodes["Z"], SW=nodes["SW"], Tau=nodes["Tau"])
+    nodes["Tau"].addMarkovBlanket(Z=nodes["Z"], SW=nodes["SW"], Y=nodes["Y"])
+
+    # Share a workspace of preallocated buffers between the nodes, so that the updates do not
+    # allocate new (N,D) arrays at every iteration
+    workspace = Workspace()
+    for node in nodes.values(): node.setWorkspace(workspace)
+
+    return nodes
@@ -0,0 +1,147 @@
+"""
+Module to account for the memory held by the nodes of a model
+
+memoryReport: memory held by each array of each node (parameters, expectations and other arrays such as the data or cached terms)
+memorySummary: text summary of the memory held by each node
+saveMemoryReport: save the report (and the peak allocations traced during training, see BayesNet) in an hdf5 file
+
+Arrays that share memory (i.e. views of other arrays) are counted once, in the first node where they are found.
+The peak allocations of the updates of each node can be traced with tracemalloc during training (--traceMemory).
+"""
+
+from __future__ import division
+import numpy as np
+import numpy.ma as ma
+import pandas as pd
+
+from .nodes import Node
+from .distributions import Distribution
+from .multiview_nodes import Multiview_Node
+
+# Attributes that point to other nodes or to shared objects, which are accounted for separately
+SKIP_ATTRIBUTES = ["markov_blanket", "workspace"]
+
+def arrayOwner(x):
+    """ Method to return the array that owns the memory of an array """
+    while isinstance(x.base, np.ndarray): x = x.base
+    return x
+
+def walkArrays(obj, path, seen, out):
+    """ Method to collect the arrays held by an object (nodes, distributions, dictionaries and lists)
+
+    PARAMETERS
+    ----------
+    obj: object
+    path: str
+        name of the object
+    seen: set
+        ids of the arrays that have already been counted
+    out: list
+        list where the (path, bytes, shape) of each array are appended
+    """
+    if isinstance(obj, ma.MaskedArray):
+        walkArrays(obj.data, path, seen, out)
+        if obj.mask is not ma.nomask: walkArrays(obj.mask, path + "(mask)", seen, out)
+    elif isinstance(obj, np.ndarray):
+        owner = arrayOwner(obj)
+        if id(owner) in seen: return
+        seen.add(id(owner))
+        out.append((path, owner.nbytes, owner.shape))
+    elif isinstance(obj, dict):
+        for k in obj: walkArrays(obj[k], "%s/%s" % (path, k) if path else str(k), seen, out)
+    elif isinstance(obj, (list, tuple)):
+        for i, x in enumerate(obj): walkArrays(x, "%s/%d" % (path, i) if path else str(i), seen, out)
+    elif isinstance(obj, pd.DataFrame):
+        walkArrays(obj.values, path, seen, out)
+    elif isinstance(obj, (Node, Distribution)) or hasattr(obj, "__dict__") and type(obj).__module__.startswith("mofa."):
+        for k in sorted(vars(obj).keys()):
+            if k in SKIP_ATTRIBUTES: continue
+            walkArrays(getattr(obj, k), "%s/%s" % (path, k) if path else k, seen, out)
+
+def category(path):
+    """ Method to classify an array of a node by its path """
+    parts = path.split("/")
+    if "params" in parts: return "parameter"
+    if "expectations" in parts or parts[0] == "E": return "expectation"
+    return "other"
+
+def memoryReport(net):
+    """ Method to calculate the memory held by each array of each node of a model
+
+    PARAMETERS
+    ----------
+    net: BayesNet
+
+    RETURNS
+    -------
+    DataFrame with the node, the view (-1 for single-view nodes), the path of the array within the node,
+    its category (parameter, expectation or other), its size in bytes and its shape
+    """
+    seen, rows = set(), []
+    nodes = net.getNodes()
+    for name in nodes:
+        node = nodes[name]
+        views = [ (m, node.getNodes()[m]) for m in node.activeM ] if isinstance(node, Multiview_Node) else [ (-1, node) ]
+        for m, view_node in views:
+            out = []
+            walkArrays(view_node, "", seen, out)
+            rows.extend([ (name, m, path, category(path), nbytes, shape) for path, nbytes, shape in out ])
+
+    # Scratch buffers shared by all the nodes
+    workspace = getattr(list(nodes.values())[0], "workspace", None) if len(nodes) > 0 else None
+    if workspace is not None:
+        for (buf, m), x in workspace.buffers.items():
+            rows.append(("workspace", m if m is not None else -1, buf, "other", x.nbytes, x.shape))
+
+    return pd.DataFrame(rows, columns=["node", "view", "path", "category", "bytes", "shape"])
+
+def memorySummary(net, report=None):
+    """ Method to return a text summary of the memory held by each node, by category
+
+    PARAMETERS
+    ----------
+    net: BayesNet
+    report: DataFrame
+        report calculated with memoryReport (calculated if not given)
+    """
+    if report is None: report = memoryReport(net)
+    table = report.pivot_table(index="node", columns="category", values="bytes", aggfunc="sum", fill_value=0)
+    table = table.reindex(columns=["parameter","expectation","other"], fill_value=0)
+    table["total"] = table.sum(axis=1)
+    lines = [ "%-12s %12s %12s %12s %12s" % ("Node", "Parameters", "Expectations", "Other", "Total") ]
+    for node, row in table.sort_values("total", ascending=False).iterrows():
+        lines.append("%-12s %12s %12s %12s %12s" % (node, formatBytes(row["parameter"]), formatBytes(row["expectation"]), formatBytes(row["other"]), formatBytes(row["total"])))
+    lines.append("%-12s %12s %12s %12s %12s" % ("Total", formatBytes(table["parameter"].sum()), formatBytes(table["expectation"].sum()), formatBytes(table["other"].sum()), formatBytes(table["total"].sum())))
+
+    # Peak allocations of the updates of each node
+    trace = getattr(net, "memory_trace", {})
+    if len(trace) > 0:
+        lines.append("Peak allocation of the updates: " + ", ".join([ "%s=%s" % (k, formatBytes(v)) for k,v in trace.items() ]))
+    return "\n".join(lines)
+
+def formatBytes(n):
+    """ Method to format a number of bytes """
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(n) < 1024.: return "%.1f%s" % (n, unit)
+        n /= 1024.
+    return "%.1fTB" % n
+
+def saveMemoryReport(net, hdf5):
+    """ Method to save the memory report of the model in an hdf5 file
+
+    PARAMETERS
+    ----------
+    net: BayesNet
+    hdf5:
+    """
+    report = memoryReport(net)
+    grp = hdf5.create_group("memory")
+    grp.create_dataset("node", data=np.array(report["node"].tolist(), dtype='S'))
+    grp.create_dataset("view", data=report["view"].values.astype(np.int64))
+    grp.create_dataset("path", data=np.array(report["path"].tolist(), dtype='S'))
+    grp.create_dataset("category", data=np.array(report["category"].tolist(), dtype='S'))
+    grp.create_dataset("bytes", data=report["bytes"].values.astype(np.int64))
+    trace = getattr(net, "memory_trace", {})
+    if len(trace) > 0:
+        peak = grp.create_group("peak_allocation")
+        for k,v in trace.items(): peak.create_dataset(k, data=np.int64(v))
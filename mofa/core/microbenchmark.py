@@ -0,0 +1,354 @@
+"""
+Module to benchmark the updates of the nodes (kernels) on a frozen model state, and to check that new
+implementations of an update give the same results as the current one
+
+The state of a model is frozen after some iterations of training, and every run of a kernel starts from an
+identical copy of it. The current implementation of each kernel is kept as the reference when the benchmark
+is created, so alternatives can be tested even if they are patched into the classes afterwards.
+The outputs of the kernels are the parameters, the expectations and the contribution to the ELBO
+of the updated nodes, which have to match the outputs of the reference within the tolerance.
+
+Kernels:
+    SW, Z, Tau, AlphaW, Theta: update of the node (parameters and expectations)
+    Y: update of the pseudodata of the non-gaussian views (the gaussian views are constant)
+    removeInactiveFactors: removal of the inactive factors from the network (with dropR2)
+
+Example:
+    from mofa.core.microbenchmark import KernelBenchmark, freezeModel
+    bench = KernelBenchmark(freezeModel(data, ["gaussian","bernoulli"], iterations=10))
+    def updateZ(node):
+        ...
+    bench.compare("Z", {"new":updateZ})
+
+The time of the kernels is also compared with the operation counts of the dry run (see estimate.nodeCosts):
+    mofa-microbenchmark --checkEstimates 3
+"""
+
+from __future__ import division
+import argparse
+import contextlib
+import copy
+import importlib
+import os
+import pickle
+import sys
+from time import time
+from collections.abc import Mapping
+import numpy as np
+import numpy.ma as ma
+
+from .multiview_nodes import Multiview_Node
+from .nongaussian_nodes import PseudoY
+
+NODE_KERNELS = ["SW", "Z", "Tau", "AlphaW", "Theta", "Y"]
+NET_KERNELS = ["removeInactiveFactors"]
+
+def freezeModel(data, likelihoods, iterations=10, outfile=None, **options):
+    """ Method to train a model for a few iterations and return its state (see api.train)
+
+    PARAMETERS
+    ----------
+    data: list
+        list of ndarrays or DataFrames with the data of each view
+    likelihoods: list
+        likelihood of each view
+    iterations: int
+        number of iterations of training before the state is frozen
+    outfile: str
+        if given, the state is also saved in this file (see loadModel)
+    options:
+        other options of the model (see api.train)
+
+    RETURNS
+    -------
+    a BayesNet instance
+    """
+    from .api import train
+
+    options.setdefault("nostop", True)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        net = train(data, likelihoods, iter=iterations, **options).net
+    if outfile is not None:
+        with open(outfile, "wb") as f:
+            pickle.dump(net, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return net
+
+def loadModel(infile):
+    """ Method to load a state saved with freezeModel """
+    with open(infile, "rb") as f:
+        return pickle.load(f)
+
+def flatten(x, prefix, out):
+    """ Method to collect the arrays of nested dictionaries and lists into a flat dictionary """
+    if isinstance(x, Mapping):
+        for k in sorted(x.keys()): flatten(x[k], "%s/%s" % (prefix, k), out)
+    elif isinstance(x, (list, tuple)):
+        for i in range(len(x)): flatten(x[i], "%s/%d" % (prefix, i), out)
+    elif x is not None:
+        out[prefix] = ma.filled(x, np.nan) if isinstance(x, ma.MaskedArray) else np.asarray(x)
+    return out
+
+class KernelBenchmark(object):
+    """ Class to time and compare the implementations of the kernels on a frozen model state """
+
+    def __init__(self, net, seed=1, rtol=1e-6, atol=1e-8):
+        """
+        PARAMETERS
+        ----------
+        net: BayesNet
+            trained (or partially trained) model, it is copied and left unchanged
+        seed: int
+            seed of the random number generator before every run of a kernel
+        rtol: float
+            relative tolerance of the comparison with the reference
+        atol: float
+            absolute tolerance of the comparison with the reference
+        """
+        self.state = copy.deepcopy(net)
+        self.seed = seed
+        self.rtol = rtol
+        self.atol = atol
+
+        # Snapshot of the current implementation of the kernels
+        self.reference = {}
+        for name in NODE_KERNELS:
+            if name not in self.state.getNodes(): continue
+            methods = {}
+            for node in self.targets(self.state, name):
+                cls = type(node)
+                if cls not in methods: methods[cls] = (cls.updateParameters, cls.updateExpectations)
+            self.reference[name] = self.nodeKernel(methods)
+        self.reference["removeInactiveFactors"] = type(self.state).removeInactiveFactors
+
+    @staticmethod
+    def nodeKernel(methods):
+        # Method to define the reference kernel of a node from the methods of its classes
+        def kernel(node):
+            updateParameters, updateExpectations = methods[type(node)]
+            updateParameters(node)
+            updateExpectations(node)
+        return kernel
+
+    def kernels(self):
+        """ Method to return the names of the kernels that can be run on the frozen state """
+        return list(self.reference.keys())
+
+    def targets(self, net, name):
+        """ Method to return the nodes that a kernel updates (one per view for multi-view nodes)
+
+        PARAMETERS
+        ----------
+        net: BayesNet
+        name: str
+            name of the kernel
+        """
+        if name in NET_KERNELS: return [net]
+        node = net.getNodes()[name]
+        nodes = [ node.getNodes()[m] for m in node.activeM ] if isinstance(node, Multiview_Node) else [node]
+        if name == "Y": nodes = [ n for n in nodes if isinstance(n, PseudoY) ]
+        return nodes
+
+    def outputs(self, net, name):
+        """ Method to collect the outputs of a kernel: parameters, expectations and contribution to the ELBO of the updated nodes
+
+        PARAMETERS
+        ----------
+        net: BayesNet
+        name: str
+            name of the kernel
+        """
+        out = {}
+        if name in NET_KERNELS:
+            out["active"] = np.asarray(net.active)
+            out["K"] = np.asarray(net.dim["K"])
+            for node in ["Z", "SW", "AlphaW", "Theta"]:
+                if node in net.getNodes(): flatten(net.getNodes()[node].getExpectations(), node, out)
+            out["elbo"] = np.asarray(net.calculateELBO()["total"])
+            return out
+        for i, node in enumerate(self.targets(net, name)):
+            flatten(node.getParameters(), "%d/parameters" % i, out)
+            flatten(node.getExpectations(), "%d/expectations" % i, out)
+            if hasattr(node, "calculateELBO"): out["%d/elbo" % i] = np.asarray(node.calculateELBO())
+        return out
+
+    def run(self, name, kernel=None, repeats=5, **kwargs):
+        """ Method to time a kernel, every run starts from a copy of the frozen state
+
+        PARAMETERS
+        ----------
+        name: str
+            name of the kernel
+        kernel: function
+            implementation of the kernel, with the node (or the network for removeInactiveFactors) as first argument.
+            By default the reference implementation
+        repeats: int
+            number of runs
+        kwargs:
+            arguments of the kernel (i.e. by_r2 for removeInactiveFactors)
+
+        RETURNS
+        -------
+        times: ndarray with the time of each run
+        outputs: outputs of the first run (see outputs)
+        """
+        assert name in self.reference, "Kernel %s not found, the kernels are: %s" % (name, ", ".join(self.kernels()))
+        if kernel is None: kernel = self.reference[name]
+        times, outputs = np.zeros(repeats), None
+        for r in range(repeats):
+            net = copy.deepcopy(self.state)
+            targets = self.targets(net, name)
+            np.random.seed(self.seed)
+            t = time()
+            for target in targets:
+                kernel(target, **kwargs)
+            times[r] = time()-t
+            if outputs is None: outputs = self.outputs(net, name)
+        return times, outputs
+
+    def check(self, reference, outputs):
+        """ Method to compare the outputs of a kernel with the outputs of the reference
+
+        RETURNS
+        -------
+        list of messages with the outputs that do not match (empty if all of them match)
+        """
+        errors = []
+        for k in sorted(set(reference.keys()) | set(outputs.keys())):
+            if k not in outputs or k not in reference:
+                errors.append("%s: missing output" % k)
+            elif reference[k].shape != outputs[k].shape:
+                errors.append("%s: shape %s instead of %s" % (k, outputs[k].shape, reference[k].shape))
+            elif not np.allclose(outputs[k], reference[k], rtol=self.rtol, atol=self.atol, equal_nan=True):
+                diff = np.nanmax(np.abs(np.asarray(outputs[k], dtype=float) - np.asarray(reference[k], dtype=float)))
+                errors.append("%s: largest difference %.3e" % (k, diff))
+        return errors
+
+    def compare(self, name, alternatives, repeats=5, verbose=True, **kwargs):
+        """ Method to time alternative implementations of a kernel against the reference, and to assert that their outputs match
+
+        PARAMETERS
+        ----------
+        name: str
+            name of the kernel
+        alternatives: dic
+            implementations of the kernel (see run) by name
+        repeats: int
+            number of runs of each implementation
+        verbose: boolean
+        kwargs:
+            arguments of the kernel
+
+        RETURNS
+        -------
+        dictionary with the median time of the reference and of each alternative
+        """
+        times, reference = self.run(name, repeats=repeats, **kwargs)
+        timings = { 'reference':float(np.median(times)) }
+        if verbose: print("%s reference: %.4fs" % (name, timings['reference']))
+        for alt, kernel in alternatives.items():
+            times, outputs = self.run(name, kernel, repeats=repeats, **kwargs)
+            timings[alt] = float(np.median(times))
+            errors = self.check(reference, outputs)
+            assert len(errors) == 0, "%s (%s) does not match the reference:\n%s" % (name, alt, "\n".join(errors))
+            if verbose: print("%s %s: %.4fs (x%.2f)" % (name, alt, timings[alt], timings['reference']/timings[alt]))
+        return timings
+
+    def checkEstimates(self, repeats=5, tolerance=3., min_time=1e-3, verbose=True):
+        """ Method to compare the measured time of each kernel with the time predicted from its operation counts in the
+        estimates of the dry run (see estimate.nodeCosts), so that the counts are updated when the kernels change.
+        The ratios of the measured and the predicted times are divided by their median, which accounts for the
+        overheads and the speed of this machine that are not captured by the measured throughput
+
+        PARAMETERS
+        ----------
+        repeats: int
+            number of runs of each kernel
+        tolerance: float
+            largest factor between the relative ratio of a kernel and one
+        min_time: float
+            kernels that run faster than this (in seconds) are dominated by the overheads and are not checked
+        verbose: boolean
+
+        RETURNS
+        -------
+        dictionary with the relative ratio of the measured and the predicted time of each kernel that is checked,
+        and list of the kernels whose ratio is not within [1/tolerance, tolerance]
+        """
+        from .estimate import nodeCosts, machineRates, predictTime
+        from .nongaussian_nodes import Poisson_PseudoY
+
+        # Dimensions and likelihoods of the frozen state
+        nodes = self.state.getNodes()
+        N, K, D = nodes["Z"].dim[0], self.state.dim["K"], self.state.dim["D"]
+        likelihoods = [ "gaussian" if not isinstance(Y, PseudoY) else "poisson" if isinstance(Y, Poisson_PseudoY) else "bernoulli"
+            for Y in nodes["Y"].getNodes() ]
+        covariates = int(getattr(nodes["Z"], "covariates", np.zeros(0)).sum())
+        missing = any([ ma.getmask(Y).any() for Y in nodes["Y"].getExpectation() ])
+        costs = nodeCosts(N, D, K, likelihoods, covariates=covariates, dropR2=True, missing=missing)
+        costs["time"] = predictTime(costs, machineRates(K))
+        predicted = costs.groupby("node")["time"].sum()
+
+        measured = {}
+        for name in self.kernels():
+            if predicted.get(name, 0.) <= 0.: continue
+            kwargs = { 'by_r2':0. } if name == "removeInactiveFactors" else {}
+            times, _ = self.run(name, repeats=repeats, **kwargs)
+            if np.median(times) >= min_time: measured[name] = float(np.median(times))
+        if len(measured) == 0: return {}, []
+
+        ratios = dict([ (name, measured[name]/predicted[name]) for name in measured ])
+        median = np.median(list(ratios.values()))
+        ratios = dict([ (name, r/median) for name, r in ratios.items() ])
+        failed = [ name for name, r in ratios.items() if r > tolerance or r < 1./tolerance ]
+        if verbose:
+            for name in sorted(ratios):
+                print("%s: measured %.4fs, predicted %.4fs, relative ratio %.2f%s" % (name, measured[name],
+                    predicted[name]*median, ratios[name], " (out of tolerance)" if name in failed else ""))
+        return ratios, failed
+
+def entry_point():
+    p = argparse.ArgumentParser( description='Benchmark of the updates of the nodes on a frozen model state' )
+    p.add_argument( '--state',        type=str, default=None,                    help='Frozen state (see freezeModel), by default a model is trained on simulated data' )
+    p.add_argument( '--N',            type=int, default=1000,                    help='Number of simulated samples' )
+    p.add_argument( '--D',            type=int, default=1000,                    help='Number of simulated features per view' )
+    p.add_argument( '--K',            type=int, default=10,                      help='Number of simulated factors' )
+    p.add_argument( '--likelihoods',  type=str, nargs='+', default=["gaussian","bernoulli","poisson"], help='Likelihoods of the simulated views' )
+    p.add_argument( '--missing',      type=float, default=0.,                    help='Fraction of simulated missing values' )
+    p.add_argument( '--iterations',   type=int, default=10,                      help='Number of iterations before the state is frozen' )
+    p.add_argument( '--saveState',    type=str, default=None,                    help='File to save the frozen state' )
+    p.add_argument( '--kernels',      type=str, nargs='+', default=None,         help='Kernels to benchmark (default: all)' )
+    p.add_argument( '--alternatives', type=str, nargs='+', default=[],           help='Alternative implementations, as kernel=module:function' )
+    p.add_argument( '--repeats',      type=int, default=5,                       help='Number of runs of each implementation' )
+    p.add_argument( '--dropR2',       type=float, default=0.01,                  help='Threshold of removeInactiveFactors' )
+    p.add_argument( '--rtol',         type=float, default=1e-6,                  help='Relative tolerance of the comparison with the reference' )
+    p.add_argument( '--atol',         type=float, default=1e-8,                  help='Absolute tolerance of the comparison with the reference' )
+    p.add_argument( '--checkEstimates', type=float, default=None,                help='Instead of the benchmark, check that the time of each kernel is within this factor of the time predicted by the dry run (see estimate.py)' )
+    args = p.parse_args()
+
+    if args.state is not None:
+        net = loadModel(args.state)
+    else:
+        from .benchmark import simulateData
+        data, likelihoods = simulateData(args.N, args.D, args.K, len(args.likelihoods), args.likelihoods, args.missing)
+        net = freezeModel(data, likelihoods, iterations=args.iterations, outfile=args.saveState, factors=args.K, learnIntercept=True, startSparsity=0, seed=1)
+    bench = KernelBenchmark(net, rtol=args.rtol, atol=args.atol)
+
+    if args.checkEstimates is not None:
+        ratios, failed = bench.checkEstimates(repeats=args.repeats, tolerance=args.checkEstimates)
+        print("%d kernel(s) out of tolerance" % len(failed))
+        if len(failed) > 0: sys.exit(1)
+        return
+
+    alternatives = {}
+    for alt in args.alternatives:
+        name, target = alt.split("=", 1)
+        module, function = target.split(":", 1)
+        alternatives.setdefault(name, {})[target] = getattr(importlib.import_module(module), function)
+
+    for name in (args.kernels if args.kernels is not None else bench.kernels()):
+        kwargs = { 'by_r2':args.dropR2 } if name == "removeInactiveFactors" else {}
+        bench.compare(name, alternatives.get(name, {}), repeats=args.repeats, **kwargs)
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    entry_point()
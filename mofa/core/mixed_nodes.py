@@ -28,31 +28,34 @@ class Mixed_Theta_Nodes(Variational_Node, Constant_Node):
         self.D = ConstTheta.dim[0]
 
         self.idx = idx
-        
+        self.precompute()
+
+    def precompute(self):
+        # Full dimensions of the node and position of the learnt and the constant factors
+        self.dim = (self.D, self.K)
+        self.learnIdx = s.nonzero(self.idx)[0]
+        self.constIdx = s.nonzero(1-self.idx)[0]
+
     def addMarkovBlanket(self, **kargs):
         # SHOULD WE ALSO ADD MARKOV BLANKET FOR CONSTHTETA???
         self.learnTheta.addMarkovBlanket(**kargs)
 
     def getExpectations(self):
-
-        # Get expectations from ConstTheta nodes (D,Kconst)
-        Econst = self.constTheta.getExpectations().copy()
-
-        # Get expectations from LearnTheta nodes and expand to (D,Kconst)
-        Elearn = self.learnTheta.getExpectations().copy()
-        Elearn["E"] = s.repeat(Elearn["E"][None,:], self.D, 0)
-        Elearn["lnE"] = s.repeat(Elearn["lnE"][None,:], self.D, 0)
-        Elearn["lnEInv"] = s.repeat(Elearn["lnEInv"][None,:], self.D, 0)
-
-        # Concatenate expectations to (D,K)
-        E = s.concatenate((Econst["E"], Elearn["E"]), axis=1)
-        lnE = s.concatenate((Econst["lnE"], Elearn["lnE"]), axis=1)
-        lnEInv = s.concatenate((Econst["lnEInv"], Elearn["lnEInv"]), axis=1)
-
-        # Permute to the right order given by self.idx
-        idx = s.concatenate((s.nonzero(1-self.idx)[0],s.where(self.idx)[0]), axis=0)
-        E, lnE, lnEinv = E[:,idx], lnE[:,idx], lnEInv[:,idx]
-        return dict({'E': E, 'lnE': lnE, 'lnEInv':lnEInv})
+        # Expectations with their natural shape, which broadcasts to the dimensions of the node (D,K):
+        # (1,K) if the constant theta is the same for all the features, (D,K) otherwise.
+        # The expectations of the learnt theta (Klearn,) are never expanded to the features
+
+        # Get expectations from ConstTheta nodes (D,Kconst) or (1,Kconst) and LearnTheta nodes (Klearn,)
+        Econst = self.constTheta.getExpectations()
+        Elearn = self.learnTheta.getExpectations()
+
+        # Place the factors in the right order given by self.idx
+        expectations = {}
+        for k in ('E','lnE','lnEInv'):
+            expectations[k] = s.empty((Econst[k].shape[0],self.K))
+            expectations[k][:,self.constIdx] = Econst[k]
+            expectations[k][:,self.learnIdx] = Elearn[k]
+        return expectations
 
     def getExpectation(self):
         return self.getExpectations()['E']
@@ -67,12 +70,21 @@ class Mixed_Theta_Nodes(Variational_Node, Constant_Node):
     def calculateELBO(self):
         return self.learnTheta.calculateELBO()
 
-    def removeFactors(self, *idx):
-        for i in idx:
-            if self.idx[idx] == 1:
-                self.learnTheta.removeFactors(s.where(i == s.nonzero(self.idx)[0])[0])
-            else:
-                self.constTheta.removeFactors(s.where(i == s.nonzero(1-self.idx)[0])[0])
-            self.idx = self.idx[s.arange(self.K)!=i]
-            self.K -= 1
-
+    def getSubIndex(self, idx):
+        # Method to map indices of factors to the indices within the LearnTheta and the ConstTheta nodes
+        learn = s.where(s.isin(s.nonzero(self.idx)[0], idx))[0]
+        const = s.where(s.isin(s.nonzero(1-self.idx)[0], idx))[0]
+        return learn, const
+
+    def deactivateFactors(self, idx):
+        learn, const = self.getSubIndex(idx)
+        if len(learn) > 0: self.learnTheta.deactivateFactors(learn)
+        if len(const) > 0: self.constTheta.deactivateFactors(const)
+
+    def removeFactors(self, idx):
+        learn, const = self.getSubIndex(idx)
+        if len(learn) > 0: self.learnTheta.removeFactors(learn)
+        if len(const) > 0: self.constTheta.removeFactors(const)
+        self.idx = s.delete(self.idx, idx)
+        self.K -= len(idx)
+        self.precompute()
@@ -64,6 +64,26 @@ class Multiview_Node(Node):
         """
         for m in self.activeM: self.nodes[m].removeFactors(idx)
 
+    def deactivateFactors(self,idx):
+        """Method to switch off factors without removing them from the arrays of the node
+
+        PARAMETERS
+        ----------
+        idx: ndarray
+            indices of the factors to be switched off
+        """
+        for m in self.activeM: self.nodes[m].deactivateFactors(idx)
+
+    def setWorkspace(self, workspace, view=None):
+        """Method to attach a workspace of preallocated buffers to the single-view nodes
+
+        PARAMETERS
+        ----------
+        workspace: Workspace
+            arena of buffers shared by the nodes of the model
+        """
+        for m in self.activeM: self.nodes[m].setWorkspace(workspace, m)
+
     def getNodes(self):
         """Method to get the nodes"""
         return self.nodes
@@ -9,6 +9,7 @@ All nodes have two main attributes:
 
 import scipy as s
 import numpy as np
+import numpy.ma as ma
 
 
 class Node(object):
@@ -19,6 +20,10 @@ class Node(object):
     dim: tuple
         Dimensionality of the node
     """
+    # Workspace of preallocated buffers, shared by all nodes of a model (see setWorkspace)
+    workspace = None
+    view = None
+
     def __init__(self, dim):
         self.dim = dim
 
@@ -38,6 +43,72 @@ class Node(object):
         """ Method to return the Markov blanket of the node """
         return self.markov_blanket
 
+    def setWorkspace(self, workspace, view=None):
+        """ Method to attach a workspace of preallocated buffers to the node
+
+        PARAMETERS
+        ----------
+        workspace: Workspace
+            arena of buffers shared by the nodes of the model
+        view: int
+            index of the view of the node (None if the node is shared by all views)
+        """
+        self.workspace = workspace
+        self.view = view
+
+    def getBuffer(self, name, shape, view=None):
+        """ Method to return an (uninitialised) scratch buffer from the workspace of the node
+
+        PARAMETERS
+        ----------
+        name: str
+            name of the buffer
+        shape: tuple
+            shape of the buffer
+        view: int
+            index of the view, by default the view of the node
+        """
+        if view is None: view = self.view
+        if self.workspace is None:
+            return s.empty(shape)
+        return self.workspace.get(name, shape, view)
+
+    def getPrecisionWeights(self, tau, mask, shape, view=None):
+        """ Method to return the precision of the noise of a view without expanding it to the dimensions of the data
+
+        A feature-wise precision keeps its natural shape (D,) and is applied after the sums over the samples, whereas the
+        missing values are removed with weights (the observed entries, or None if there are no missing values).
+        The precision of the features without observations is set to zero, as it is undefined (i.e. NaN) for some likelihoods.
+        A (N,D) precision (Jaakkola's bound) is masked into the weights and the feature-wise precision is one.
+
+        PARAMETERS
+        ----------
+        tau: ndarray
+            expectation of the precision, (D,) or (N,D)
+        mask: ndarray
+            mask of the missing values of the data
+        shape: tuple
+            shape of the data (N,D)
+        view: int
+            index of the view, by default the view of the node
+
+        RETURNS
+        -------
+        the feature-wise precision (D,) and the (N,D) weights (a buffer of the workspace) or None
+        """
+        tau = ma.getdata(tau)
+        if tau.ndim == 1:
+            if not np.any(mask): return tau, None
+            missing = mask.all(axis=0)
+            if missing.any(): tau = np.where(missing, 0., tau)
+            weights = self.getBuffer("tau", shape, view)
+            np.logical_not(mask, out=weights)
+            return tau, weights
+        weights = self.getBuffer("tau", shape, view)
+        np.copyto(weights, tau)
+        weights[mask] = 0.
+        return np.ones(shape[1]), weights
+
     def update(self):
         """ General method to update both parameters and expectations of the node """
         self.updateParameters()
@@ -67,6 +138,17 @@ class Node(object):
         """ General function to get the parameters of the node """
         pass
 
+    def deactivateFactors(self, idx):
+        """ General method to switch off factors without removing them from the arrays of the node
+        Inactive factors are not updated and do not contribute to the model until they are removed with removeFactors()
+
+        PARAMETERS
+        ----------
+        idx: ndarray
+            indices of the factors to be switched off
+        """
+        pass
+
     def updateDim(self, axis, new_dim):
         """ Method to update the dimensionality of a node 
         PARAMETERS
@@ -19,6 +19,7 @@ PseudoY: general class for pseudodata
 
 from __future__ import division
 import scipy as s
+import numpy as np
 import numpy.ma as ma
 
 from .variational_nodes import Unobserved_Variational_Node
@@ -120,9 +121,12 @@ class PseudoY_Seeger(PseudoY):
         PseudoY.__init__(self, dim=dim, obs=obs, params=params, E=E)
 
     def updateParameters(self):
-        Z = self.markov_blanket["Z"].getExpectation()
-        SW = self.markov_blanket["SW"].getExpectation()
-        self.params["zeta"] = s.dot(Z,SW.T)
+        # The linear predictor is copied into the array of zeta (reused between iterations), as the cached product is shared
+        ZW = self.markov_blanket["SW"].getProduct("ZW")
+        if self.params.get("zeta") is None or self.params["zeta"].shape != ZW.shape:
+            self.params["zeta"] = ZW.copy()
+        else:
+            np.copyto(self.params["zeta"], ZW)
 
 class Poisson_PseudoY(PseudoY_Seeger):
     """
@@ -174,9 +178,7 @@ class Poisson_PseudoY(PseudoY_Seeger):
 
     def calculateELBO(self):
         # Compute Lower Bound using the Poisson likelihood with observed data
-        Z = self.markov_blanket["Z"].getExpectation()
-        SW = self.markov_blanket["SW"].getExpectation()
-        tmp = self.ratefn(s.dot(Z,SW.T))
+        tmp = self.ratefn(self.markov_blanket["SW"].getProduct("ZW"))
         lb = s.sum( self.obs*s.log(tmp) - tmp)
         return lb
 class Bernoulli_PseudoY(PseudoY_Seeger):
@@ -213,9 +215,7 @@ class Bernoulli_PseudoY(PseudoY_Seeger):
 
     def calculateELBO(self):
         # Compute Lower Bound using the Bernoulli likelihood with observed data
-        Z = self.markov_blanket["Z"].getExpectation()
-        SW = self.markov_blanket["SW"].getExpectation()
-        tmp = s.dot(Z,SW.T)
+        tmp = self.markov_blanket["SW"].getProduct("ZW")
         lik = s.sum( self.obs*tmp - s.log(1+s.exp(tmp)) )
         return lik
 class Binomial_PseudoY(PseudoY_Seeger):
@@ -260,10 +260,7 @@ class Binomial_PseudoY(PseudoY_Seeger):
 
     def calculateELBO(self):
         # Compute Lower Bound using the Bernoulli likelihood with observed data
-        Z = self.markov_blanket["Z"].getExpectation()
-        SW = self.markov_blanket["SW"].getExpectation()
-
-        tmp = sigmoid(s.dot(Z,SW.T))
+        tmp = sigmoid(self.markov_blanket["SW"].getProduct("ZW"))
 
         # TODO change apprximation
         tmp[tmp==0] = 0.00000001
@@ -338,15 +335,15 @@ class Bernoulli_PseudoY_Jaakkola(PseudoY):
         self.E = (2.*self.obs - 1.)/(4.*lambdafn(self.params["zeta"]))
 
     def updateParameters(self):
-        Z = self.markov_blanket["Z"].getExpectations()
-        SW = self.markov_blanket["SW"].getExpectations()
-        self.params["zeta"] = s.sqrt( s.square(Z["E"].dot(SW["E"].T)) - s.dot(s.square(Z["E"]),s.square(SW["E"].T)) + s.dot(Z["E2"], SW["ESWW"].T) )
-        self.params["zeta"] = ma.masked_invalid(self.params["zeta"])
+        SW = self.markov_blanket["SW"]
+        tmp = self.getBuffer("tmp", self.dim)
+        zeta = s.square(SW.getProduct("ZW"))
+        zeta -= SW.getProduct("ZZWW", out=tmp)
+        zeta += SW.getProduct("E2", out=tmp)
+        self.params["zeta"] = ma.masked_invalid(s.sqrt(zeta, out=zeta))
 
     def calculateELBO(self):
         # Compute Lower Bound using the Bernoulli likelihood with observed data
-        Z = self.markov_blanket["Z"].getExpectation()
-        SW = self.markov_blanket["SW"].getExpectation()
-        tmp = s.dot(Z,SW.T)
+        tmp = self.markov_blanket["SW"].getProduct("ZW")
         lik = ma.sum( self.obs*tmp - s.log(1+s.exp(tmp)) )
         return lik
@@ -0,0 +1,573 @@
+"""
+Module to train a model in parallel over several worker processes (data parallelism over features)
+
+The features of every view are split into contiguous shards and each worker owns one shard of every view:
+its columns of Y and the corresponding rows of SW, Tau and Theta. The nodes that are shared by all features
+(Z, AlphaW and the learnt Theta) live in the coordinator, which in every iteration:
+    (1) asks the workers to update Y and SW and to return the sufficient statistics needed by the Z update
+    (2) reduces the statistics and updates Z, AlphaW and Theta
+    (3) sends the new Z, AlphaW and Theta to the workers, which then update Tau
+
+The sufficient statistics returned by each worker are (summed over its views and features):
+    TYW: (N,K) matrix (tau*Y)*E[W]
+    TWW: (N,K) matrix tau*E[W^2]
+    KK: (K,K) matrix E[W]'*diag(tau)*E[W] for the views with a feature-wise precision and no missing values
+    NKK: (N,K,K) tensor with the sample-wise version of KK for the remaining views (None if there are none)
+
+Workers communicate with the coordinator through multiprocessing connections. Local workers are spawned as
+processes connected with pipes; remote workers are started in other hosts with the 'mofa-worker' command and
+the coordinator connects to them using sockets.
+"""
+
+from __future__ import division
+import argparse
+import traceback
+import scipy as s
+import numpy.ma as ma
+import pandas as pd
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Client, Listener
+
+from .BayesNet import BayesNet
+from .init_nodes import buildNodes
+from .mixed_nodes import Mixed_Theta_Nodes
+from .nongaussian_nodes import PseudoY, Tau_Jaakkola
+from .updates import Theta_Node
+from .variational_nodes import Unobserved_Variational_Node
+
+
+# Nodes whose lower bound is a sum over features, calculated by the workers
+SHARDED_NODES = ("Y", "SW", "Tau")
+
+# Model options that are defined per feature and have to be split between the workers
+FEATURE_OPTS = {
+    "initSW": ("Theta", "mean_S0", "var_S0", "mean_S1", "var_S1"),
+    "priorTau": ("a", "b"),
+    "initTau": ("a", "b", "E"),
+    "initTheta": ("E",),
+}
+
+
+def partitionFeatures(D, nworkers):
+    """Method to split the features of each view into contiguous shards, one per worker
+
+    PARAMETERS
+    ----------
+    D: list
+        number of features per view
+    nworkers: int
+        number of workers
+
+    RETURNS
+    -------
+    list of length nworkers where each element is a list with the indices of the features of each view
+    """
+    assert nworkers <= min(D), "The number of workers cannot be larger than the number of features of the smallest view"
+    splits = [ s.array_split(s.arange(D[m]), nworkers) for m in range(len(D)) ]
+    return [ [ splits[m][w] for m in range(len(D)) ] for w in range(nworkers) ]
+
+def sliceModelOpts(model_opts, cols):
+    """Method to subset the feature-wise model options to a shard of features
+
+    PARAMETERS
+    ----------
+    model_opts: dict
+        model options
+    cols: list
+        indices of the features of each view
+    """
+    opts = dict(model_opts)
+    for key,params in FEATURE_OPTS.items():
+        opts[key] = dict(model_opts[key])
+        for param in params:
+            opts[key][param] = [ v[cols[m]] if isinstance(v,s.ndarray) and v.ndim>0 else v for m,v in enumerate(model_opts[key][param]) ]
+    return opts
+
+def _concatenate(arrays, axis):
+    """ Method to concatenate the shards of an array, keeping the mask of missing values """
+    if any(isinstance(a,ma.MaskedArray) for a in arrays):
+        return ma.concatenate(arrays, axis=axis)
+    return s.concatenate(arrays, axis=axis)
+
+def _learntTheta(node):
+    """ Method to return the Theta_Node of a single-view theta node and the indices of the factors where it is learnt """
+    if isinstance(node, Mixed_Theta_Nodes):
+        return node.learnTheta, s.nonzero(node.idx)[0]
+    elif isinstance(node, Theta_Node):
+        return node, s.arange(node.dim[0])
+    return None, None
+
+
+#############
+## Workers ##
+#############
+
+class ShardWorker(object):
+    """
+    Class for a worker that owns a shard of features of every view.
+    The worker keeps a local copy of the network restricted to its features, where Z, AlphaW and Theta
+    are replicas of the nodes of the coordinator
+    """
+    def setup(self, data, data_opts, model_opts, dim, seed=None):
+        """Method to initialise the local network
+
+        PARAMETERS
+        ----------
+        data: list
+            observed data of the shard, one matrix per view with dimensions (N,D[m])
+        data_opts: dict
+        model_opts: dict
+            model options subset to the features of the shard (see sliceModelOpts)
+        dim: dict
+            dimensionalities of the shard
+        seed: int
+        """
+        nodes = buildNodes(dim, data, data_opts, model_opts, seed)
+        self.net = BayesNet(dim=dim, nodes=nodes, schedule=model_opts["schedule"], options={})
+        self.nodes = nodes
+
+    def setGlobals(self, Z=None, AlphaW=None, Theta=None):
+        """Method to overwrite the replicas of the nodes that are updated in the coordinator
+
+        PARAMETERS
+        ----------
+        Z: dict
+            parameters (mean and var) of the Q distribution of the latent variables
+        AlphaW: list
+            parameters (a and b) of the Q distribution of the ARD precision of each view
+        Theta: list
+            parameters (a and b) of the Q distribution of the learnt sparsity of each view (None if it is constant)
+        """
+        if Z is not None:
+            self.nodes["Z"].Q.setParameters(**Z)
+            self.nodes["Z"].updateExpectations()
+        if AlphaW is not None:
+            for m,node in enumerate(self.nodes["AlphaW"].getNodes()):
+                node.Q.setParameters(**AlphaW[m])
+                node.updateExpectations()
+        if Theta is not None:
+            for m,node in enumerate(self.nodes["Theta"].getNodes()):
+                learnTheta = _learntTheta(node)[0]
+                if learnTheta is not None:
+                    learnTheta.Q.setParameters(**Theta[m])
+                    learnTheta.updateExpectations()
+
+    def updateWeights(self):
+        """Method to update the pseudodata and the weights and collect the statistics for the coordinator """
+        self.nodes["Y"].update()
+        self.nodes["SW"].update()
+        return self.calculateStatistics()
+
+    def calculateStatistics(self):
+        """Method to calculate the sufficient statistics of the shard (see the module documentation) """
+        Y = self.nodes["Y"].getExpectation()
+        tau = self.nodes["Tau"].getExpectation()
+        SW = self.nodes["SW"].getExpectations()
+        N, K = self.net.dim["N"], self.net.dim["K"]
+
+        stats = { 'TYW':s.zeros((N,K)), 'TWW':s.zeros((N,K)), 'KK':s.zeros((K,K)), 'NKK':None, 'D':[], 'ES':[], 'EWW':[] }
+        for m in range(len(Y)):
+            W, WW = SW[m]["E"], SW[m]["ESWW"]
+
+            # Mask the missing values
+            mask = ma.getmaskarray(Y[m])
+            Ym = ma.getdata(Y[m]).copy()
+            Ym[mask] = 0.
+            taum = ma.getdata(tau[m])
+
+            # Feature-wise precision and no missing values: the cross products reduce to a (K,K) matrix
+            if taum.shape != Ym.shape and not mask.any():
+                stats["TYW"] += s.dot(Ym, W*taum[:,None])
+                stats["TWW"] += s.dot(taum, WW)
+                stats["KK"] += s.dot(W.T*taum, W)
+
+            # Otherwise the cross products depend on the sample: a feature-wise precision is applied to the weights
+            # and the missing values are removed with the observed entries, without expanding the precision to (N,D)
+            else:
+                if taum.shape != Ym.shape:
+                    # (the precision of the features without observations is undefined, see Node.getPrecisionWeights)
+                    weights = (~mask).astype(float)
+                    taum = s.where(mask.all(axis=0), 0., taum)
+                    tauW, tauWW = W*taum[:,None], WW*taum[:,None]
+                    stats["TYW"] += s.dot(Ym, tauW)
+                else:
+                    weights = taum.copy()
+                    weights[mask] = 0.
+                    tauW, tauWW = W, WW
+                    stats["TYW"] += s.dot(weights*Ym, W)
+                stats["TWW"] += s.dot(weights, tauWW)
+                if stats["NKK"] is None:
+                    stats["NKK"] = s.zeros((N,K,K))
+                for k in range(K):
+                    stats["NKK"][:,k,:] += s.dot(weights, tauW[:,k,None]*W)
+
+            # Feature-wise sums for the updates of AlphaW and Theta
+            stats["D"].append(W.shape[0])
+            stats["ES"].append(SW[m]["ES"].sum(axis=0))
+            stats["EWW"].append(SW[m]["EWW"].sum(axis=0))
+
+        return stats
+
+    def updateTau(self, **shared):
+        """Method to update the noise precision after receiving the new nodes from the coordinator """
+        self.setGlobals(**shared)
+        self.nodes["Tau"].update()
+
+    def calculateELBO(self):
+        """Method to calculate the lower bound of the nodes that are sharded by features """
+        elbo = self.net.calculateELBO(*SHARDED_NODES)
+        return { node:elbo[node] for node in SHARDED_NODES }
+
+    def calculateR2Terms(self):
+        """Method to calculate the terms of the coefficient of determination of the shard """
+        return self.net.calculateR2Terms()
+
+    def deactivateFactors(self, idx):
+        """Method to switch off factors in the local network """
+        self.net.deactivateFactors(idx)
+
+    def compactFactors(self):
+        """Method to remove the inactive factors from the local network """
+        self.net.compactFactors()
+
+    def collect(self):
+        """Method to return the state of the nodes that are sharded by features """
+        shard = { "SW":[], "Tau":[], "Y":[] }
+        for node in self.nodes["SW"].getNodes():
+            shard["SW"].append(node.Q.getParameters())
+        for node in self.nodes["Tau"].getNodes():
+            if isinstance(node, Unobserved_Variational_Node):
+                shard["Tau"].append({ 'Q':node.Q.getParameters() })
+            elif isinstance(node, Tau_Jaakkola):
+                shard["Tau"].append({ 'value':node.getValue() })
+            else:
+                shard["Tau"].append(None)
+        for node in self.nodes["Y"].getNodes():
+            if isinstance(node, PseudoY):
+                shard["Y"].append({ 'E':node.getExpectation(), 'params':node.getParameters() })
+            else:
+                shard["Y"].append(None)
+        return shard
+
+def serveWorker(conn):
+    """Method to serve the requests of a coordinator through a connection until it is closed
+
+    PARAMETERS
+    ----------
+    conn: multiprocessing Connection
+    """
+    worker = ShardWorker()
+    while True:
+        try:
+            method, kwargs = conn.recv()
+        except EOFError:
+            break
+        if method == "close":
+            break
+        try:
+            conn.send(("ok", getattr(worker,method)(**kwargs)))
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+    conn.close()
+
+def worker_entry_point():
+    """ Command line entry point to start a remote worker """
+    p = argparse.ArgumentParser( description='Start a MOFA worker for feature-sharded training' )
+    p.add_argument( '--host',     type=str, default="0.0.0.0",         help='Address to listen on' )
+    p.add_argument( '--port',     type=int, required=True,             help='Port to listen on' )
+    p.add_argument( '--authkey',  type=str, required=True,             help='Authentication key shared with the coordinator' )
+    p.add_argument( '--once',     action='store_true',                 help='Exit after serving one coordinator?' )
+    args = p.parse_args()
+
+    listener = Listener((args.host,args.port), authkey=args.authkey.encode())
+    print("MOFA worker listening on %s:%d..." % (args.host,args.port))
+    while True:
+        conn = listener.accept()
+        print("Serving coordinator %s..." % str(listener.last_accepted))
+        serveWorker(conn)
+        if args.once: break
+    listener.close()
+
+
+##################
+## Worker pools ##
+##################
+
+class WorkerPool(object):
+    """ Class to send requests to a set of workers and collect their replies """
+    def __init__(self, connections, processes=()):
+        """
+        PARAMETERS
+        ----------
+        connections: list
+            multiprocessing connections to the workers
+        processes: list
+            local worker processes (to be joined when the pool is closed)
+        """
+        self.connections = connections
+        self.processes = processes
+
+    def size(self):
+        """ Method to return the number of workers """
+        return len(self.connections)
+
+    def call(self, method, kwargs=None):
+        """Method to call a method of all the workers and wait for the results
+
+        PARAMETERS
+        ----------
+        method: str
+            name of the ShardWorker method
+        kwargs: dict or list
+            keyword arguments, either shared by all the workers or a list with one dictionary per worker
+        """
+        if kwargs is None: kwargs = {}
+        if isinstance(kwargs, dict): kwargs = [kwargs]*self.size()
+        for conn,kw in zip(self.connections,kwargs):
+            conn.send((method,kw))
+        results = []
+        for conn in self.connections:
+            status, result = conn.recv()
+            if status == "error":
+                raise RuntimeError("Error in MOFA worker while running '%s':\n%s" % (method,result))
+            results.append(result)
+        return results
+
+    def close(self):
+        """ Method to stop the workers """
+        for conn in self.connections:
+            conn.send(("close",None))
+            conn.close()
+        for p in self.processes:
+            p.join()
+
+def startLocalWorkers(nworkers):
+    """Method to start worker processes in the local machine, connected with pipes
+
+    PARAMETERS
+    ----------
+    nworkers: int
+        number of worker processes
+    """
+    connections, processes = [], []
+    for w in range(nworkers):
+        parent_conn, child_conn = Pipe()
+        p = Process(target=serveWorker, args=(child_conn,))
+        p.daemon = True
+        p.start()
+        child_conn.close()
+        connections.append(parent_conn)
+        processes.append(p)
+    return WorkerPool(connections, processes)
+
+def connectWorkers(addresses, authkey):
+    """Method to connect to remote workers started with 'mofa-worker'
+
+    PARAMETERS
+    ----------
+    addresses: list
+        addresses of the workers in the format host:port
+    authkey: str
+        authentication key shared with the workers
+    """
+    connections = []
+    for address in addresses:
+        host, port = address.rsplit(":",1)
+        connections.append(Client((host,int(port)), authkey=authkey.encode()))
+    return WorkerPool(connections)
+
+
+#################
+## Coordinator ##
+#################
+
+class ShardedBayesNet(BayesNet):
+    """
+    Bayesian network where the features are sharded over a pool of workers.
+
+    The coordinator keeps the full set of nodes: Z, AlphaW and Theta are updated here from the statistics
+    reduced over the workers, whereas Y, SW and Tau are only filled in with the state of the workers
+    at the end of training.
+    """
+    def __init__(self, dim, nodes, schedule, options, pool, trial=1):
+        """
+        PARAMETERS
+        ----------
+        dim, nodes, schedule, options, trial: see BayesNet
+        pool: WorkerPool
+            pool of workers, set up with setupWorkers()
+        """
+        assert tuple(schedule) == ("Y","SW","Z","AlphaW","Theta","Tau"), "Sharded training only supports the default schedule"
+        BayesNet.__init__(self, dim=dim, nodes=nodes, schedule=schedule, options=options, trial=trial)
+        self.pool = pool
+
+    def setupWorkers(self, data, model_opts, seed=None):
+        """Method to send the shards of the data to the workers and initialise their networks
+
+        PARAMETERS
+        ----------
+        data: list
+            observed data, one matrix per view with dimensions (N,D[m])
+        model_opts: dict
+        seed: int
+        """
+        self.shards = partitionFeatures(self.dim['D'], self.pool.size())
+        kwargs = []
+        for cols in self.shards:
+            kwargs.append({
+                'data': [ data[m].iloc[:,cols[m]] if isinstance(data[m], pd.DataFrame) else s.asarray(data[m])[:,cols[m]] for m in range(self.dim['M']) ],
+                'data_opts': { 'covariates':None, 'scale_covariates':None },
+                'model_opts': sliceModelOpts(model_opts, cols),
+                'dim': dict(self.dim, D=s.asarray([ len(c) for c in cols ])),
+                'seed': seed
+            })
+        self.pool.call("setup", kwargs)
+        self.pool.call("setGlobals", { 'Z':self.getZParameters() })
+
+    def getZParameters(self):
+        """ Method to return the parameters of the Q distribution of the latent variables """
+        Q = self.nodes["Z"].Q.getParameters()
+        return { 'mean':Q['mean'], 'var':Q['var'] }
+
+    def getThetaParameters(self):
+        """ Method to return the parameters of the Q distribution of the learnt sparsity of each view """
+        params = []
+        for node in self.nodes["Theta"].getNodes():
+            learnTheta = _learntTheta(node)[0]
+            params.append(learnTheta.Q.getParameters() if learnTheta is not None else None)
+        return params
+
+    def updateNodes(self, i):
+        """Method to do a single pass of updates over the nodes using the workers
+
+        PARAMETERS
+        ----------
+        i: int
+            iteration number
+        """
+        stats = self.pool.call("updateWeights")
+        self.updateZ(stats)
+        self.updateAlphaW(stats)
+        shared = { 'Z':self.getZParameters(), 'AlphaW':[ node.Q.getParameters() for node in self.nodes["AlphaW"].getNodes() ] }
+        if i >= self.options['startSparsity']:
+            self.updateTheta(stats)
+            shared['Theta'] = self.getThetaParameters()
+        self.pool.call("updateTau", shared)
+
+    def updateZ(self, stats):
+        """Method to update the latent variables from the reduced statistics, same update as Z_Node.updateParameters
+
+        PARAMETERS
+        ----------
+        stats: list
+            statistics returned by each worker
+        """
+        Z = self.nodes["Z"]
+        TYW = sum([ x["TYW"] for x in stats ])
+        TWW = sum([ x["TWW"] for x in stats ])
+        KK = sum([ x["KK"] for x in stats ])
+        NKK = [ x["NKK"] for x in stats if x["NKK"] is not None ]
+        NKK = sum(NKK) if len(NKK) > 0 else None
+
+        # Collect parameters from the prior or expectations from the markov blanket
+        if "Mu" in Z.markov_blanket:
+            Mu = Z.markov_blanket['Mu'].getExpectation()
+        else:
+            Mu = Z.P.getParameters()["mean"]
+        if "Alpha" in Z.markov_blanket:
+            Alpha = s.broadcast_to(Z.markov_blanket['Alpha'].getExpectation(), (Z.N,Z.dim[1]))
+        else:
+            Alpha = 1./Z.P.getParameters()["var"]
+
+        Q = Z.Q.getParameters()
+        Qmean, Qvar = Q['mean'], Q['var']
+        for k in Z.getLvIndex():
+            cross = s.dot(Qmean, KK[:,k]) - Qmean[:,k]*KK[k,k]
+            if NKK is not None:
+                cross += (Qmean*NKK[:,:,k]).sum(axis=1) - Qmean[:,k]*NKK[:,k,k]
+            Qvar[:,k] = 1./(Alpha[:,k]+TWW[:,k])
+            Qmean[:,k] = Qvar[:,k] * ( Alpha[:,k]*Mu[:,k] + TYW[:,k] - cross )
+
+        Z.Q.setParameters(mean=Qmean, var=Qvar)
+        Z.updateExpectations()
+
+    def updateAlphaW(self, stats):
+        """ Method to update the ARD precision of the weights, same update as AlphaW_Node_mk.updateParameters """
+        for m,node in enumerate(self.nodes["AlphaW"].getNodes()):
+            P = node.P.getParameters()
+            D = sum([ x["D"][m] for x in stats ])
+            EWW = sum([ x["EWW"][m] for x in stats ])
+            node.Q.setParameters(a=P['a']+0.5*D, b=P['b']+0.5*EWW)
+            node.updateExpectations()
+
+    def updateTheta(self, stats):
+        """ Method to update the learnt sparsity of the weights, same update as Theta_Node.updateParameters """
+        for m,node in enumerate(self.nodes["Theta"].getNodes()):
+            learnTheta, factors = _learntTheta(node)
+            if learnTheta is None: continue
+            D = sum([ x["D"][m] for x in stats ])
+            ES = sum([ x["ES"][m] for x in stats ])[factors]
+            learnTheta.Q.setParameters(a=learnTheta.Ppar['a']+ES, b=learnTheta.Ppar['b']+D-ES)
+            learnTheta.updateExpectations()
+
+    def calculateR2Terms(self):
+        """ Method to calculate the terms of the coefficient of determination, reduced over the workers """
+        terms = self.pool.call("calculateR2Terms")
+        return sum([ x[0] for x in terms ]), sum([ x[1] for x in terms ])
+
+    def deactivateFactors(self, idx):
+        """ Method to switch off factors in the nodes of the coordinator and the workers """
+        BayesNet.deactivateFactors(self, idx)
+        self.pool.call("deactivateFactors", { 'idx':idx })
+
+    def compactFactors(self):
+        """ Method to remove the inactive factors from the nodes of the coordinator and the workers """
+        if self.active.all(): return
+        BayesNet.compactFactors(self)
+        self.pool.call("compactFactors")
+
+    def calculateELBO(self, *nodes):
+        """ Method to calculate the Evidence Lower Bound of the model, reducing the sharded nodes over the workers """
+        if len(nodes) == 0: nodes = self.getVariationalNodes().keys()
+        sharded = self.pool.call("calculateELBO")
+        elbo = pd.Series(s.zeros(len(nodes)+1), index=list(nodes)+["total"])
+        for node in nodes:
+            if node in SHARDED_NODES:
+                elbo[node] = float(sum([ x[node] for x in sharded ]))
+            else:
+                elbo[node] = float(self.nodes[node].calculateELBO())
+            elbo["total"] += elbo[node]
+        return elbo
+
+    def iterate(self):
+        """ Method to train the model and collect the state of the workers at the end """
+        BayesNet.iterate(self)
+        self.gatherShards()
+
+    def gatherShards(self):
+        """ Method to fill in the nodes of the coordinator with the state of the sharded nodes of the workers """
+        shards = self.pool.call("collect")
+        for m in range(self.dim['M']):
+
+            # Weights
+            node = self.nodes["SW"].getNodes()[m]
+            # (the parameters of the spike are per factor and shared by all shards)
+            params = shards[0]["SW"][m]
+            node.Q.setParameters(**{ k:(_concatenate([x["SW"][m][k] for x in shards], axis=0) if s.ndim(params[k]) == 2 else params[k]) for k in params })
+            node.updateExpectations()
+
+            # Noise precision
+            node = self.nodes["Tau"].getNodes()[m]
+            if isinstance(node, Unobserved_Variational_Node):
+                params = shards[0]["Tau"][m]['Q'].keys()
+                node.Q.setParameters(**{ k:_concatenate([x["Tau"][m]['Q'][k] for x in shards], axis=0) for k in params })
+                node.updateExpectations()
+            elif isinstance(node, Tau_Jaakkola):
+                node.value = _concatenate([ x["Tau"][m]['value'] for x in shards ], axis=1)
+
+            # Pseudodata
+            node = self.nodes["Y"].getNodes()[m]
+            if isinstance(node, PseudoY):
+                node.E = _concatenate([ x["Y"][m]['E'] for x in shards ], axis=1)
+                for k in shards[0]["Y"][m]['params'].keys():
+                    node.params[k] = _concatenate([ x["Y"][m]['params'][k] for x in shards ], axis=1)
@@ -0,0 +1,103 @@
+from __future__ import division
+import numpy as np
+import pandas as pd
+
+"""
+Module to define the functions to prepare the data before training
+
+missingViews: find the views where each sample is missing
+checkMissingSamples: warn about samples that are missing in all views
+removeIncompleteSamples: remove samples that are missing in at least one view
+maskData: mask values at random or complete samples of a view, to test missing values and to evaluate imputation
+"""
+
+def missingViews(data):
+    """ Method to find the views where each sample is missing (i.e. all its values are missing)
+
+    PARAMETERS
+    ----------
+    data: list
+        list of DataFrames or ndarrays with dimensions (samples,features)
+
+    RETURNS
+    -------
+    boolean ndarray with dimensions (samples,views)
+    """
+    missing = np.zeros((data[0].shape[0],len(data)), dtype=bool)
+    for m in range(len(data)):
+        Y = np.asarray(data[m])
+        missing[:,m] = np.isnan(Y).all(axis=1) if Y.shape[1] > 0 else True
+    return missing
+
+def checkMissingSamples(data):
+    """ Method to check if any sample has missing values in all views
+
+    PARAMETERS
+    ----------
+    data: list
+        list of DataFrames or ndarrays with dimensions (samples,features)
+    """
+    empty = missingViews(data).all(axis=1)
+    if np.any(empty):
+        print("Warning: %d sample(s) have missing values in all views, their factors will only be determined by the prior..." % empty.sum())
+    return empty
+
+def removeIncompleteSamples(data):
+    """ Method to remove samples with missing views
+
+    PARAMETERS
+    ----------
+    data: list
+    """
+    print("Removing incomplete samples...")
+
+    incomplete = missingViews(data).any(axis=1)
+
+    if np.any(incomplete):
+        print("A total of " + str(incomplete.sum()) + " sample(s) have at least a missing view and will be removed")
+        data = [ data[m].iloc[~incomplete] for m in range(len(data)) ]
+
+    return data
+
+def maskData(data, data_opts, rng=None):
+    """ Method to mask values of the data,
+    It is mainly to test missing values and to evaluate imputation
+
+    PARAMETERS
+    ----------
+    data: list
+        list of DataFrames with dimensions (samples,features)
+    data_opts: dic
+    rng: numpy Generator
+        random number generator (by default it is seeded from the global numpy random state)
+    """
+    print("Masking data with the following options:")
+    print("at random:")
+    print(data_opts['maskAtRandom'])
+    print("full cases:")
+    print(data_opts['maskNSamples'])
+
+    if rng is None: rng = np.random.default_rng(np.random.randint(2**31-1))
+
+    for m in range(len(data)):
+        N, D = data[m].shape
+        p2Mask = data_opts['maskAtRandom'][m]
+        Nsamples2Mask = data_opts['maskNSamples'][m]
+        if p2Mask == 0 and Nsamples2Mask == 0: continue
+
+        # The data can be memory-mapped or shared with the caller, so the masked values are set in a copy
+        Y = np.array(data[m].values, order="C")
+
+        # Mask values at random
+        if p2Mask != 0:
+            idxMask = rng.choice(N*D, size=int(round(N*D*p2Mask)), replace=False)
+            Y.ravel()[idxMask] = np.nan
+
+        # Mask samples in a complete view
+        if Nsamples2Mask != 0:
+            idxMask = rng.choice(N, size=Nsamples2Mask, replace=False)
+            Y[idxMask,:] = np.nan
+
+        data[m] = pd.DataFrame(Y, index=data[m].index, columns=data[m].columns, copy=False)
+
+    return data
@@ -0,0 +1,149 @@
+"""
+Module to profile the training of a model with a sampling profiler
+
+A background thread takes a sample of the stack of the training thread at regular intervals, only during a window
+of iterations (see BayesNet.iterate), so the overhead is small and the steady state can be profiled without the
+initialisation. Each sample is labelled with the node that was being updated (or with the step of the iteration,
+i.e. calculateELBO or removeInactiveFactors).
+
+The results are written as:
+- collapsed stacks (one line per stack with its number of samples), which can be converted into a flame graph
+    with flamegraph.pl or speedscope. The node is added as a frame below updateNodes
+- a table with the number of samples of each function in each node (self: the function was running, total: the
+    function was in the stack)
+"""
+
+from __future__ import division
+from collections import Counter
+import os
+import sys
+import threading
+
+class SamplingProfiler(object):
+    """ Class to take samples of the stack of the training thread """
+
+    def __init__(self, interval=0.005, start=0, end=None):
+        """
+        PARAMETERS
+        ----------
+        interval: float
+            time between samples in seconds
+        start: int
+            first iteration to profile (starting at 0)
+        end: int
+            iteration at which the profiling stops (None to profile until the end)
+        """
+        self.interval = interval
+        self.window = (start, end)
+        self.node = None
+        self.active = False
+        self.stacks = Counter()
+        self.nsamples = 0
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        """ Method to start the sampling thread, the samples are taken from the thread that calls this method """
+        self.target = threading.get_ident()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="mofa-profiler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Method to stop the sampling thread """
+        self.active = False
+        self.stopped.set()
+        if self.thread is not None: self.thread.join()
+        self.thread = None
+
+    def setIteration(self, i):
+        """ Method to switch the sampling on or off depending on the iteration """
+        start, end = self.window
+        self.active = i >= start and (end is None or i < end)
+
+    def setNode(self, node):
+        """ Method to label the following samples with the node that is being updated (None when no node is updated) """
+        self.node = node
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.active: continue
+            frame = sys._current_frames().get(self.target)
+            if frame is None: continue
+            self.stacks[self.sample(frame, self.node)] += 1
+            self.nsamples += 1
+
+    @staticmethod
+    def frameName(frame):
+        code = frame.f_code
+        return "%s:%s" % (os.path.splitext(os.path.basename(code.co_filename))[0], getattr(code, "co_qualname", code.co_name))
+
+    def sample(self, frame, node):
+        """ Method to convert a frame into a stack (from the outermost frame), with the node as a frame below updateNodes """
+        stack = []
+        while frame is not None:
+            stack.append(self.frameName(frame))
+            frame = frame.f_back
+        stack.reverse()
+        for i, name in enumerate(stack):
+            if name.endswith("updateNodes") and node is not None:
+                stack.insert(i+1, "[%s]" % node)
+                break
+        return tuple(stack)
+
+    def label(self, stack):
+        """ Method to return the node (or the step of the iteration) of a stack """
+        iterate = [ i for i, name in enumerate(stack) if name.endswith(".iterate") ]
+        if len(iterate) == 0 or iterate[-1]+1 == len(stack): return "other"
+        step = stack[iterate[-1]+1:]
+        if step[0].endswith(".updateNodes") and len(step) > 1:
+            # (sharded networks do not label the nodes, their updates are named after the functions of the coordinator)
+            return step[1][1:-1] if step[1].startswith("[") else step[1].split(".")[-1]
+        return step[0].split(".")[-1]
+
+    def functions(self):
+        """ Method to aggregate the samples by node and function
+
+        RETURNS
+        -------
+        list of (node, function, self samples, total samples), sorted by the total samples
+        """
+        own, total = Counter(), Counter()
+        for stack, n in self.stacks.items():
+            node = self.label(stack)
+            own[(node, stack[-1])] += n
+            for name in set(stack): total[(node, name)] += n
+        rows = [ (k[0], k[1], own.get(k,0), v) for k,v in total.items() if not k[1].startswith("[") ]
+        return sorted(rows, key=lambda x: (-x[3], -x[2], x[0], x[1]))
+
+    def nodes(self):
+        """ Method to return the number of samples of each node (or step of the iteration) """
+        counts = Counter()
+        for stack, n in self.stacks.items(): counts[self.label(stack)] += n
+        return counts
+
+    def summary(self, top=10):
+        """ Method to return a text summary with the fraction of the samples of each node and the functions with more samples """
+        if self.nsamples == 0: return "No samples were taken"
+        lines = [ "%d samples (%.1f ms interval)" % (self.nsamples, 1000*self.interval) ]
+        lines.append("  ".join([ "%s=%.1f%%" % (k, 100.*v/self.nsamples) for k,v in self.nodes().most_common() ]))
+        rows = sorted(self.functions(), key=lambda x: -x[2])[:top]
+        lines.extend([ "%-14s %-50s self=%5.1f%% total=%5.1f%%" % (node, name, 100.*own/self.nsamples, 100.*total/self.nsamples) for node, name, own, total in rows ])
+        return "\n".join(lines)
+
+    def write(self, prefix):
+        """ Method to write the collapsed stacks (prefix.collapsed) and the table of functions (prefix.tsv)
+
+        PARAMETERS
+        ----------
+        prefix: str
+        """
+        with open(prefix + ".collapsed", "w") as f:
+            for stack, n in sorted(self.stacks.items()):
+                f.write("%s %d\n" % (";".join(stack), n))
+        with open(prefix + ".tsv", "w") as f:
+            f.write("node\tfunction\tself\ttotal\n")
+            for row in self.functions():
+                f.write("%s\t%s\t%d\t%d\n" % row)
+        return [prefix + ".collapsed", prefix + ".tsv"]
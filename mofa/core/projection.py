@@ -0,0 +1,149 @@
+"""
+Module to project new samples onto a trained model
+
+The weights (SW), the precision of the noise (Tau) and the ARD prior (AlphaW) are kept fixed, and only the
+variational distribution of the factors (and the pseudodata of the non-gaussian views) is updated for the new
+samples, with the same updates as in training (see Z_Node, Poisson_PseudoY and Bernoulli_PseudoY_Jaakkola).
+All samples are updated at the same time, and they can have missing values or missing views.
+
+The new data has to be processed as the training data (i.e. centered with the means of the training data).
+
+Example:
+    import mofa
+    from mofa.core.projection import projectSamples
+    Z, Zvar = projectSamples("model.hdf5", { "mRNA":Ynew_mRNA, "methylation":Ynew_met })
+"""
+
+from __future__ import division
+import numpy as np
+import pandas as pd
+
+from .reader import ModelFile
+from .utils import sigmoid, lambdafn
+
+def getProjectionTerms(model):
+    """ Method to collect the terms of a trained model that are required to project new samples
+
+    PARAMETERS
+    ----------
+    model: a trained model (see api.Model), a saved model (see reader.ModelFile) or the path of a saved model
+    """
+    if isinstance(model, str): model = ModelFile(model)
+
+    if isinstance(model, ModelFile):
+        assert "projection" in model.file, "The model was saved without the terms to project new samples, please save it again"
+        views = model.views
+        terms = { 'views':views, 'features':model.features, 'likelihoods':model.likelihoods,
+            'EW':{ m:np.asarray(model.W[m], dtype=np.float64) for m in views },
+            'EWW':{ m:model.file["projection/SWW/%s" % m][()].T.astype(np.float64) for m in views },
+            'tau':{ m:model.file["expectations/Tau/%s" % m][()].astype(np.float64) for m in views },
+            'covariates':model.file["projection/covariates"][()].astype(bool) }
+        terms['Zcov'] = np.asarray(model.Z[:,np.where(terms['covariates'])[0]])
+    else:
+        nodes = model.net.getNodes()
+        views = model.view_names
+        SW, tau = nodes["SW"].getExpectations(), nodes["Tau"].getExpectation()
+        terms = { 'views':views, 'features':dict(zip(views, model.feature_names)), 'likelihoods':dict(zip(views, model.likelihoods)),
+            'EW':{ views[m]:SW[m]["E"] for m in range(len(views)) },
+            'EWW':{ views[m]:SW[m]["ESWW"] for m in range(len(views)) },
+            'tau':{ views[m]:tau[m] for m in range(len(views)) },
+            'covariates':nodes["Z"].covariates.copy() }
+        terms['Zcov'] = model.Z[:,terms['covariates']]
+    return terms
+
+def projectSamples(model, data, covariates=None, maxiter=100, tolerance=1e-5, verbose=False):
+    """ Method to infer the factors of new samples, keeping the rest of the model fixed
+
+    PARAMETERS
+    ----------
+    model: a trained model (see api.Model), a saved model (see reader.ModelFile) or the path of a saved model
+    data: dic
+        data of the new samples for each view (views can be missing), either ndarrays with dimensions (samples,features)
+        and the features in the same order as the training data, or DataFrames with the names of the features as columns
+        (features that are not in the DataFrame are considered missing)
+    covariates: ndarray
+        values of the covariates for the new samples, with dimensions (samples,covariates), excluding the intercept
+    maxiter: int
+        maximum number of iterations
+    tolerance: float
+        the updates stop when the largest change in the factors is below this value
+    verbose: boolean
+
+    RETURNS
+    -------
+    Z: ndarray with the expectations of the factors, with dimensions (samples,factors)
+    Zvar: ndarray with the variances of the factors, with dimensions (samples,factors)
+    """
+    terms = getProjectionTerms(model)
+    EW, EWW, tau, lik = terms['EW'], terms['EWW'], terms['tau'], terms['likelihoods']
+
+    # Align the data with the features of the model, missing values are set to zero and excluded with the mask
+    Y, obs = {}, {}
+    for m in terms['views']:
+        if m not in data or data[m] is None: continue
+        X = data[m]
+        if isinstance(X, pd.DataFrame): X = X.reindex(columns=terms['features'][m]).values
+        X = np.array(X, dtype=np.float64)
+        assert X.ndim == 2 and X.shape[1] == EW[m].shape[0], "View %s has %d features instead of %d" % (m, X.shape[-1], EW[m].shape[0])
+        obs[m] = ~np.isnan(X)
+        X[~obs[m]] = 0.
+        Y[m] = X
+    assert len(Y) > 0, "None of the views of the model was found in the data"
+    assert len(set([ X.shape[0] for X in Y.values() ])) == 1, "All views must have the same number of samples"
+    N, K = list(Y.values())[0].shape[0], len(terms['covariates'])
+
+    # Initialise the factors, covariates are fixed (the intercept is the covariate that is one for all training samples)
+    Zmean, Zvar = np.zeros((N,K)), np.ones((N,K))
+    idx_covariates = np.where(terms['covariates'])[0]
+    intercept = np.all(terms['Zcov'] == 1., axis=0)
+    if (~intercept).sum() > 0:
+        assert covariates is not None, "Please specify the values of the covariates of the new samples"
+        covariates = np.asarray(covariates, dtype=np.float64).reshape(N,-1)
+        assert covariates.shape[1] == (~intercept).sum(), "The model has %d covariates (excluding the intercept)" % (~intercept).sum()
+        Zmean[:,idx_covariates[~intercept]] = covariates
+    Zmean[:,idx_covariates[intercept]] = 1.
+    Zvar[:,idx_covariates] = 0.
+    latent_variables = np.where(~terms['covariates'])[0]
+
+    # Precision of the noise of the gaussian and poisson views (masked)
+    T = { m:obs[m]*tau[m][None,:] for m in Y if lik[m] != "bernoulli" }
+
+    for i in range(maxiter):
+
+        # Update the pseudodata of the non-gaussian views
+        Yhat = {}
+        for m in Y:
+            if lik[m] == "gaussian":
+                Yhat[m] = Y[m]
+            elif lik[m] == "poisson":
+                zeta = np.dot(Zmean, EW[m].T)
+                Yhat[m] = zeta - sigmoid(zeta)*(1-Y[m]/np.logaddexp(0.,zeta))/tau[m][None,:]
+            elif lik[m] == "bernoulli":
+                zeta = np.sqrt( np.square(np.dot(Zmean, EW[m].T)) - np.dot(np.square(Zmean), np.square(EW[m]).T) + np.dot(np.square(Zmean)+Zvar, EWW[m].T) )
+                lam = np.where(zeta > 1e-8, lambdafn(np.maximum(zeta,1e-8)), 0.125)
+                Yhat[m] = (2.*Y[m] - 1.)/(4.*lam)
+                T[m] = obs[m]*2.*lam
+            else:
+                print("Likelihood %s not implemented for the projection" % lik[m])
+                exit()
+
+        # Update the factors one at a time, keeping the residuals up to date
+        Zold = Zmean.copy()
+        R = { m:Yhat[m] - np.dot(Zmean, EW[m].T) for m in Y }
+        for k in latent_variables:
+            foo = np.zeros(N)
+            bar = np.zeros(N)
+            for m in Y:
+                foo += np.dot(T[m], EWW[m][:,k])
+                bar += np.dot(T[m]*R[m], EW[m][:,k]) + Zmean[:,k]*np.dot(T[m], np.square(EW[m][:,k]))
+            Zvar[:,k] = 1./(1.+foo)
+            mean = Zvar[:,k]*bar
+            for m in Y:
+                R[m] -= np.outer(mean-Zmean[:,k], EW[m][:,k])
+            Zmean[:,k] = mean
+
+        delta = np.abs(Zmean-Zold).max()
+        if verbose: print("Projection, iteration %d: largest change in the factors=%.2e" % (i+1, delta))
+        if delta < tolerance: break
+
+    return Zmean, Zvar
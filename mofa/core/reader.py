@@ -0,0 +1,262 @@
+"""
+Module to read the models saved in hdf5 files (see saveModel in utils.py) without loading them in memory
+
+load: open a saved model
+ModelFile: a saved model, the matrices are read lazily when they are indexed
+LazyMatrix: a matrix in a saved model, only the requested slices are read (and cached)
+
+Example:
+    import mofa
+    model = mofa.load("model.hdf5")
+    model.views, model.samples, model.features["mRNA"], model.factors
+    model.Z[:,:3]                   # factors 0,1,2 of all samples
+    model.W["mRNA"][:,[0,4,7]]      # weights of factors 0,4,7 in the mRNA view
+    model.data["mRNA"][:10,:]       # training data of the first 10 samples
+    model.variance_explained["r2_per_factor"]   # variance explained by each factor in each view
+"""
+
+from __future__ import division
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import h5py
+
+class LRUCache(object):
+    """ Class to store the slices read from a file, removing the least recently used ones when the total size exceeds a limit """
+
+    def __init__(self, max_bytes):
+        """
+        PARAMETERS
+        ----------
+        max_bytes: int
+            maximum size of the cached arrays in bytes
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.items = OrderedDict()
+
+    def get(self, key):
+        if key not in self.items: return None
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        if value.nbytes > self.max_bytes: return
+        self.items[key] = value
+        self.nbytes += value.nbytes
+        while self.nbytes > self.max_bytes:
+            _, old = self.items.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def clear(self):
+        self.items.clear()
+        self.nbytes = 0
+
+def normaliseIndex(idx, n):
+    """ Method to convert an index along an axis of length n (int, slice, list of ints or boolean mask)
+    into the slice to read from the file and the positions to take from it
+
+    PARAMETERS
+    ----------
+    idx: int, slice, list or ndarray
+    n: int
+        length of the axis
+
+    RETURNS
+    -------
+    span: slice with the contiguous range to read
+    take: ndarray with the positions within the span (None to take all of them)
+    scalar: boolean indicating whether the axis has to be dropped
+    """
+    if isinstance(idx, slice):
+        start, stop, step = idx.indices(n)
+        if step == 1: return slice(start, max(start,stop)), None, False
+        idx = np.arange(start, stop, step)
+    elif np.isscalar(idx):
+        i = int(idx) + (n if int(idx) < 0 else 0)
+        assert 0 <= i < n, "Index %d is out of bounds for an axis of length %d" % (idx, n)
+        return slice(i, i+1), np.array([0]), True
+
+    idx = np.asarray(idx)
+    if idx.dtype == bool:
+        assert len(idx) == n, "Boolean index does not match the length of the axis"
+        idx = np.where(idx)[0]
+    idx = np.where(idx < 0, idx + n, idx).astype(int)
+    if len(idx) == 0: return slice(0,0), None, False
+    assert idx.min() >= 0 and idx.max() < n, "Index out of bounds for an axis of length %d" % n
+    return slice(int(idx.min()), int(idx.max())+1), idx - idx.min(), False
+
+class LazyMatrix(object):
+    """ Class to read slices of a dataset of a saved model. The datasets are stored transposed (as expected by the
+    R package), but they are indexed here in the original orientation: (samples,factors) for Z, (features,factors)
+    for W and (samples,features) for the data """
+
+    def __init__(self, model, path):
+        """
+        PARAMETERS
+        ----------
+        model: ModelFile
+        path: str
+            path of the dataset in the hdf5 file
+        """
+        self.model = model
+        self.path = path
+        dataset = model.file[path]
+        self.shape = dataset.shape[::-1]
+        self.dtype = dataset.dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        X = self[...]
+        return X if dtype is None else X.astype(dtype)
+
+    def __getitem__(self, key):
+        return self.read(key)
+
+    def read(self, key, cache=True):
+        """ Method to read a slice, only the contiguous range of the requested rows and columns is read from the file
+
+        PARAMETERS
+        ----------
+        key: index or tuple of indices (int, slice, list of ints or boolean mask) along each axis
+        cache: boolean
+            keep the slice in the cache? (disable it to stream over large matrices)
+        """
+        if key is Ellipsis: key = (slice(None),)*self.ndim
+        if not isinstance(key, tuple): key = (key,)
+        key = key + (slice(None),)*(self.ndim-len(key))
+        assert len(key) == self.ndim, "Too many indices"
+        idx = [ normaliseIndex(key[i], self.shape[i]) for i in range(self.ndim) ]
+
+        # Read the ranges from the file, or from the cache
+        spans = tuple([ (s.start, s.stop) for s,_,_ in idx ])
+        X = self.model.cache.get((self.path, spans)) if cache else None
+        if X is None:
+            X = self.model.file[self.path][tuple([ s for s,_,_ in idx ][::-1])].T
+            if cache:
+                X.setflags(write=False)
+                self.model.cache.put((self.path, spans), X)
+
+        # Take the requested positions within the ranges
+        for axis in range(self.ndim):
+            if idx[axis][1] is not None: X = X.take(idx[axis][1], axis=axis)
+        return X.squeeze(axis=tuple([ i for i in range(self.ndim) if idx[i][2] ])) if any([ i[2] for i in idx ]) else X
+
+class ModelFile(object):
+    """ Class to access a saved model, reading only the requested parts of the file """
+
+    def __init__(self, path, cache_size=2**28):
+        """
+        PARAMETERS
+        ----------
+        path: str
+            hdf5 file saved by saveModel
+        cache_size: int
+            maximum size in bytes of the slices that are kept in memory
+        """
+        self.path = path
+        self.file = h5py.File(path, "r")
+        self.cache = LRUCache(cache_size)
+        self._samples = None
+        self._features = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """ Method to close the file """
+        self.cache.clear()
+        self.file.close()
+
+    @property
+    def views(self):
+        """ Names of the views (in the order of the file) """
+        return list(self.file["expectations/SW"].keys())
+
+    @property
+    def samples(self):
+        """ Names of the samples """
+        if self._samples is None: self._samples = decode(self.file["samples"][()])
+        return self._samples
+
+    @property
+    def features(self):
+        """ Dictionary with the names of the features of each view """
+        if self._features is None: self._features = { m:decode(self.file["features"][m][()]) for m in self.file["features"] }
+        return self._features
+
+    @property
+    def factors(self):
+        """ Indices of the factors """
+        return list(range(self.file["expectations/Z"].shape[0]))
+
+    @property
+    def likelihoods(self):
+        """ Dictionary with the likelihood of each view """
+        return dict(zip(self.views, decode(self.file["model_opts/likelihood"][()])))
+
+    @property
+    def Z(self):
+        """ Expectations of the factors, with dimensions (samples,factors) """
+        return LazyMatrix(self, "expectations/Z")
+
+    @property
+    def W(self):
+        """ Dictionary with the expectations of the weights of each view, with dimensions (features,factors) """
+        return { m:LazyMatrix(self, "expectations/SW/%s" % m) for m in self.views }
+
+    @property
+    def data(self):
+        """ Dictionary with the training data of each view, with dimensions (samples,features) """
+        return { m:LazyMatrix(self, "data/%s" % m) for m in self.file["data"] }
+
+    @property
+    def training_stats(self):
+        """ Dictionary with the training statistics (elbo, elbo_terms and activeK) """
+        return { k:self.file["training_stats"][k][()] for k in self.file["training_stats"] }
+
+    @property
+    def variance_explained(self):
+        """ Dictionary with the variance explained by all the factors ('r2_total', a Series with one value per view) and by
+        each factor ('r2_per_factor', a DataFrame with dimensions (factors,views)), as calculated when the model was saved.
+        The intercept is not included in the factors. """
+        assert "variance_explained" in self.file, "The model was saved without the variance explained, please save it again"
+        grp = self.file["variance_explained"]
+        views, factors = decode(grp.attrs['views']), list(grp.attrs['factors'])
+        return { 'r2_total': pd.Series(grp["r2_total"][()], index=views),
+            'r2_per_factor': pd.DataFrame(grp["r2_per_factor"][()].T, index=factors, columns=views) }
+
+    def getExpectation(self, node, view=None):
+        """ Method to access the expectations of any node
+
+        PARAMETERS
+        ----------
+        node: str
+            name of the node (i.e. Z, SW, AlphaW, Theta, Tau, Y)
+        view: str
+            name of the view, for multi-view nodes
+        """
+        path = "expectations/%s" % node if view is None else "expectations/%s/%s" % (node, view)
+        return LazyMatrix(self, path)
+
+def decode(names):
+    """ Method to convert the names stored as bytes into strings """
+    return [ x.decode() if isinstance(x, bytes) else str(x) for x in names ]
+
+def load(path, cache_size=2**28):
+    """ Method to open a saved model, the file is kept open and its contents are read when they are accessed
+
+    PARAMETERS
+    ----------
+    path: str
+        hdf5 file saved by saveModel
+    cache_size: int
+        maximum size in bytes of the slices that are kept in memory
+    """
+    return ModelFile(path, cache_size=cache_size)
@@ -1,24 +1,27 @@
 """
 Module to simulate test data
 
+The data is generated in blocks of samples, so that large views can be written directly to memory-mapped
+.npy files or to hdf5 datasets without keeping them in memory (see generateView and writeData).
+The random numbers of each block of each view are drawn from their own generator, seeded from the seed of
+the simulation, the view and the block. Therefore, the data is reproducible for a given seed and block size,
+and the blocks can be generated in any order.
+
 To-do:
-- Currently non-gaussian likelihoods have no noise
 - Maybe integrate this into the corresponding Node classes with a Simulate() method?
 - Fix binomial
 """
 
 from __future__ import division
-import scipy as s
+import numpy as np
 import pandas as pd
-import warnings
-from scipy.stats import bernoulli, norm, gamma, uniform, poisson, binom
-from random import sample
 
-from .utils import sigmoid
+from .utils import sigmoid, blockSize
+from .imputation import openOutput
 
 
 class Simulate(object):
-    def __init__(self, M, N, D, K):
+    def __init__(self, M, N, D, K, seed=None):
         """General method to Simulate from the generative model
 
         PARAMETERS
@@ -27,6 +30,7 @@ class Simulate(object):
         N (int): number of samples
         D (list/tuple of length M): dimensionality of each view
         K (int): number of latent variables
+        seed (int): seed of the simulation (random by default)
         """
 
         # Sanity checks
@@ -38,25 +42,22 @@ class Simulate(object):
         self.N = N
         self.K = K
         self.D = D
+        self.seed = seed if seed is not None else int(np.random.SeedSequence().entropy % 2**32)
+        self.rng = np.random.default_rng(self.seed)
+
+    def blockGenerator(self, m, i):
+        """ Method to return the random number generator of the block of samples starting at i of view m """
+        return np.random.default_rng([self.seed, m, i])
 
     def initAlpha(self):
         """ Initialisation of ARD on the weights"""
-        alpha = [ s.zeros(self.K,) for m in range(self.M) ]
-        for m in range(self.M):
-            tmp = bernoulli.rvs(p=0.5, size=self.K)
-            tmp[tmp==1] = 1.
-            tmp[tmp==0] = 1E5
-            alpha[m] = tmp
-        return alpha
+        return [ np.where(self.rng.random(self.K) < 0.5, 1., 1E5) for m in range(self.M) ]
 
     def initW_ard(self, alpha=None):
         """ Initialisation of weights in automatic relevance determination prior"""
         if alpha is None:
             alpha = self.initAlpha()
-        W = [ s.zeros((self.D[m],self.K)) for m in range(self.M) ]
-        for m in range(self.M):
-            for k in range(self.K):
-                W[m][:,k] = norm.rvs(loc=0, scale=1/s.sqrt(alpha[m][k]), size=self.D[m])
+        W = [ self.rng.standard_normal((self.D[m],self.K)) / np.sqrt(alpha[m]) for m in range(self.M) ]
         return W,alpha
 
     def initW_spikeslab(self, theta, alpha=None):
@@ -69,135 +70,191 @@ class Simulate(object):
             assert not any([0 in a for a in alpha]), 'alpha cannot be zero'
 
         # Simulate bernoulli variable S
-        S = [ s.zeros((self.D[m],self.K)) for m in range(self.M) ]
-        for m in range(self.M):
-
-            # Completely vectorised, not sure if it works
-            # S[m] = bernoulli.rvs(p=theta[m].flatten(), size=self.D[m]*self.K).reshape((self.D[m],self.K))
-
-            # Partially vectorised
-            for k in range(self.K):
-                S[m][:,k] = bernoulli.rvs(p=theta[m][:,k], size=self.D[m])
-            
-            # Unvectorised
-            # for d in range(self.D[m]):
-            #     for k in range(self.K):
-            #         S[m][d,k] = bernoulli.rvs(p=theta[m][d,k], size=1)
-
+        S = [ (self.rng.random((self.D[m],self.K)) < theta[m]).astype(float) for m in range(self.M) ]
 
         # Simulate gaussian weights W
-        W_hat = [ s.empty((self.D[m],self.K)) for m in range(self.M) ]
-        W = [ s.empty((self.D[m],self.K)) for m in range(self.M) ]
-        for m in range(self.M):
-            for k in range(self.K):
-                W_hat[m][:,k] = norm.rvs(loc=0, scale=s.sqrt(1./alpha[m][k]), size=self.D[m])
-            W[m] = W_hat[m] * S[m]
+        W_hat = [ self.rng.standard_normal((self.D[m],self.K)) / np.sqrt(alpha[m]) for m in range(self.M) ]
+        W = [ W_hat[m] * S[m] for m in range(self.M) ]
 
         return S, W, W_hat, alpha
 
     def initZ(self):
         """ Initialisation of latent variables"""
-        Z = s.empty((self.N,self.K))
-        for n in range(self.N):
-            for k in range(self.K):
-                Z[n,k] = norm.rvs(loc=0, scale=1, size=1)
-        return Z
+        return self.rng.standard_normal((self.N,self.K))
 
     def initTau(self):
         """ Initialisation of noise precision"""
-        return [ uniform.rvs(loc=1,scale=3,size=self.D[m]) for m in range(self.M) ]
+        return [ self.rng.uniform(1., 4., size=self.D[m]) for m in range(self.M) ]
 
     def initMu(self):
         """ Initialisation of hyperprior means of latent variables"""
         # Means are initialised to zero by default
-        return [ s.zeros(self.D[m]) for m in range(self.M) ]
+        return [ np.zeros(self.D[m]) for m in range(self.M) ]
+
+    def missingSamples(self, missing_view=0.):
+        """ Initialisation of the structured missing values: samples that are missing a complete view
+
+        PARAMETERS
+        ----------
+        missing_view (float or list of length M): fraction of samples missing each view.
+            Each sample keeps at least one view
+
+        RETURNS
+        -------
+        boolean ndarray with dimensions (samples,views)
+        """
+        if np.isscalar(missing_view): missing_view = [missing_view]*self.M
+        missing = np.zeros((self.N,self.M), dtype=bool)
+        for m in range(self.M):
+            if missing_view[m] > 0.:
+                missing[self.rng.choice(self.N, size=int(missing_view[m]*self.N), replace=False),m] = True
+
+        # Samples missing all views keep a random view
+        empty = np.where(missing.all(axis=1))[0]
+        missing[empty, self.rng.integers(self.M, size=len(empty))] = False
+        return missing
 
-    def generateData(self, W, Z, Tau, Mu, likelihood, missingness=0.0, missing_view=False):
-        """ Initialisation of observations 
+    def generateBlock(self, m, i, n, W, Z, Tau, Mu, likelihood, missingness=0.0, missing_samples=None, sample=True):
+        """ Method to generate the observations of a block of samples of a view
 
         PARAMETERS
         ----------
+        m (int): index of the view
+        i (int): first sample of the block
+        n (int): number of samples of the block
         W (list of length M where each element is a np array with shape (Dm,K)): weights
         Z (np array with shape (N,K): latent variables
         Tau (list of length M where each element is a np array with shape (Dm,)): precision of the normally-distributed noise
         Mu (list of length M where each element is a np array with shape (Dm,)): feature-wise means
         likelihood (str): type of likelihood
-        missingness (float): percentage of missing values
+        missingness (float): probability of each value to be missing
+        missing_samples (boolean np array with shape (N,M)): samples missing a complete view (see missingSamples)
+        sample (bool): sample the non-gaussian observations? Otherwise the most likely values are used
         """
-
-        Y = [ s.zeros((self.N,self.D[m])) for m in range(self.M) ]
+        rng = self.blockGenerator(m, i)
+        F = np.dot(Z[i:i+n], W[m].T)
 
         if likelihood == "gaussian":
-            # Vectorised
-            for m in range(self.M):
-                Y[m] = s.dot(Z,W[m].T) + Mu[m] + norm.rvs(loc=0, scale=1/s.sqrt(Tau[m]), size=[self.N, self.D[m]])
-            # Non-vectorised, slow
-            # for m in range(self.M):
-                # for n in range(self.N):
-                    # for d in range(self.D[m]):
-                        # Y[m][n,d] = s.dot(Z[n,:],W[m][d,:].T) + Mu[m][d] + norm.rvs(loc=0,scale=1/s.sqrt(Tau[m][d]))
+            F += Mu[m] + rng.standard_normal(F.shape) / np.sqrt(Tau[m])
 
         elif likelihood == "warp":
-            for m in range(self.M):
-                Y[m] = s.exp(s.dot(Z,W[m].T) + Mu[m] + norm.rvs(loc=0, scale=1/s.sqrt(Tau[m]), size=[self.N, self.D[m]]))
-
+            F += Mu[m] + rng.standard_normal(F.shape) / np.sqrt(Tau[m])
+            np.exp(F, out=F)
 
         # Sample observations using a poisson likelihood
         elif likelihood == "poisson":
-            # Slow way
-            # for m in range(self.M):
-            #     for n in range(self.N):
-            #         for d in range(self.D[m]):
-            #             f = s.dot(Z[n,:],W[m][d,:].T)
-            #             # f = s.dot(Z[n,:],W[m][d,:].T) + norm.rvs(loc=0,scale=s.sqrt(1/Tau[m][d]))
-            #             rate = s.log(1+s.exp(f))
-            #             # Sample from the Poisson distribution
-            #             # Y[m][n,d] = poisson.rvs(rate)
-            #             # Use the more likely values
-            #             Y[m][n,d] = s.special.round(rate)
-
-            # Fast way
-            for m in range(self.M):
-                F = s.dot(Z,W[m].T)
-                # F = s.dot(Z,W[m].T) + norm.rvs(loc=0,scale=s.sqrt(1/Tau[m]))
-                rate = s.log(1+s.exp(F))
-                # Sample from the Poisson distribution
-                # MAYBE THIS REQUIRES RESHAPING
-                # Y[m] = poisson.rvs(rate)
-                # Use the more likely values
-                Y[m] = s.special.round(rate)
+            rate = np.logaddexp(0., F)
+            F = rng.poisson(rate).astype(float) if sample else np.round(rate)
 
         # Sample observations using a bernoulli likelihood
         elif likelihood == "bernoulli":
-            for m in range(self.M):
-                # for n in range(self.N):
-                    # for d in range(self.D[m]):
-                        # Without noise
-                        # f = sigmoid( s.dot(Z[n,:],W[m][d,:].T) )
-                        # With noise, problem: it shifts the sigmoid...
-                        # f = sigmoid( s.dot(Z[n,:],W[m][d,:].T) + norm.rvs(loc=0,scale=1/s.sqrt(Tau[m][d])) )
-
-                        # Sample from the Bernoulli distributionn
-                        # Y[m][n,d] = bernoulli.rvs(f)
-                        # Use the more likely state
-                        # Y[m][n,d] = s.special.round(f)
-                f = sigmoid( s.dot(Z,W[m].T) )
-                Y[m] = s.special.round(f)
+            f = sigmoid(F)
+            F = (rng.random(F.shape) < f).astype(float) if sample else np.round(f)
+
+        else:
+            print("Likelihood %s not implemented for the simulations" % likelihood)
+            exit()
 
         # Introduce missing values into the data
         if missingness > 0.0:
-            for m in range(self.M):
-                nas = s.random.choice(range(self.N*self.D[m]), size=int(missingness*self.N*self.D[m]), replace=False)
-                tmp = Y[m].flatten()
-                tmp[nas] = s.nan
-                Y[m] = tmp.reshape((self.N,self.D[m]))
-        if missing_view > 0.0:   # percentage of samples missing a view
-            # select samples missing one view
-            n_missing = s.random.choice(range(self.N), int(missing_view * self.N), replace=False)
-            Y[0][n_missing,:] = s.nan
+            F[rng.random(F.shape) < missingness] = np.nan
+        if missing_samples is not None:
+            F[missing_samples[i:i+n,m]] = np.nan
+
+        return F
+
+    def generateView(self, m, W, Z, Tau, Mu, likelihood, missingness=0.0, missing_samples=None, sample=True, out=None, dtype=np.float32, block=None):
+        """ Method to generate a view in blocks of samples
+
+        PARAMETERS
+        ----------
+        m (int): index of the view
+        W, Z, Tau, Mu, likelihood, missingness, missing_samples, sample: see generateBlock
+        out: None (new array), ndarray, path of a .npy file (memory-mapped) or path of an hdf5 dataset ('file.h5:/dataset')
+        dtype: type of the output
+        block (int): number of samples of each block (by default about 32MB per block)
+        """
+        if block is None: block = blockSize(self.D[m])
+        Y, handle = openOutput(out, (self.N,self.D[m]), dtype)
+        for i in range(0, self.N, block):
+            n = min(block, self.N-i)
+            Y[i:i+n] = self.generateBlock(m, i, n, W, Z, Tau, Mu, likelihood, missingness, missing_samples, sample)
+        if isinstance(Y, np.memmap): Y.flush()
+        if handle is not None: handle.close()
+        return Y if handle is None else out
+
+    def generateData(self, W, Z, Tau, Mu, likelihood, missingness=0.0, missing_view=0.0, sample=True):
+        """ Initialisation of observations
+
+        PARAMETERS
+        ----------
+        W (list of length M where each element is a np array with shape (Dm,K)): weights
+        Z (np array with shape (N,K): latent variables
+        Tau (list of length M where each element is a np array with shape (Dm,)): precision of the normally-distributed noise
+        Mu (list of length M where each element is a np array with shape (Dm,)): feature-wise means
+        likelihood (str or list of length M): type of likelihood of all the views or of each view
+        missingness (float): percentage of missing values
+        missing_view (float or list of length M): percentage of samples missing each view (see missingSamples)
+        sample (bool): sample the non-gaussian observations? Otherwise the most likely values are used
+        """
+        if isinstance(likelihood, str): likelihood = [likelihood]*self.M
+        missing_samples = self.missingSamples(missing_view) if np.any(np.asarray(missing_view) > 0.) else None
 
         # Convert data to pandas data frame
+        Y = [None]*self.M
         for m in range(self.M):
-            Y[m] = pd.DataFrame(data=Y[m])
+            Y[m] = self.generateView(m, W, Z, Tau, Mu, likelihood[m], missingness, missing_samples, sample, dtype=np.float64)
+            Y[m] = pd.DataFrame(data=Y[m], copy=False)
 
         return Y
+
+    def writeData(self, files, W, Z, Tau, Mu, likelihood, missingness=0.0, missing_view=0.0, sample=True, dtype=np.float32, block=None):
+        """ Method to write the observations of each view to a file, in blocks of samples
+
+        PARAMETERS
+        ----------
+        files (list of length M): .npy files or hdf5 datasets ('file.h5:/dataset') of each view
+        W, Z, Tau, Mu, likelihood, missingness, missing_view, sample: see generateData
+        dtype: type of the output
+        block (int): number of samples of each block
+        """
+        assert len(files) == self.M, "Please specify one file for each view"
+        if isinstance(likelihood, str): likelihood = [likelihood]*self.M
+        missing_samples = self.missingSamples(missing_view) if np.any(np.asarray(missing_view) > 0.) else None
+        for m in range(self.M):
+            self.generateView(m, W, Z, Tau, Mu, likelihood[m], missingness, missing_samples, sample, out=files[m], dtype=dtype, block=block)
+        return files
+
+def entry_point():
+    import argparse
+    p = argparse.ArgumentParser( description='Simulate data from the generative model of MOFA' )
+    p.add_argument( '--outFiles',     type=str, nargs='+', required=True,         help='Output file of each view: .npy (memory-mapped) or hdf5 (file.h5 or file.h5:/dataset)' )
+    p.add_argument( '--likelihoods',  type=str, nargs='+', required=True,         help='Likelihood of each view: gaussian, bernoulli or poisson' )
+    p.add_argument( '--N',            type=int, required=True,                    help='Number of samples' )
+    p.add_argument( '--D',            type=int, nargs='+', required=True,         help='Number of features of each view' )
+    p.add_argument( '--K',            type=int, default=10,                       help='Number of factors' )
+    p.add_argument( '--theta',        type=float, default=0.5,                    help='Fraction of non-zero weights' )
+    p.add_argument( '--missing',      type=float, default=0.,                     help='Fraction of missing values' )
+    p.add_argument( '--missingView',  type=float, default=0.,                     help='Fraction of samples missing each view' )
+    p.add_argument( '--mostLikely',   action='store_true',                        help='Use the most likely values of the non-gaussian views, instead of sampling them' )
+    p.add_argument( '--float64',      action='store_true',                        help='Save the data in double precision?' )
+    p.add_argument( '--truthFile',    type=str, default=None,                     help='Output file (.npz) with the simulated factors and weights' )
+    p.add_argument( '--seed',         type=int, default=None,                     help='Random seed' )
+    args = p.parse_args()
+
+    M = len(args.outFiles)
+    D = args.D*M if len(args.D) == 1 else args.D
+    likelihoods = args.likelihoods*M if len(args.likelihoods) == 1 else args.likelihoods
+    assert len(D) == M and len(likelihoods) == M, "Please specify the number of features and the likelihood of each view"
+
+    sim = Simulate(M=M, N=args.N, D=D, K=args.K, seed=args.seed)
+    S, W, W_hat, alpha = sim.initW_spikeslab(theta=[ args.theta*np.ones((D[m],args.K)) for m in range(M) ])
+    Z, Tau, Mu = sim.initZ(), sim.initTau(), sim.initMu()
+    sim.writeData(args.outFiles, W, Z, Tau, Mu, likelihoods, missingness=args.missing, missing_view=args.missingView,
+        sample=not args.mostLikely, dtype=np.float64 if args.float64 else np.float32)
+    if args.truthFile is not None:
+        np.savez(args.truthFile, Z=Z, seed=sim.seed, **dict([ ("W%d" % m, W[m]) for m in range(M) ] + [ ("Tau%d" % m, Tau[m]) for m in range(M) ]))
+    print("Simulated %d samples and %d views with seed %d" % (args.N, M, sim.seed))
+
+if __name__ == '__main__':
+    entry_point()
@@ -0,0 +1,340 @@
+"""
+Module to select the hyperparameters of a model with a sweep over a grid of configurations
+
+The data is read once and processed once for each set of likelihoods (the processing depends on the likelihoods),
+and the configurations are trained in a pool of worker processes that receive the processed data when they start.
+Configurations are warm-started from the trained state of their neighbour with the next higher number of factors
+(and the same likelihoods, dropR2 and startSparsity): the factors that explain more variance in the neighbour
+initialise the factors, weights, ARD precisions and noise precisions of the new model. Configurations without
+a neighbour (the highest number of factors) start from a random initialisation and run first.
+
+runSweep: train the configurations of a grid and return a table with the final ELBO, number of factors and runtime
+entry_point: command line interface (mofa-sweep), with the options of mofa and the values of the grid
+
+Example:
+    mofa-sweep --inFiles view0.txt view1.txt --views A B --likelihoods gaussian gaussian --outFile sweep.tsv \
+        --sweepFactors 5 10 20 --sweepDropR2 none 0.01 --sweepLikelihoods gaussian,gaussian gaussian,bernoulli --sweepWorkers 4
+"""
+
+from __future__ import division
+import contextlib
+import copy
+import itertools
+import multiprocessing
+import os
+import sys
+from time import time, sleep
+import numpy as np
+import pandas as pd
+
+from .init_asd import getParser, getDataOpts, setCovariates, getModelOpts, getTrainOpts
+from .build_model import runSingleTrial
+from .utils import readData, processData, removeIncompleteSamples, saveModel, calculateVarianceExplained, mmapDirectory, removeViews, releaseView
+
+SWEEP_KEYS = ["likelihoods", "factors", "dropR2", "startSparsity"]
+
+# Data and options shared by the configurations of a sweep, set in each worker when it starts (see setupSweep)
+_sweep = {}
+
+def sweepConfigurations(grid):
+    """ Method to define the configurations of a grid and the neighbour that each configuration is warm-started from
+
+    PARAMETERS
+    ----------
+    grid: dic
+        lists of values of each key of SWEEP_KEYS, all their combinations are trained (the likelihoods are lists with
+        the likelihood of each view)
+
+    RETURNS
+    -------
+    list of dictionaries with the values of the configuration, its 'id' and the 'parent' configuration (None for cold starts),
+    sorted so that the parents come before their children
+    """
+    values = [ [ tuple(x) for x in grid["likelihoods"] ] ] + [ grid[k] for k in SWEEP_KEYS[1:] ]
+    configs = [ dict(zip(SWEEP_KEYS, x)) for x in itertools.product(*values) ]
+    configs.sort(key=lambda c: -c["factors"])
+    for i, c in enumerate(configs): c["id"] = i
+    for c in configs:
+        higher = [ p for p in configs if p["factors"] > c["factors"] and all([ p[k] == c[k] for k in SWEEP_KEYS if k != "factors" ]) ]
+        c["parent"] = min(higher, key=lambda p: p["factors"])["id"] if len(higher) > 0 else None
+    return configs
+
+def setupSweep(data, data_opts, args, covariates=None, verbose=False):
+    """ Method to store the data and the options shared by the configurations (the initializer of the workers)
+
+    PARAMETERS
+    ----------
+    data: dic
+        processed data (list of DataFrames) of each set of likelihoods
+    data_opts: dic
+        data options of each set of likelihoods
+    args: argparse.Namespace
+        options of the model and the training (see init_asd.getParser)
+    covariates: ndarray
+        matrix of covariates with dimensions (samples,covariates)
+    verbose: boolean
+        show the output of the training?
+    """
+    _sweep.update(data=data, data_opts=data_opts, args=args, covariates=covariates, verbose=verbose)
+
+def trainedState(net, intercept=False):
+    """ Method to collect the state of a trained model that is used to warm-start other configurations
+
+    The active covariates are kept first, followed by the active factors sorted by their variance explained
+    (summed over the views)
+
+    PARAMETERS
+    ----------
+    net: BayesNet
+    intercept: boolean
+        is the first factor an intercept?
+    """
+    nodes = net.getNodes()
+    Z = nodes["Z"]
+    covariates = [ k for k in range(net.dim["K"]) if Z.covariates[k] and net.active[k] ]
+    factors = list(Z.getLvIndex())
+
+    # Variance explained by each factor (the intercept is excluded from the r2 of calculateVarianceExplained)
+    Zexp, W, Y = Z.getExpectation(), [ e["E"] for e in nodes["SW"].getExpectations() ], nodes["Y"].getExpectation()
+    r2 = sum([ calculateVarianceExplained(Zexp, W[m], Y[m], intercept=intercept)['r2_per_factor'] for m in range(len(W)) ])
+    factors.sort(key=lambda k: -r2[k-int(intercept)])
+    idx = covariates + factors
+
+    Zq = Z.Q.getParameters()
+    SW = [ nodes["SW"].getNodes()[m].Q.getParameters() for m in range(len(W)) ]
+    Tau = [ nodes["Tau"].getNodes()[m] for m in range(len(W)) ]
+    return { 'covariates':len(covariates),
+        'Z':{ 'mean':np.array(Zq['mean'][:,idx]), 'var':np.array(Zq['var'][:,idx]) },
+        'SW':[ { k:np.array(SW[m][k][:,idx]) for k in ['mean_S1', 'var_S1', 'theta'] } for m in range(len(W)) ],
+        'AlphaW':[ np.array(e[idx]) for e in nodes["AlphaW"].getExpectation() ],
+        'Tau':[ np.array(Tau[m].getExpectation()) if hasattr(Tau[m], "Q") else None for m in range(len(W)) ] }
+
+def warmStart(model_opts, state, N, seed=None):
+    """ Method to initialise a model from the state of a trained model (see trainedState)
+
+    The covariates and the first factors of the new model are initialised from the state, the remaining factors
+    (if the state has less factors than the new model) are initialised as usual
+
+    PARAMETERS
+    ----------
+    model_opts: dic
+        model options (see init_asd.getModelOpts), the initialisations are modified in place
+    state: dic
+        state of a trained model with the same data and covariates
+    N: int
+        number of samples
+    seed: int
+        seed of the random initialisation of the remaining factors
+    """
+    K = model_opts['k']
+    M = len(model_opts['likelihood'])
+    C = state['covariates']
+    assert np.isnan(model_opts["priorZ"]["var"]).sum() == C, "The covariates of the state do not match the covariates of the model"
+    n = min(K, state['Z']['mean'].shape[1])
+
+    # Latent variables
+    mean = np.random.default_rng(seed).standard_normal((N,K))
+    var = np.ones((N,K)) * model_opts["initZ"]["var"]
+    mean[:,:n], var[:,:n] = state['Z']['mean'][:,:n], state['Z']['var'][:,:n]
+    model_opts["initZ"]["mean"], model_opts["initZ"]["var"] = mean, var
+
+    for m in range(M):
+        # Weights (theta is a new array because the initialisation of SW shares it with the one of Theta)
+        model_opts["initSW"]["mean_S1"][m][:,:n] = state['SW'][m]['mean_S1'][:,:n]
+        model_opts["initSW"]["var_S1"][m][:,:n] = state['SW'][m]['var_S1'][:,:n]
+        model_opts["initSW"]["Theta"][m] = model_opts["initSW"]["Theta"][m].copy()
+        model_opts["initSW"]["Theta"][m][:,:n] = state['SW'][m]['theta'][:,:n]
+
+        # ARD precision of the weights and precision of the noise
+        model_opts["initAlphaW"]["E"][m][:n] = state['AlphaW'][m][:n]
+        if state['Tau'][m] is not None and model_opts['likelihood'][m] == "gaussian":
+            model_opts["initTau"]["E"][m] = state['Tau'][m].copy()
+
+def trainConfiguration(config, state=None, outfile=None):
+    """ Method to train a configuration of the sweep, it is meant to run in a worker (see setupSweep)
+
+    PARAMETERS
+    ----------
+    config: dic
+        configuration (see sweepConfigurations)
+    state: dic
+        state of the trained parent configuration to warm-start from (None for a random initialisation)
+    outfile: str
+        if given, the model is saved in this hdf5 file
+
+    RETURNS
+    -------
+    dictionary with the configuration and the results, and the state of the trained model (see trainedState)
+    """
+    key = config["likelihoods"]
+    args = copy.copy(_sweep["args"])
+    args.likelihoods, args.factors, args.dropR2, args.startSparsity = list(key), config["factors"], config["dropR2"], config["startSparsity"]
+    args.ntrials = 1
+    data = _sweep["data"][key]
+    data_opts = copy.deepcopy(_sweep["data_opts"][key])
+    data_opts["outfile"] = outfile
+    N = data[0].shape[0]
+
+    # Covariates, model and training options as in the command line (the covariates are modified by the initialisation)
+    covariates = _sweep["covariates"].copy() if _sweep["covariates"] is not None else None
+    setCovariates(args, data_opts, N, covariates=covariates)
+    model_opts = getModelOpts(args, data, data_opts)
+    train_opts = getTrainOpts(args)
+    if state is not None:
+        warmStart(model_opts, state, N, seed=args.seed)
+
+    t = time()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stdout if _sweep["verbose"] else devnull):
+        net = runSingleTrial(data, data_opts, model_opts, train_opts, seed=args.seed)
+        if outfile is not None:
+            saveModel(net, outfile=outfile, train_opts=train_opts, model_opts=model_opts, view_names=data_opts['view_names'],
+                sample_names=data[0].index.tolist(), feature_names=[ Y.columns.tolist() for Y in data ], storage=data_opts.get('storage'))
+    runtime = time()-t
+
+    stats = net.getTrainingStats()
+    elbo = stats["elbo"][~np.isnan(stats["elbo"])]
+    result = { 'id':config["id"], 'likelihoods':",".join(key), 'factors':config["factors"], 'dropR2':config["dropR2"],
+        'startSparsity':config["startSparsity"], 'warm_start':config["parent"] if state is not None else None,
+        'elbo':float(elbo[-1]) if len(elbo) > 0 else np.nan, 'K':len(net.getNodes()["Z"].getLvIndex()),
+        'iterations':len(stats["time"]), 'converged':bool(len(stats["time"]) < train_opts["maxiter"]),
+        'time':runtime, 'outfile':outfile }
+    return result, trainedState(net, intercept=args.learnIntercept)
+
+def runSweep(views, data_opts, args, grid, workers=1, warm=True, outfile=None, save=False, covariates=None, verbose=False):
+    """ Method to train the configurations of a grid
+
+    PARAMETERS
+    ----------
+    views: list
+        list with the [data, sample names, feature names] of each view, as read by utils.readData
+    data_opts: dic
+    args: argparse.Namespace
+        options of the model and the training that are shared by all the configurations (see init_asd.getParser)
+    grid: dic
+        values of each key of SWEEP_KEYS (see sweepConfigurations)
+    workers: int
+        number of configurations trained at the same time
+    warm: boolean
+        warm-start the configurations from their neighbours?
+    outfile: str
+        file of the summary table (tab-separated)
+    save: boolean
+        save the model of each configuration in <outfile without extension>_<id>.hdf5?
+    covariates: ndarray
+        matrix of covariates with dimensions (samples,covariates)
+    verbose: boolean
+        show the output of the training?
+
+    RETURNS
+    -------
+    DataFrame with one row per configuration: the values of the configuration, the configuration it was warm-started from,
+    the final ELBO, the number of active factors (K), the number of iterations and the runtime in seconds
+    """
+    configs = sweepConfigurations(grid)
+
+    # The data is processed once for each set of likelihoods, the read-only views are not modified by the processing
+    # (memory-mapped copies of each set are kept in their own subdirectory of the temporary directory of the run, which
+    # is removed at the end of the sweep together with the raw views, see utils.mmapDirectory)
+    data, opts = {}, {}
+    for key in sorted(set([ c["likelihoods"] for c in configs ])):
+        tmp = copy.copy(args)
+        tmp.likelihoods = list(key)
+        opts[key] = getDataOpts(tmp)
+        opts[key]['mmap_dir'] = os.path.join(mmapDirectory(data_opts['mmap_dir']), "_".join(key)) if data_opts.get('mmap_dir') is not None else None
+        parsed = []
+        for Y, samples, features in views:
+            Y = Y.view()
+            Y.setflags(write=False)
+            parsed.append([Y, samples, features])
+        data[key] = processData(parsed, opts[key], threads=args.loadThreads, release=False)
+        if opts[key]['RemoveIncompleteSamples']:
+            data[key] = removeIncompleteSamples(data[key])
+
+    # The raw views are not needed once all the sets are processed
+    for Y, _, _ in views: releaseView(Y)
+
+    def configFile(c):
+        return "%s_%d.hdf5" % (os.path.splitext(outfile)[0], c["id"]) if save and outfile is not None else None
+
+    print("\nTraining %d configurations with %d worker(s)...\n" % (len(configs), workers))
+    results, states = {}, {}
+    def report(result):
+        print("Configuration %d: likelihoods=%s, factors=%d, dropR2=%s, startSparsity=%d%s: ELBO=%.2f, K=%d, iterations=%d, time=%.2fs" %
+            (result['id'], result['likelihoods'], result['factors'], result['dropR2'], result['startSparsity'],
+            " (warm start from %d)" % result['warm_start'] if result['warm_start'] is not None else "",
+            result['elbo'], result['K'], result['iterations'], result['time']))
+        sys.stdout.flush()
+
+    try:
+        # Sequential sweep in this process
+        if workers <= 1:
+            setupSweep(data, opts, args, covariates, verbose)
+            for c in configs:
+                state = states.get(c["parent"]) if warm else None
+                results[c["id"]], states[c["id"]] = trainConfiguration(c, state, configFile(c))
+                report(results[c["id"]])
+
+        # Parallel sweep: each configuration is submitted when the state of its parent is available
+        else:
+            pool = multiprocessing.Pool(workers, initializer=setupSweep, initargs=(data, opts, args, covariates, verbose))
+            pending, running = list(configs), {}
+            try:
+                while len(pending) > 0 or len(running) > 0:
+                    for c in list(pending):
+                        if warm and c["parent"] is not None and c["parent"] not in states: continue
+                        state = states.get(c["parent"]) if warm else None
+                        running[c["id"]] = pool.apply_async(trainConfiguration, (c, state, configFile(c)))
+                        pending.remove(c)
+                    done = [ i for i in running if running[i].ready() ]
+                    for i in done:
+                        results[i], states[i] = running.pop(i).get()
+                        report(results[i])
+                    if len(done) == 0: sleep(0.05)
+            finally:
+                pool.terminate()
+                pool.join()
+
+    finally:
+        # Remove the memory-mapped copies of the data once all the configurations are trained
+        if data_opts.get('mmap_dir') is not None: removeViews(data_opts['mmap_dir'])
+
+    table = pd.DataFrame([ results[c["id"]] for c in configs ]).sort_values("id")
+    table["warm_start"] = table["warm_start"].astype("Int64")
+    if outfile is not None:
+        table.to_csv(outfile, sep="\t", index=False)
+        print("\nSummary of the sweep written in %s" % outfile)
+    return table
+
+def optionalFloat(x):
+    """ Method to parse a float that can be 'none' """
+    return None if x.lower() == "none" else float(x)
+
+def entry_point():
+    p = getParser()
+    p.description = 'Hyperparameter sweep of MOFA: --outFile is the summary table (tab-separated)'
+    p.add_argument( '--sweepFactors',       type=int, nargs='+', default=None,           help='Initial numbers of factors (default: --factors)' )
+    p.add_argument( '--sweepDropR2',        type=optionalFloat, nargs='+', default=None, help='Thresholds to drop factors, none to keep all of them (default: --dropR2)' )
+    p.add_argument( '--sweepStartSparsity', type=int, nargs='+', default=None,           help='Iterations to activate the spike-and-slab (default: --startSparsity)' )
+    p.add_argument( '--sweepLikelihoods',   type=str, nargs='+', default=None,           help='Sets of likelihoods, with the likelihood of each view separated by commas, i.e. gaussian,gaussian gaussian,bernoulli (default: --likelihoods)' )
+    p.add_argument( '--sweepWorkers',       type=int, default=1,                         help='Number of configurations trained at the same time' )
+    p.add_argument( '--noWarmStart',        action='store_true',                         help='Start all the configurations from a random initialisation?' )
+    p.add_argument( '--saveModels',         action='store_true',                         help='Save the model of each configuration in <outFile without extension>_<configuration>.hdf5' )
+    args = p.parse_args()
+
+    grid = { 'factors':args.sweepFactors if args.sweepFactors is not None else [args.factors],
+        'dropR2':args.sweepDropR2 if args.sweepDropR2 is not None else [args.dropR2],
+        'startSparsity':args.sweepStartSparsity if args.sweepStartSparsity is not None else [args.startSparsity],
+        'likelihoods':[ x.split(",") for x in args.sweepLikelihoods ] if args.sweepLikelihoods is not None else [args.likelihoods] }
+    for lik in grid['likelihoods']:
+        assert len(lik) == len(args.inFiles), "Please specify one likelihood for each view in each set of likelihoods"
+
+    # Read the data and the covariates once
+    data_opts = getDataOpts(args)
+    views = readData(data_opts, threads=args.loadThreads)
+    covariates = pd.read_csv(args.covariatesFile, delimiter=" ", header=None).values if args.covariatesFile is not None else None
+
+    runSweep(views, data_opts, args, grid, workers=args.sweepWorkers, warm=not args.noWarmStart, outfile=args.outFile,
+        save=args.saveModels, covariates=covariates, verbose=args.verbose)
+
+if __name__ == '__main__':
+    entry_point()
@@ -92,33 +92,38 @@ class Tau_Node(Gamma_Unobserved_Variational_Node):
     def updateParameters(self):
 
         # Collect expectations from other nodes
-        Y = self.markov_blanket["Y"].getExpectation().copy()
-        tmp = self.markov_blanket["SW"].getExpectations()
-        SW,SWW = tmp["E"], tmp["ESWW"]
-        Ztmp = self.markov_blanket["Z"].getExpectations()
-        Z,ZZ = Ztmp["E"],Ztmp["E2"]
-        mask = ma.getmask(Y)
+        Yexp = self.markov_blanket["Y"].getExpectation()
+        SWnode = self.markov_blanket["SW"]
+        mask = ma.getmask(Yexp)
 
         # Collect parameters from the P and Q distributions of this node
         P,Q = self.P.getParameters(), self.Q.getParameters()
         Pa, Pb = P['a'], P['b']
 
-        # Mask matrices
-        Y = Y.data
+        # Mask matrices (using preallocated buffers from the workspace)
+        Y, tmp = self.getBuffer("Y", Yexp.shape), self.getBuffer("tmp", Yexp.shape)
+        np.copyto(Y, ma.getdata(Yexp))
         Y[mask] = 0.
 
         # Calculate terms for the update
         # term1 = s.square(Y).sum(axis=0).data # not checked numerically with or without mask
-        term1 = s.square(Y).sum(axis=0)
+        term1 = s.square(Y, out=tmp).sum(axis=0)
 
         # term2 = 2.*(Y*s.dot(Z,SW.T)).sum(axis=0).data
-        term2 = 2.*(Y*s.dot(Z,SW.T)).sum(axis=0) # save to modify
-
-        term3 = ma.array(ZZ.dot(SWW.T), mask=mask).sum(axis=0)
+        ZW = SWnode.getProduct("ZW")
+        term2 = 2.*s.multiply(Y, ZW, out=tmp).sum(axis=0) # save to modify
 
-        SWZ = ma.array(SW.dot(Z.T), mask=mask.T)
+        SWnode.getProduct("E2", out=tmp)
+        tmp[mask] = 0.
+        term3 = tmp.sum(axis=0)
 
-        term4 = dotd(SWZ, SWZ.T) - ma.array(s.dot(s.square(Z),s.square(SW).T), mask=mask).sum(axis=0)
+        # term4 = dotd(SWZ, SWZ.T) - ma.array(ZZWW, mask=mask).sum(axis=0)
+        s.square(ZW, out=tmp)
+        tmp[mask] = 0.
+        term4 = tmp.sum(axis=0)
+        SWnode.getProduct("ZZWW", out=tmp)
+        tmp[mask] = 0.
+        term4 -= tmp.sum(axis=0)
 
         tmp = term1 - term2 + term3 + term4
 
@@ -175,6 +180,11 @@ class AlphaW_Node_mk(Gamma_Unobserved_Variational_Node):
         Pa, Pb, Qa, Qb = P['a'], P['b'], Q['a'], Q['b']
         QE, QlnE = self.Q.getExpectations()['E'], self.Q.getExpectations()['lnE']
 
+        # Inactive factors do not contribute to the lower bound
+        active = self.getActiveFactors()
+        if not active.all():
+            Pa, Pb, Qa, Qb, QE, QlnE = [ x[active] if s.ndim(x) > 0 else x for x in (Pa, Pb, Qa, Qb, QE, QlnE) ]
+
         # Do the calculations
         lb_p = (Pa*s.log(Pb)).sum() - special.gammaln(Pa).sum() + ((Pa-1.)*QlnE).sum() - (Pb*QE).sum()
         lb_q = (Qa*s.log(Qb)).sum() - special.gammaln(Qa).sum() + ((Qa-1.)*QlnE).sum() - (Qb*QE).sum()
@@ -191,58 +201,86 @@ class SW_Node(BernoulliGaussian_Unobserved_Variational_Node):
     def precompute(self):
         self.D = self.dim[0]
         self.factors_axis = 1
+        self.products = {}
+        self.products_version = None
+
+    def getProduct(self, name, out=None):
+        # Method to return a (N,D) product of the expectations of Z and SW, shared by all the nodes of the view.
+        # Products are computed once and cached until the expectations of either Z or SW change:
+        #   'ZW': E[Z]E[SW]' (linear predictor)
+        #   'ZZWW': E[Z]^2 E[SW]^2'
+        #   'E2': E[Z^2]E[(SW)^2]'
+        # The returned arrays are shared and must not be modified in place. The products that are used once per
+        # iteration (ZZWW and E2) are written into 'out' instead, and are not cached, so that only the linear
+        # predictor stays in memory between the updates
+        Z = self.markov_blanket["Z"]
+        if self.products_version != (Z.version, self.version):
+            self.products = {}
+            self.products_version = (Z.version, self.version)
+        if name in self.products:
+            if out is None: return self.products[name]
+            np.copyto(out, self.products[name])
+            return out
+        Zexp, SWexp = Z.getExpectations(), self.getExpectations()
+        if name == "ZW":
+            product = s.dot(Zexp["E"], SWexp["E"].T, out=out)
+        elif name == "ZZWW":
+            product = s.dot(s.square(Zexp["E"]), s.square(SWexp["E"]).T, out=out)
+        elif name == "E2":
+            product = s.dot(Zexp["E2"], SWexp["ESWW"].T, out=out)
+        if out is None: self.products[name] = product
+        return product
 
     def updateParameters(self):
         # Collect expectations from other nodes
         Ztmp = self.markov_blanket["Z"].getExpectations()
         Z,ZZ = Ztmp["E"],Ztmp["E2"]
-        tau = self.markov_blanket["Tau"].getExpectation().copy()
-        Y = self.markov_blanket["Y"].getExpectation().copy()
-        alpha = self.markov_blanket["Alpha"].getExpectation().copy()
+        tauexp = self.markov_blanket["Tau"].getExpectation()
+        Yexp = self.markov_blanket["Y"].getExpectation()
+        alpha = self.markov_blanket["Alpha"].getExpectation()
         thetatmp = self.markov_blanket['Theta'].getExpectations()
         theta_lnE, theta_lnEInv  = thetatmp['lnE'], thetatmp['lnEInv']
-        mask = ma.getmask(Y)
+        mask = ma.getmask(Yexp)
 
         # Collect parameters and expectations from P and Q distributions of this node
         SW = self.Q.getExpectations()["E"]
         Q = self.Q.getParameters()
         Qmean_S1, Qvar_S1, Qtheta = Q['mean_S1'], Q['var_S1'], Q['theta']
 
-        # Check dimensions of Theta and and expand if necessary
-        if theta_lnE.shape != Qmean_S1.shape:
-            theta_lnE = s.repeat(theta_lnE[None,:],Qmean_S1.shape[0],0)
-        if theta_lnEInv.shape != Qmean_S1.shape:
-            theta_lnEInv = s.repeat(theta_lnEInv[None,:],Qmean_S1.shape[0],0)
-
-        # Check dimensions of Tau and and expand if necessary
-        if tau.shape != Y.shape:
-            tau = s.repeat(tau[None,:], Y.shape[0], axis=0)
-        # tau = ma.masked_where(ma.getmask(Y), tau)
+        # Collect preallocated buffers from the workspace
+        Y = self.getBuffer("Y", Yexp.shape)
+        tmp = self.getBuffer("tmp", Yexp.shape)
 
-        # Check dimensions of Alpha and and expand if necessary
-        if alpha.shape[0] == 1:
-            alpha = s.repeat(alpha[:], self.dim[1], axis=0)
+        # Difference of the log expectations of Theta, (D,K) or (1,K) if it is the same for all the features
+        theta_diff = s.atleast_2d(theta_lnE - theta_lnEInv)
 
-        # Mask matrices
-        Y = Y.data
+        # Mask matrices. The precision of the noise is not expanded to (N,D) (see Node.getPrecisionWeights)
+        np.copyto(Y, ma.getdata(Yexp))
         Y[mask] = 0.
-        tau[mask] = 0.
+        tau, weights = self.getPrecisionWeights(tauexp, mask, Yexp.shape)
+
+        # Terms of all the factors that only depend on Z: (tau*Y)'Z and tau*ZZ (summed over the observed samples)
+        tauYZ = s.dot((Y if weights is None else s.multiply(weights, Y, out=tmp)).T, Z) * tau[:,None]
+        tauZZ = (ZZ.sum(axis=0)[None,:] if weights is None else s.dot(weights.T, ZZ)) * tau[:,None]
 
-        # Update each latent variable in turn
-        for k in range(self.dim[1]):
+        # ARD precision of each factor (a single precision shared by all the factors is broadcast without copying it)
+        alpha = s.broadcast_to(alpha, (self.dim[1],))
+
+        # Update each latent variable in turn (inactive factors are not updated)
+        for k in s.where(self.getActiveFactors())[0]:
 
             # Calculate intermediate steps
-            term1 = (theta_lnE-theta_lnEInv)[:,k]
+            term1 = theta_diff[:,k]
             term2 = 0.5*s.log(alpha[k])
             # term3 = 0.5*s.log(ma.dot(ZZ[:,k],tau) + alpha[k])
-            term3 = 0.5*s.log(s.dot(ZZ[:,k],tau) + alpha[k]) # good to modify
+            term4_tmp3 = tauZZ[:,k] + alpha[k]
+            term3 = 0.5*s.log(term4_tmp3)
             # term4_tmp1 = ma.dot((tau*Y).T,Z[:,k]).data
-            term4_tmp1 = s.dot((tau*Y).T,Z[:,k]) # good to modify
+            term4_tmp1 = tauYZ[:,k]
             # term4_tmp2 = ( tau * s.dot((Z[:,k]*Z[:,s.arange(self.dim[1])!=k].T).T, SW[:,s.arange(self.dim[1])!=k].T) ).sum(axis=0)
-            term4_tmp2 = ( tau * s.dot((Z[:,k]*Z[:,s.arange(self.dim[1])!=k].T).T, SW[:,s.arange(self.dim[1])!=k].T) ).sum(axis=0) # good to modify
-
-            term4_tmp3 = ma.dot(ZZ[:,k].T,tau) + alpha[k]
-            # term4_tmp3 = s.dot(ZZ[:,k].T,tau) + alpha[k] # good to modify (I REPLACE MA.DOT FOR S.DOT, IT SHOULD BE SAFE )
+            s.dot((Z[:,k]*Z[:,s.arange(self.dim[1])!=k].T).T, SW[:,s.arange(self.dim[1])!=k].T, out=tmp)
+            if weights is not None: s.multiply(weights, tmp, out=tmp)
+            term4_tmp2 = tau * tmp.sum(axis=0)
 
             # term4 = 0.5*s.divide((term4_tmp1-term4_tmp2)**2,term4_tmp3)
             term4 = 0.5*s.divide(s.square(term4_tmp1-term4_tmp2),term4_tmp3) # good to modify, awsnt checked numerically
@@ -258,8 +296,8 @@ class SW_Node(BernoulliGaussian_Unobserved_Variational_Node):
             # Update Expectations for the next iteration
             SW[:,k] = Qtheta[:,k] * Qmean_S1[:,k]
 
-        # Save updated parameters of the Q distribution
-        self.Q.setParameters(mean_S0=s.zeros((self.D,self.dim[1])), var_S0=s.repeat(1./alpha[None,:],self.D,0), mean_S1=Qmean_S1, var_S1=Qvar_S1, theta=Qtheta )
+        # Save updated parameters of the Q distribution (the spike is shared by all features)
+        self.Q.setParameters(mean_S0=s.zeros(self.dim[1]), var_S0=1./alpha, mean_S1=Qmean_S1, var_S1=Qvar_S1, theta=Qtheta )
 
     def calculateELBO(self):
 
@@ -271,17 +309,22 @@ class SW_Node(BernoulliGaussian_Unobserved_Variational_Node):
 
         # Get ARD sparsity or prior variance
         if "Alpha" in self.markov_blanket:
-            alpha = self.markov_blanket['Alpha'].getExpectations().copy()
-            if alpha["E"].shape[0] == 1:
-                alpha["E"] = s.repeat(alpha["E"][:], self.dim[1], axis=0)
-                alpha["lnE"] = s.repeat(alpha["lnE"][:], self.dim[1], axis=0)
+            alpha = self.markov_blanket['Alpha'].getExpectations()
+            alpha = { k:s.broadcast_to(alpha[k], (self.dim[1],)) for k in ("E","lnE") }
         else:
             print("Not implemented")
             exit()
 
+        # Inactive factors do not contribute to the lower bound
+        active = self.getActiveFactors()
+        if not active.all():
+            S, WW, Qvar = S[:,active], WW[:,active], Qvar[:,active]
+            alpha = { k:v[active] for k,v in alpha.items() }
+            theta = { k:v[...,active] for k,v in theta.items() }
+
         # Calculate ELBO for W
         lb_pw = (self.D*alpha["lnE"].sum() - s.sum(alpha["E"]*WW))/2.
-        lb_qw = -0.5*self.dim[1]*self.D - 0.5*(S*s.log(Qvar) + (1.-S)*s.log(1./alpha["E"])).sum() # IS THE FIRST CONSTANT TERM CORRECT???
+        lb_qw = -0.5*active.sum()*self.D - 0.5*(S*s.log(Qvar) + (1.-S)*s.log(1./alpha["E"])).sum() # IS THE FIRST CONSTANT TERM CORRECT???
         lb_w = lb_pw - lb_qw
 
         # Calculate ELBO for S
@@ -350,7 +393,9 @@ class Theta_Node(Beta_Unobserved_Variational_Node):
         lb_q = (Qa-1.)*QlnE + (Qb-1.)*QlnEInv - special.betaln(Qa,Qb)
         lb_q[np.isnan(lb_q)] = 0
 
-        return lb_p.sum() - lb_q.sum()
+        # Inactive factors do not contribute to the lower bound
+        active = self.getActiveFactors()
+        return lb_p[active].sum() - lb_q[active].sum()
 
 class Theta_Constant_Node(Constant_Variational_Node):
     """
@@ -362,6 +407,9 @@ class Theta_Constant_Node(Constant_Variational_Node):
         self.precompute()
 
     def precompute(self):
+        # The value is kept as (1,K) if it is the same for all the features, which broadcasts to the dimensions of the node
+        if self.value.shape[0] > 1 and (self.value == self.value[:1]).all():
+            self.value = self.value[:1].copy()
         self.E = self.value
         # TODO this is wrong with missing values -> need to correct N_cells to account for the cells in which a given gene is missing
         self.lnE = self.N_cells * s.log(self.value)
@@ -394,21 +442,28 @@ class Z_Node(UnivariateGaussian_Unobserved_Variational_Node):
         self.factors_axis = 1
 
     def getLvIndex(self):
-        # Method to return the index of the latent variables (without covariates)
+        # Method to return the index of the active latent variables (without covariates)
         latent_variables = np.array(range(self.dim[1]))
-        if any(self.covariates):
-            # latent_variables = np.delete(latent_variables, latent_variables[self.covariates])
-            latent_variables = latent_variables[~self.covariates]
+        latent_variables = latent_variables[~self.covariates & self.getActiveFactors()]
         return latent_variables
 
+    def deactivateFactors(self, idx):
+        # Method to switch off factors without removing them from the arrays of the node
+        # The latent variables are set to zero, so that inactive factors do not contribute to the predictions
+        super(Z_Node,self).deactivateFactors(idx)
+        Q = self.Q.getParameters()
+        Q['mean'][:,idx] = 0.
+        Q['var'][:,idx] = 0.
+        self.Q.updateExpectations()
+
     def updateParameters(self):
 
         # Collect expectations from the markov blanket
-        Y = deepcopy(self.markov_blanket["Y"].getExpectation())
+        Yexp = self.markov_blanket["Y"].getExpectation()
         SWtmp = self.markov_blanket["SW"].getExpectations()
-        tau = deepcopy(self.markov_blanket["Tau"].getExpectation())
+        tauexp = self.markov_blanket["Tau"].getExpectation()
         latent_variables = self.getLvIndex() # excluding covariates from the list of latent variables
-        mask = [ma.getmask(Y[m]) for m in range(len(Y))]
+        M = len(Yexp)
 
         # Collect parameters from the prior or expectations from the markov blanket
         if "Mu" in self.markov_blanket:
@@ -416,35 +471,44 @@ class Z_Node(UnivariateGaussian_Unobserved_Variational_Node):
         else:
             Mu = self.P.getParameters()["mean"]
 
+        # The ARD precision (K,) is broadcast over the samples without copying it
         if "Alpha" in self.markov_blanket:
-            Alpha = self.markov_blanket['Alpha'].getExpectation()
-            Alpha = s.repeat(Alpha[None,:], self.N, axis=0)
+            Alpha = s.broadcast_to(self.markov_blanket['Alpha'].getExpectation(), (self.N,self.dim[1]))
         else:
             Alpha = 1./self.P.getParameters()["var"]
 
-        # Check dimensionality of Tau and expand if necessary (for Jaakola's bound only)
-        for m in range(len(Y)):
-            if tau[m].shape != Y[m].shape:
-                tau[m] = s.repeat(tau[m].copy()[None,:], self.N, axis=0)
-            # Mask tau
-            # tau[m] = ma.masked_where(ma.getmask(Y[m]), tau[m]) # important to keep this out of the loop to mask non-gaussian tau
-            tau[m][mask[m]] = 0.
+        # Mask matrices, using preallocated buffers from the workspace. The precision of the noise is not expanded
+        # to (N,D) but applied to the weights of each view (see Node.getPrecisionWeights)
+        Y, weights, tmp, SW, tauSW = [], [], [], [], []
+        tauSWW = s.zeros((self.N,self.dim[1]))
+        for m in range(M):
+            Y.append(self.getBuffer("Y", Yexp[m].shape, view=m))
+            tmp.append(self.getBuffer("tmp", Yexp[m].shape, view=m))
+            mask = ma.getmask(Yexp[m])
             # Mask Y
-            Y[m] = Y[m].data
-            Y[m][mask[m]] = 0.
+            np.copyto(Y[m], ma.getdata(Yexp[m]))
+            Y[m][mask] = 0.
+            # Precision and weights of the observed entries, and the terms of all the factors that only depend on SW
+            tau, w = self.getPrecisionWeights(tauexp[m], mask, Yexp[m].shape, view=m)
+            weights.append(w)
+            SW.append(SWtmp[m]["E"])
+            tauSW.append(SW[m] * tau[:,None])
+            ESWW = SWtmp[m]["ESWW"] * tau[:,None]
+            tauSWW += ESWW.sum(axis=0)[None,:] if w is None else s.dot(w, ESWW)
 
         # Collect parameters from the P and Q distributions of this node
         Q = self.Q.getParameters().copy()
         Qmean, Qvar = Q['mean'], Q['var']
 
-        M = len(Y)
         for k in latent_variables:
-            foo = s.zeros((self.N,))
             bar = s.zeros((self.N,))
             for m in range(M):
-                foo += np.dot(tau[m],SWtmp[m]["ESWW"][:,k])
-                bar += np.dot(tau[m]*(Y[m] - s.dot( Qmean[:,s.arange(self.dim[1])!=k] , SWtmp[m]["E"][:,s.arange(self.dim[1])!=k].T )), SWtmp[m]["E"][:,k])
-            Qvar[:,k] = 1./(Alpha[:,k]+foo)
+                # bar += np.dot(tau[m]*(Y[m] - s.dot( Qmean[:,s.arange(self.dim[1])!=k] , SWtmp[m]["E"][:,s.arange(self.dim[1])!=k].T )), SWtmp[m]["E"][:,k])
+                s.dot( Qmean[:,s.arange(self.dim[1])!=k] , SW[m][:,s.arange(self.dim[1])!=k].T, out=tmp[m] )
+                s.subtract(Y[m], tmp[m], out=tmp[m])
+                if weights[m] is not None: s.multiply(weights[m], tmp[m], out=tmp[m])
+                bar += np.dot(tmp[m], tauSW[m][:,k])
+            Qvar[:,k] = 1./(Alpha[:,k]+tauSWW[:,k])
             Qmean[:,k] = Qvar[:,k] * (  Alpha[:,k]*Mu[:,k] + bar )
 
         # Save updated parameters of the Q distribution
@@ -462,15 +526,14 @@ class Z_Node(UnivariateGaussian_Unobserved_Variational_Node):
             PE, PE2 = self.P.getParameters()["mean"], s.zeros((self.N,self.dim[1]))
 
         if "Alpha" in self.markov_blanket:
-            Alpha = self.markov_blanket['Alpha'].getExpectations().copy() # Notice that this Alpha is the ARD prior on Z, not on W.
-            Alpha["E"] = s.repeat(Alpha["E"][None,:], self.N, axis=0)
-            Alpha["lnE"] = s.repeat(Alpha["lnE"][None,:], self.N, axis=0)
+            Alpha = self.markov_blanket['Alpha'].getExpectations() # Notice that this Alpha is the ARD prior on Z, not on W.
         else:
             Alpha = { 'E':1./self.P.getParameters()["var"], 'lnE':s.log(1./self.P.getParameters()["var"]) }
 
         # This ELBO term contains only cross entropy between Q and P,and entropy of Q. So the covariates should not intervene at all
+        # (the ARD precision (K,) is selected before it is broadcast over the samples)
         latent_variables = self.getLvIndex()
-        Alpha["E"], Alpha["lnE"] = Alpha["E"][:,latent_variables], Alpha["lnE"][:,latent_variables]
+        Alpha = { k:s.broadcast_to(Alpha[k][...,latent_variables], (self.N,len(latent_variables))) for k in ("E","lnE") }
         Qmean, Qvar = Qmean[:, latent_variables], Qvar[:, latent_variables]
         PE, PE2 = PE[:, latent_variables], PE2[:, latent_variables]
         QE, QE2 = QE[:, latent_variables], QE2[:, latent_variables]
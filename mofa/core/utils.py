@@ -1,94 +1,406 @@
 from __future__ import division
-from time import sleep
+from time import sleep, time
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import pandas as pd
 import numpy.ma as ma
 import os
+import re
+import sys
 import h5py
+import hashlib
+import tempfile
+import shutil
+import atexit
+import threading
+
+from .preparation import checkMissingSamples, removeIncompleteSamples, maskData
 
 """
 Module to define some useful util functions
 """
 
 
-def removeIncompleteSamples(data):
-    """ Method to remove samples with missing views 
+def readNames(file):
+    """ Method to read the names of the samples or the features from a sidecar file (one name per line)
 
     PARAMETERS
     ----------
-    data: list  
+    file: str
+        path to the sidecar file
     """
-    print("Removing incomplete samples...")
+    if not os.path.isfile(file):
+        return None
+    with open(file) as f:
+        return [ line.rstrip("\r\n") for line in f if line.strip() != "" ]
 
-    M = len(data)
-    N = data[0].shape[0]
-    samples_to_remove = []
-    for n in range(N):
-        for m in range(M):
-            if pd.isnull(data[m].iloc[n][0]):
-                samples_to_remove.append(n)
-                break
+# Temporary directory of this run in each directory of memory-mapped views (see mmapDirectory)
+_mmap_runs = {}
+_mmap_lock = threading.Lock()
 
-    if len(samples_to_remove) > 0:
-        print("A total of " + str(len(samples_to_remove)) + " sample(s) have at least a missing view and will be removed")
+def mmapDirectory(mmap_dir):
+    """ Method to return the temporary directory of this run inside a directory of memory-mapped views. It is created
+    on the first call and removed with all its files when the process exits, or before with removeViews
 
-    data_filt = [None]*M
-    samples_to_keep = np.setdiff1d(range(N),samples_to_remove)
-    for m in range(M):
-        data_filt[m] = data[m].iloc[samples_to_keep]
+    PARAMETERS
+    ----------
+    mmap_dir: str
+        directory of the memory-mapped views (i.e. data_opts['mmap_dir'])
+    """
+    mmap_dir = os.path.abspath(mmap_dir)
+    with _mmap_lock:
+        if mmap_dir not in _mmap_runs:
+            if not os.path.isdir(mmap_dir): os.makedirs(mmap_dir)
+            _mmap_runs[mmap_dir] = tempfile.mkdtemp(dir=mmap_dir, prefix="run_")
+            atexit.register(_removeRun, _mmap_runs[mmap_dir], os.getpid())
+        return _mmap_runs[mmap_dir]
+
+def _removeRun(path, pid):
+    """ Method to remove the temporary directory of a run at exit, only in the process that created it (not in forked children) """
+    if os.getpid() == pid: shutil.rmtree(path, ignore_errors=True)
+
+def removeViews(mmap_dir):
+    """ Method to remove the temporary directory of this run inside a directory of memory-mapped views (see mmapDirectory),
+    including the directories of other runs nested in it. The arrays that are still mapped remain valid until they are released
 
-    return data_filt
+    PARAMETERS
+    ----------
+    mmap_dir: str
+        directory of the memory-mapped views (i.e. data_opts['mmap_dir'])
+    """
+    with _mmap_lock:
+        path = _mmap_runs.pop(os.path.abspath(mmap_dir), None)
+        if path is None: return
+        for d in [ d for d in _mmap_runs if d.startswith(path + os.sep) ]: del _mmap_runs[d]
+    shutil.rmtree(path, ignore_errors=True)
 
+def releaseView(Y):
+    """ Method to remove the file of a view allocated by allocateView once it is no longer needed, the array remains
+    valid until it is released. Other arrays (i.e. in memory or memory-mapped input files) are not modified
 
+    PARAMETERS
+    ----------
+    Y: ndarray
+    """
+    if not isinstance(Y, np.memmap) or Y.filename is None: return
+    with _mmap_lock:
+        owned = any([ Y.filename.startswith(d + os.sep) for d in _mmap_runs.values() ])
+    if owned and os.path.isfile(Y.filename):
+        try:
+            os.remove(Y.filename)
+        except OSError:
+            pass
+
+def allocateView(shape, m, data_opts, dtype=np.float32, purpose="data"):
+    """ Method to preallocate the array of a view, either in memory or as a memory-mapped file in the temporary
+    directory of this run inside data_opts['mmap_dir'] (see mmapDirectory). Every allocation gets a new file, named after
+    the view and the purpose, so that live memory maps (i.e. the raw data while it is processed) are never overwritten
+
+    PARAMETERS
+    ----------
+    shape: tuple
+    m: int
+        index of the view
+    data_opts: dic
+    dtype: numpy dtype
+    purpose: str
+        use of the array (i.e. raw or processed), included in the name of the file
+    """
+    if data_opts.get('mmap_dir') is not None:
+        fd, path = tempfile.mkstemp(dir=mmapDirectory(data_opts['mmap_dir']), prefix="view%d_%s_" % (m, purpose), suffix=".npy")
+        os.close(fd)
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+    return np.empty(shape, dtype=dtype)
+
+def blockSize(D, nbytes=2**25):
+    """ Method to return the number of rows of a block with D columns that fits in about nbytes (float64) """
+    return max(1, nbytes // (8*max(1,D)))
+
+def readText(file, m, data_opts):
+    """ Method to read a delimited text file in blocks of rows into a preallocated float32 array
+
+    PARAMETERS
+    ----------
+    file: str
+    m: int
+        index of the view
+    data_opts: dic
+    """
+    opts = { 'delimiter':data_opts["delimiter"], 'header':data_opts["colnames"], 'index_col':data_opts["rownames"] }
+
+    # Count the rows and the columns to preallocate the array
+    with open(file, "rb") as f:
+        N = sum([ 1 for line in f if line.strip() ])
+    if data_opts["colnames"] is not None: N -= 1
+    first = pd.read_csv(file, nrows=1, **opts)
+    D = first.shape[1]
+    Y = allocateView((N,D), m, data_opts, purpose="raw")
+
+    # Parse the file in blocks of rows
+    samples, n = [], 0
+    for chunk in pd.read_csv(file, chunksize=blockSize(D), **opts):
+        assert n+chunk.shape[0] <= N, "Unexpected number of rows in %s" % file
+        Y[n:n+chunk.shape[0]] = chunk.values
+        samples.extend(chunk.index.tolist())
+        n += chunk.shape[0]
+    Y = Y[:n]
+
+    samples = samples if data_opts["rownames"] is not None else None
+    features = first.columns.tolist() if data_opts["colnames"] is not None else None
+    return Y, samples, features
+
+def readView(file, m, data_opts):
+    """ Method to read the data of a single view
+
+    The format is inferred from the extension of the file:
+    - .npy: numpy array, memory-mapped
+    - .npz: numpy archive with the matrix in 'data' (or in its first array) and optionally the names in 'samples' and 'features'
+    - .h5 or .hdf5: HDF5 dataset, named 'data' unless it is given as 'file.h5:/path/to/dataset'. Optional 'samples' and 'features'
+        datasets in the same group contain the names. The dataset is memory-mapped if it is stored contiguously and without compression
+    - .parquet: Parquet table with one column per feature (requires pyarrow or fastparquet)
+    - any other extension: delimited text file, read in blocks of rows using the delimiter and header options
+    For the binary formats, the names of the samples and features can also be given in the sidecar files
+    '<file>.rownames' and '<file>.colnames' (one name per line)
+
+    PARAMETERS
+    ----------
+    file: str
+        path to the file
+    m: int
+        index of the view
+    data_opts: dic
+
+    RETURNS
+    -------
+    Y: ndarray with the data as it is stored in the file (rows by columns)
+    samples: list with the names of the rows (None if they are not available)
+    features: list with the names of the columns (None if they are not available)
+    """
+    h5 = re.match(r"^(.*\.(?:h5|hdf5))(?::(.+))?$", file)
+    ext = os.path.splitext(file)[1].lower()
+    samples, features = None, None
+
+    # Delimited text
+    if h5 is None and ext not in [".npy", ".npz", ".parquet"]:
+        return readText(file, m, data_opts)
+
+    # Numpy array
+    if ext == ".npy":
+        Y = np.load(file, mmap_mode="r")
+
+    # Numpy archive
+    elif ext == ".npz":
+        archive = np.load(file)
+        Y = archive["data"] if "data" in archive.files else archive[archive.files[0]]
+        if "samples" in archive.files: samples = archive["samples"].astype(str).tolist()
+        if "features" in archive.files: features = archive["features"].astype(str).tolist()
+
+    # HDF5 dataset
+    elif h5 is not None:
+        file, dataset = h5.group(1), h5.group(2) if h5.group(2) is not None else "data"
+        with h5py.File(file, "r") as f:
+            ds = f[dataset]
+            offset = ds.id.get_offset()
+            if offset is not None and ds.chunks is None:
+                Y = np.memmap(file, dtype=ds.dtype, mode="r", offset=offset, shape=ds.shape)
+            else:
+                Y = ds[()]
+            group = ds.parent
+            if "samples" in group: samples = [ x.decode() if isinstance(x,bytes) else str(x) for x in group["samples"][()] ]
+            if "features" in group: features = [ x.decode() if isinstance(x,bytes) else str(x) for x in group["features"][()] ]
+
+    # Parquet table
+    elif ext == ".parquet":
+        Y = pd.read_parquet(file)
+        samples, features = Y.index.astype(str).tolist(), Y.columns.astype(str).tolist()
+        Y = Y.values
+
+    assert Y.ndim == 2, "%s does not contain a matrix" % file
+
+    # Cast non-floating point data, floating point data is used as it is to keep the memory map
+    if Y.dtype.kind != "f":
+        Y = Y.astype(np.float32)
+
+    # Sidecar files with the names of the samples and features
+    if samples is None: samples = readNames(file + ".rownames")
+    if features is None: features = readNames(file + ".colnames")
+
+    return Y, samples, features
+
+def blockStatistics(X):
+    """ Method to calculate the number of observed values, mean, sum of squared deviations, minimum and maximum
+    of each column of a block of data, ignoring missing values
 
-def maskData(data, data_opts):
-    """ Method to mask values of the data, 
-    It is mainly to test missing values and to evaluate imputation
-    
     PARAMETERS
     ----------
+    X: ndarray
+        block of data with dimensions (observations,features)
+    """
+    obs = ~np.isnan(X)
+    n = obs.sum(axis=0).astype(np.float64)
+    mean = np.where(obs, X, 0.).sum(axis=0, dtype=np.float64) / np.maximum(n,1.)
+    M2 = np.square(np.where(obs, X - mean, 0.)).sum(axis=0)
+    return { 'n':n, 'mean':mean, 'M2':M2, 'min':np.where(obs, X, np.inf).min(axis=0), 'max':np.where(obs, X, -np.inf).max(axis=0) }
+
+def featureStatistics(Y):
+    """ Method to calculate the statistics of each feature in a single pass over blocks of the data
+
+    Blocks of samples are merged using the parallel version of Welford's algorithm (Chan et al, 1979),
+    blocks of features (if the data is stored by features) are calculated independently
+
+    PARAMETERS
+    ----------
+    Y: ndarray
+        data with dimensions (samples,features)
+    """
+    N, D = Y.shape
+
+    # Data stored by features: independent blocks of features
+    if Y.flags.f_contiguous and not Y.flags.c_contiguous:
+        step = blockSize(N)
+        blocks = [ blockStatistics(Y[:,j:j+step]) for j in range(0,D,step) ]
+        return { k:np.concatenate([ b[k] for b in blocks ]) for k in blocks[0].keys() } if D > 0 else blockStatistics(Y)
+
+    # Data stored by samples: merge blocks of samples
+    stats = None
+    step = blockSize(D)
+    for i in range(0,max(N,1),step):
+        b = blockStatistics(Y[i:i+step])
+        if stats is None:
+            stats = b
+            continue
+        n = stats['n'] + b['n']
+        delta = b['mean'] - stats['mean']
+        stats['mean'] = stats['mean'] + delta * b['n'] / np.maximum(n,1.)
+        stats['M2'] = stats['M2'] + b['M2'] + np.square(delta) * stats['n'] * b['n'] / np.maximum(n,1.)
+        stats['min'] = np.minimum(stats['min'], b['min'])
+        stats['max'] = np.maximum(stats['max'], b['max'])
+        stats['n'] = n
+    return stats
+
+def processView(Y, m, data_opts, release=True):
+    """ Method to do the sanity checks and to parse the data of a single view
+
+    The statistics of the features are calculated in a single pass (see featureStatistics), and then the filtered, centered
+    and scaled data is written once: in place if the array is writable, or otherwise (i.e. memory-mapped input files) into a
+    new float32 array. If no processing is required the data is returned as it is.
+
+    PARAMETERS
+    ----------
+    Y: ndarray
+        data of the view, with dimensions (samples,features)
+    m: int
+        index of the view
     data_opts: dic
+    release: boolean
+        remove the memory-mapped file of the raw data once it is processed into a new array (see releaseView)?
+
+    RETURNS
+    -------
+    Y: ndarray with the processed data
+    keep: boolean ndarray indicating which features were kept
     """
-    print("Masking data with the following options:")
-    print("at random:")
-    print(data_opts['maskAtRandom'])
-    print("full cases:")
-    print(data_opts['maskNSamples'])
-
-    for m in range(len(data)):
-
-        # Mask values at random
-        D = data[m].shape[1]
-        N = data[m].shape[0]
-        p2Mask = data_opts['maskAtRandom'][m]
-        if p2Mask != 0:
-            idxMask = np.zeros(N*D)
-            idxMask[:int(round(N*D*p2Mask))] = 1
-            np.random.shuffle(idxMask)
-            idxMask = np.reshape(idxMask, [N, D])
-            data[m] = data[m].mask(idxMask==1)
-
-        # Mask samples in a complete view
-        Nsamples2Mask = data_opts['maskNSamples'][m]
-        if Nsamples2Mask != 0:
-            idxMask = np.random.choice(N, size=Nsamples2Mask, replace = False)
-            # idxMask = np.arange(Nsamples2Mask)
-            # print idxMask
-            tmp = data[m].copy()
-            tmp.ix[idxMask,:] = pd.np.nan
-            data[m] = tmp
-
-    return data
+    stats = featureStatistics(Y)
+    keep = np.ones(Y.shape[1], dtype=bool)
+
+    # Removing features with complete missing values
+    nas = stats['n'] == 0
+    if np.any(nas):
+        print("Warning: %d features(s) on view %d have missing values in all samples, removing them..." % ( nas.sum(), m) )
+        keep[nas] = False
+
+    # Removing features with no variance
+    var = (stats['n'] > 1) & (stats['min'] == stats['max'])
+    if np.any(var):
+        print("Warning: %d features(s) on view %d have zero variance, removing them..." % ( var.sum(),m) )
+        keep[var] = False
+
+    n, mean, M2 = stats['n'][keep], stats['mean'][keep], stats['M2'][keep]
+    shift, scale = None, None
+
+    # Center the features
+    if data_opts['center_features'][m]:
+        print("Centering features for view " + str(m) + "...")
+        shift = mean
+
+    # Scale the views to unit variance
+    if data_opts['scale_views'][m]:
+        print("Scaling view " + str(m) + " to unit variance...")
+        centered = mean - shift if shift is not None else mean
+        grand = (n*centered).sum() / n.sum()
+        scale = np.sqrt( (M2.sum() + (n*np.square(centered-grand)).sum()) / n.sum() )
+
+    # Scale the features to unit variance
+    if data_opts['scale_features'][m]:
+        print("Scaling features for view " + str(m) + " to unit variance...")
+        scale = np.sqrt(M2/n)
+
+    # No processing required
+    if keep.all() and shift is None and scale is None:
+        return Y, keep
+
+    # Write the processed data in place, working on the rows of the underlying C-ordered array
+    if Y.flags.writeable and (Y.flags.c_contiguous or Y.flags.f_contiguous):
+        A, axis = (Y, 1) if Y.flags.c_contiguous else (Y.T, 0)
+        step, pos = blockSize(A.shape[1]), 0
+        for i in range(0, A.shape[0], step):
+            block = A[i:i+step]
+            if axis == 1:
+                if not keep.all(): block[:,:keep.sum()] = block[:,keep]
+                block = block[:,:keep.sum()]
+                if shift is not None: block -= shift
+                if scale is not None: block /= scale
+            else:
+                block = block[keep[i:i+step]]
+                if shift is not None: block -= shift[pos:pos+block.shape[0],None]
+                if scale is not None: block /= (scale[pos:pos+block.shape[0],None] if np.ndim(scale) > 0 else scale)
+                A[pos:pos+block.shape[0]] = block
+                pos += block.shape[0]
+        return (A[:,:keep.sum()] if axis == 1 else A[:pos].T), keep
+
+    # Write the processed data into a new array
+    out = allocateView((Y.shape[0],keep.sum()), m, data_opts, purpose="processed")
+    step = blockSize(Y.shape[1])
+    for i in range(0, Y.shape[0], step):
+        block = Y[i:i+step][:,keep] if not keep.all() else np.array(Y[i:i+step])
+        if shift is not None: block = block - shift
+        if scale is not None: block = block / scale
+        out[i:i+step] = block
+    if release: releaseView(Y)
+    return out, keep
 
 # Function to load the data
-def loadData(data_opts, verbose=True):
+def loadData(data_opts, verbose=True, threads=None):
     """ Method to load the data
+
+    The views are read and parsed concurrently in a pool of threads (most of the work
+    is done by pandas and numpy, which release the GIL), so the total loading time is
+    close to the time of the largest view.
     
     PARAMETERS
     ----------
     data_opts: dic
     verbose: boolean
+    threads: int
+        number of views to load at the same time (by default as many as views, up to the number of cores)
+    """
+    views = readData(data_opts, threads=threads)
+    return processData(views, data_opts, threads=threads)
+
+def readData(data_opts, threads=None):
+    """ Method to read the files of all views without processing them (see loadData)
+
+    PARAMETERS
+    ----------
+    data_opts: dic
+    threads: int
+        number of views to read at the same time (by default as many as views, up to the number of cores)
+
+    RETURNS
+    -------
+    list with the [data, sample names, feature names] of each view, the data has dimensions (samples,features)
     """
     
     print ("\n")
@@ -99,68 +411,67 @@ def loadData(data_opts, verbose=True):
     sleep(1)
 
     M = len(data_opts['input_files'])
+    if threads is None: threads = min(M, cpu_count())
+    pool = ThreadPool(max(1,threads))
 
-    Y =  [None]*M
-    for m in range(M):
-
-        # Read file
+    # Read the files
+    def read(m):
+        t = time()
         file = data_opts['input_files'][m]
-        Y[m] = pd.read_csv(file, delimiter=data_opts["delimiter"], header=data_opts["colnames"], index_col=data_opts["rownames"]).astype(pd.np.float32)
-
-        # Y[m] = pd.read_csv(file, delimiter=data_opts["delimiter"])
-        print("Loaded %s with %d samples and %d features..." % (file, Y[m].shape[0], Y[m].shape[1]))
-
-        # Checking missing values on features
-        # print max(np.isnan(Y[m]).mean(axis=1))
-        # exit()
-
-        # Checking missing values on samples
-        # print np.isnan(Y[m]).mean(axis=1)
-        # exit()
+        Y, samples, features = readView(file, m, data_opts)
+        if samples is None: samples = list(range(Y.shape[0]))
+        if features is None: features = list(range(Y.shape[1]))
+        print("Loaded %s with %d samples and %d features (view %d, %.2fs)..." % (file, Y.shape[0], Y.shape[1], m, time()-t))
+        sys.stdout.flush()
+        return [Y, samples, features]
+    views = pool.map(read, range(M))
 
     # Check that the dimensions match
-    if len(set([Y[m].shape[0] for m in range(M)])) != 1:
-        if all([Y[m].shape[1] for m in range(M)]):
+    if len(set([views[m][0].shape[0] for m in range(M)])) != 1:
+        if all([views[m][0].shape[1] for m in range(M)]):
             print("\nColumns seem to be the shared axis, transposing the data...")
-            for m in range(M): Y[m] = Y[m].T
+            for m in range(M): views[m] = [ views[m][0].T, views[m][2], views[m][1] ]
         else:
             print("\nDimensionalities do not match, aborting. Make sure that either columns or rows are shared!")
             exit()
 
-    # TO-DO: CHECK IF ANY SAMPLE HAS MISSING VALUES IN ALL VIEWS 
+    pool.close()
+
+    return views
+
+def processData(views, data_opts, threads=None, release=True):
+    """ Method to do the sanity checks and to parse the data of all views (see processView)
+
+    PARAMETERS
+    ----------
+    views: list
+        list with the [data, sample names, feature names] of each view, the data has dimensions (samples,features)
+    data_opts: dic
+    threads: int
+        number of views to parse at the same time (by default as many as views, up to the number of cores)
+    release: boolean
+        remove the memory-mapped files of the raw data once they are processed into new arrays (see releaseView)?
+    """
+    M = len(views)
+    if threads is None: threads = min(M, cpu_count())
+    pool = ThreadPool(max(1,threads))
 
-    # Sanity checks on the data
     print ("\n" +"#"*46)
     print("## Doing sanity checks and parsing the data ##")
     print ("#"*46 + "\n")
-    for m in range(M):
-
-        # Removing features with complete missing values
-        nas = np.isnan(Y[m]).mean(axis=0)
-        if np.any(nas==1.):
-            print("Warning: %d features(s) on view %d have missing values in all samples, removing them..." % ( (nas==1.).sum(), m) )
-            Y[m].drop(Y[m].columns[np.where(nas==1.)], axis=1, inplace=True)
-
-        # Removing features with no variance
-        var = Y[m].std(axis=0) 
-        if np.any(var==0.):
-            print("Warning: %d features(s) on view %d have zero variance, removing them..." % ( (var==0.).sum(),m) )
-            Y[m].drop(Y[m].columns[np.where(var==0.)], axis=1, inplace=True)
-
-        # Center the features
-        if data_opts['center_features'][m]:
-            print("Centering features for view " + str(m) + "...")
-            Y[m] = (Y[m] - Y[m].mean(axis=0))
-
-        # Scale the views to unit variance
-        if data_opts['scale_views'][m]:
-            print("Scaling view " + str(m) + " to unit variance...")
-            Y[m] = Y[m] / np.nanstd(Y[m].as_matrix())
-
-        # Scale the features to unit variance
-        if data_opts['scale_features'][m]:
-            print("Scaling features for view " + str(m) + " to unit variance...")
-            Y[m] = Y[m] / np.std(Y[m], axis=0, )
+    def process(m):
+        t = time()
+        Y, samples, features = views[m]
+        Y, keep = processView(Y, m, data_opts, release=release)
+        features = [ f for f,k in zip(features,keep) if k ]
+        print("Parsed view %d (%.2fs)..." % (m, time()-t))
+        sys.stdout.flush()
+        return pd.DataFrame(Y, index=samples, columns=features, copy=False)
+    Y = pool.map(process, range(M))
+    pool.close()
+
+    # Check if any sample has missing values in all views
+    checkMissingSamples(Y)
 
     print("\nAfter data processing:")
     for m in range(M): print("view %d has %d samples and %d features..." % (m, Y[m].shape[0], Y[m].shape[1]))
@@ -196,6 +507,40 @@ def nans(shape, dtype=float):
     a.fill(np.nan)
     return a
 
+class Workspace(object):
+    """ Arena of preallocated buffers for the updates of the nodes
+
+    Buffers are identified by a name and a view and are allocated the first time they are requested.
+    Afterwards the same memory is returned at every iteration, unless the requested shape changes
+    (i.e. after dropping factors), in which case the buffer is reallocated. The contents of a buffer
+    are not preserved between requests, so nodes must only use them as scratch space within an update.
+    """
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, view=None):
+        """ Method to return a buffer
+
+        PARAMETERS
+        ----------
+        name: str
+            name of the buffer
+        shape: tuple
+            shape of the buffer
+        view: int
+            index of the view the buffer belongs to
+        """
+        shape = tuple(shape)
+        buf = self.buffers.get((name,view))
+        if buf is None or buf.shape != shape:
+            buf = np.empty(shape)
+            self.buffers[(name,view)] = buf
+        return buf
+
+    def nbytes(self):
+        """ Method to return the memory allocated by the workspace """
+        return sum([ buf.nbytes for buf in self.buffers.values() ])
+
 def corr(A,B):
     """ Method to efficiently compute correlation coefficients between two matrices 
     
@@ -250,6 +595,54 @@ def ddot(d, mtx, left=True):
 def lambdafn(X):
     return np.tanh(X/2.)/(4.*X)
 
+def chunkShape(shape, itemsize, nbytes=2**20):
+    """ Method to define the shape of the chunks of an hdf5 dataset, with complete rows (i.e. factors
+    for expectations stored as factors by samples/features) up to about nbytes per chunk
+
+    PARAMETERS
+    ----------
+    shape: tuple
+    itemsize: int
+    nbytes: int
+    """
+    if len(shape) == 0 or 0 in shape or len(shape) > 2:
+        return None
+    cols = max(1, min(shape[-1], nbytes//itemsize))
+    rows = max(1, min(shape[0], nbytes//(itemsize*cols))) if len(shape) == 2 else None
+    return (rows, cols) if len(shape) == 2 else (cols,)
+
+def saveArray(grp, name, X, storage=None):
+    """ Method to save an array in an hdf5 file, transposed (as expected by the R package), in a chunked
+    and optionally compressed dataset. The array is written in blocks to avoid a transposed copy in memory.
+
+    PARAMETERS
+    ----------
+    grp: h5py group
+    name: str
+    X: ndarray or masked array (missing values are saved as nan)
+    storage: dic
+        storage options: 'compression' (None, 'gzip' or 'lzf'), 'compression_opts' and 'float32' (save floats in single precision)
+    """
+    if storage is None: storage = {}
+    if not isinstance(X, ma.MaskedArray): X = np.asarray(X)
+    dtype = np.float32 if storage.get('float32') and X.dtype.kind == "f" else X.dtype
+    shape = X.shape[::-1]
+    chunks = chunkShape(shape, np.dtype(dtype).itemsize)
+    ds = grp.create_dataset(name, shape=shape, dtype=dtype, chunks=chunks,
+        compression=storage.get('compression') if chunks is not None else None,
+        compression_opts=storage.get('compression_opts') if chunks is not None and storage.get('compression') == "gzip" else None)
+
+    if X.ndim != 2:
+        ds[...] = ma.filled(X, np.nan).T if isinstance(X, ma.MaskedArray) else X.T
+        return ds
+
+    step = blockSize(X.shape[0])
+    for j in range(0, shape[0], step):
+        block = X[:, j:j+step]
+        if isinstance(block, ma.MaskedArray): block = ma.filled(block, np.nan)
+        ds[j:j+step] = block.T
+    return ds
+
 def saveParameters(model, hdf5, view_names=None):
     """ Method to save the parameters of the model in an hdf5 file
     
@@ -302,7 +695,7 @@ def saveParameters(model, hdf5, view_names=None):
                 node_subgrp.create_dataset("%s" % (param_name), data=parameters[param_name].T)
     pass
 
-def saveExpectations(model, hdf5, view_names=None):
+def saveExpectations(model, hdf5, view_names=None, storage=None):
     """ Method to save the expectations of the model in an hdf5 file
     
     PARAMETERS
@@ -310,6 +703,8 @@ def saveExpectations(model, hdf5, view_names=None):
     model: a BayesNet instance
     hdf5: 
     view_names:
+    storage: dic
+        storage options (see saveArray)
     """
     # Get nodes from the model
     nodes = model.getNodes()
@@ -336,18 +731,16 @@ def saveExpectations(model, hdf5, view_names=None):
                 else:
                     view = "%d" % m
 
-                # Collect expectations
+                # Collect expectations (the ones with a natural shape that broadcasts to the dimensions of the node, i.e. Theta, are saved expanded)
                 exp = expectations[m]["E"]
                 if exp  is not None:
-                    if type(exp) == ma.core.MaskedArray:
-                        tmp = ma.filled(exp, fill_value=np.nan)
-                        node_subgrp.create_dataset(view, data=tmp.T)
-                    else:
-                        node_subgrp.create_dataset(view, data=exp.T)
+                    dim = tuple(nodes[node].getNodes()[m].getDimensions())
+                    if np.ndim(exp) == len(dim) and exp.shape != dim: exp = np.broadcast_to(exp, dim)
+                    saveArray(node_subgrp, view, exp, storage)
 
         # Single-view nodes
         else:
-            exp_grp.create_dataset(node, data=expectations["E"].T)
+            saveArray(exp_grp, node, expectations["E"], storage)
 
 def saveTrainingStats(model, hdf5):
     """ Method to save the training statistics in an hdf5 file
@@ -373,12 +766,18 @@ def saveTrainingOpts(opts, hdf5):
     hdf5: 
     """
     # Remove dictionaries from the options
+    opts = opts.copy()
     for k,v in opts.copy().items():
         if type(v)==dict:
             for k1,v1 in v.items():
                 opts[str(k)+"_"+str(k1)] = v1
             opts.pop(k)
 
+    # Remove options that cannot be stored as numbers (i.e. addresses of remote workers)
+    for k,v in opts.copy().items():
+        if isinstance(v,str) or not (v is None or np.isscalar(v)):
+            opts.pop(k)
+
     # Create HDF5 data set
     hdf5.create_dataset("training_opts", data=np.array(list(opts.values()), dtype=np.float))
     hdf5['training_opts'].attrs['names'] = np.asarray(list(opts.keys())).astype('S')
@@ -398,8 +797,12 @@ def saveModelOpts(opts, hdf5):
         grp.create_dataset(k, data=np.asarray(v).astype('S'))
     grp[k].attrs['names'] = np.asarray(list(opts.keys())).astype('S')
 
-def saveTrainingData(model, hdf5, view_names=None, sample_names=None, feature_names=None):
+def saveTrainingData(model, hdf5, view_names=None, sample_names=None, feature_names=None, storage=None):
     """ Method to save the training data in an hdf5 file
+
+    If storage['data_file'] is given, the training data is saved only once in that (shared) hdf5 file, in a group named
+    after a hash of its content, the names of the views and the type in which it is saved, and the datasets of the model
+    file are external links to it. This avoids duplicating the data in the outputs of several trials or runs on the same data.
     
     PARAMETERS
     ----------
@@ -408,25 +811,186 @@ def saveTrainingData(model, hdf5, view_names=None, sample_names=None, feature_na
     view_names
     sample_names
     feature_names
+    storage: dic
+        storage options (see saveArray)
     """
+    if storage is None: storage = {}
     data = model.getTrainingData()
     data_grp = hdf5.create_group("data")
     featuredata_grp = hdf5.create_group("features")
     # hdf5.create_dataset("samples", data=sample_names)
     hdf5.create_dataset("samples", data=np.array(sample_names, dtype='S50'))
-    for m in range(len(data)):
-        view = view_names[m] if view_names is not None else str(m)
-        data_grp.create_dataset(view, data=data[m].data.T)
-        if feature_names is not None:
+    views = [ view_names[m] if view_names is not None else str(m) for m in range(len(data)) ]
+
+    if storage.get('data_file') is not None:
+        # Hash of the training data, the names of the views and the saved type
+        h = hashlib.sha1()
+        for m in range(len(data)):
+            dtype = np.float32 if storage.get('float32') and data[m].dtype.kind == "f" else data[m].dtype
+            h.update(("%s %s %s" % (views[m], data[m].shape, np.dtype(dtype).str)).encode())
+            step = blockSize(data[m].shape[1])
+            for i in range(0, data[m].shape[0], step):
+                h.update(np.ascontiguousarray(ma.filled(data[m][i:i+step], np.nan)))
+        key = h.hexdigest()
+
+        # Save the data in the shared file, unless it is already there
+        with h5py.File(storage['data_file'], "a") as f:
+            grp = f.require_group(key)
+            for m in range(len(data)):
+                if views[m] not in grp:
+                    saveArray(grp, views[m], data[m], storage)
+
+        # Link the data from the model file (the path is relative to the model file)
+        path = os.path.relpath(os.path.abspath(storage['data_file']), os.path.dirname(os.path.abspath(hdf5.filename)))
+        for m in range(len(data)):
+            data_grp[views[m]] = h5py.ExternalLink(path, "/%s/%s" % (key, views[m]))
+    else:
+        for m in range(len(data)):
+            saveArray(data_grp, views[m], data[m], storage)
+
+    if feature_names is not None:
+        for m in range(len(data)):
             # data_grp.attrs['features'] = np.array(feature_names[m], dtype='S')
-            featuredata_grp.create_dataset(view, data=np.array(feature_names[m], dtype='S50'))
+            featuredata_grp.create_dataset(views[m], data=np.array(feature_names[m], dtype='S50'))
+
+def saveProjection(model, hdf5, view_names=None, storage=None):
+    """ Method to save the terms that are required to project new samples onto the model (see projection.py),
+    which are not part of the expectations: the second moments of the weights and the indices of the covariates
+
+    PARAMETERS
+    ----------
+    model: a BayesNet instance
+    hdf5:
+    view_names
+    storage: dic
+        storage options (see saveArray)
+    """
+    nodes = model.getNodes()
+    grp = hdf5.create_group("projection")
+    sww_grp = grp.create_group("SWW")
+    SW = nodes["SW"].getExpectations()
+    for m in range(len(SW)):
+        saveArray(sww_grp, view_names[m] if view_names is not None else str(m), SW[m]["ESWW"], storage)
+    grp.create_dataset("covariates", data=nodes["Z"].covariates.astype(np.int8))
+
+def calculateVarianceExplained(Z, W, Y, intercept=False, per_feature=False):
+    """ Method to calculate the variance explained (coefficient of determination) in a view by all the factors and by each factor,
+    with the same definition as calculateVarianceExplained in the R package:
+        R2 = 1 - sum((Y-Ypred)**2) / sum((Y-mean(Y))**2)
+    where the sums are over the observed values and the predictions exclude the intercept, which is regressed out from the data.
+
+    The residuals are expanded into second-order statistics of the factors (Z'Z, the cross-products Y'Z and the masked
+    cross-products Mask'Z**2), which are accumulated over blocks of features, so that the predictions of each
+    factor (matrices with dimensions (samples,features)) are never calculated.
+
+    PARAMETERS
+    ----------
+    Z: ndarray
+        expectations of the factors, with dimensions (samples,factors)
+    W: ndarray
+        expectations of the weights, with dimensions (features,factors)
+    Y: ndarray or masked array
+        data (or expectations of the pseudodata) with dimensions (samples,features), missing values are nan or masked
+    intercept: boolean
+        is the first factor an intercept?
+    per_feature: boolean
+        calculate also the variance explained in each feature?
+
+    RETURNS
+    -------
+    dictionary with 'r2_total' (float) and 'r2_per_factor' (K), and if per_feature is True with 'r2_total_per_feature' (D)
+    and 'r2_per_feature' (D,K), where K excludes the intercept
+    """
+    Z = np.nan_to_num(np.asarray(Z, dtype=np.float64))
+    W = np.nan_to_num(np.asarray(W, dtype=np.float64))
+    N, D = Y.shape
+    factors = np.arange(1 if intercept else 0, Z.shape[1])
+    Zk, Wk = Z[:,factors], W[:,factors]
+    ZZ, Z2 = np.dot(Zk.T, Zk), np.square(Zk)
+
+    # Feature-wise statistics:
+    #   SSnull: sum of squares of the residuals of the null model (the mean of each feature)
+    #   SS: sum of squares of the data (without the intercept)
+    #   YZ: cross-products of the data and the factors
+    #   MZ2: sum of squares of the factors in the missing values of each feature
+    #   PP: sum of squares of the predictions (with all the factors) in the missing values of each feature
+    SSnull, SS, PP = np.zeros(D), np.zeros(D), np.zeros(D)
+    YZ, MZ2 = np.zeros((D,len(factors))), np.zeros((D,len(factors)))
+    step = blockSize(N, nbytes=2**24)
+    for j in range(0, D, step):
+        Yj = Y[:,j:j+step]
+        missing = ma.getmaskarray(Yj) if isinstance(Yj, ma.MaskedArray) else np.zeros(Yj.shape, dtype=bool)
+        Yj = np.array(ma.filled(Yj, np.nan) if isinstance(Yj, ma.MaskedArray) else Yj, dtype=np.float64)
+        missing |= np.isnan(Yj)
+        Yj[missing] = 0.
+        n = N - missing.sum(axis=0)
+        mean = Yj.sum(axis=0) / np.maximum(n,1)
+        SSnull[j:j+step] = np.square(np.where(missing, 0., Yj-mean)).sum(axis=0)
+        if intercept:
+            Yj -= W[j:j+step,0]
+            Yj[missing] = 0.
+        SS[j:j+step] = np.square(Yj).sum(axis=0)
+        YZ[j:j+step] = np.dot(Yj.T, Zk)
+        if missing.any():
+            MZ2[j:j+step] = np.dot(missing.T.astype(np.float64), Z2)
+            rows, cols = np.where(missing)
+            pred = (Zk[rows] * Wk[j+cols]).sum(axis=1)
+            PP[j:j+step] = np.bincount(cols, weights=np.square(pred), minlength=Yj.shape[1])
+
+    # Sum of squares of the residuals of each factor, and of all the factors, in each feature
+    Res_k = SS[:,None] - 2.*Wk*YZ + np.square(Wk)*(Z2.sum(axis=0)[None,:] - MZ2)
+    Res = SS - 2.*(Wk*YZ).sum(axis=1) + (np.dot(Wk,ZZ)*Wk).sum(axis=1) - PP
+
+    r2 = { 'r2_total': 1. - Res.sum()/SSnull.sum(), 'r2_per_factor': 1. - Res_k.sum(axis=0)/SSnull.sum() }
+    if per_feature:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r2['r2_total_per_feature'] = 1. - Res/SSnull
+            r2['r2_per_feature'] = 1. - Res_k/SSnull[:,None]
+    return r2
+
+def saveVarianceExplained(model, hdf5, view_names=None, intercept=False, storage=None):
+    """ Method to save the variance explained by the factors in each view (see calculateVarianceExplained),
+    so that it does not have to be recalculated from the full predictions when the model is loaded.
+    For non-gaussian views it is calculated on the pseudodata, as in the R package.
 
-def saveModel(model, outfile, train_opts, model_opts, view_names=None, sample_names=None, feature_names=None):
+    PARAMETERS
+    ----------
+    model: a BayesNet instance
+    hdf5:
+    view_names
+    intercept: boolean
+        was an intercept learnt? (it is excluded from the factors)
+    storage: dic
+        storage options (see saveArray), the variance explained in each feature is saved if storage['r2_per_feature'] is True
+    """
+    if storage is None: storage = {}
+    nodes = model.getNodes()
+    Z = nodes["Z"].getExpectation()
+    W = [ e["E"] for e in nodes["SW"].getExpectations() ]
+    Y = nodes["Y"].getExpectation()
+    views = [ view_names[m] if view_names is not None else str(m) for m in range(len(W)) ]
+
+    grp = hdf5.create_group("variance_explained")
+    r2 = [ calculateVarianceExplained(Z, W[m], Y[m], intercept=intercept, per_feature=storage.get('r2_per_feature', False)) for m in range(len(W)) ]
+    grp.create_dataset("r2_total", data=np.array([ r2[m]['r2_total'] for m in range(len(W)) ]))
+    grp.create_dataset("r2_per_factor", data=np.array([ r2[m]['r2_per_factor'] for m in range(len(W)) ]))
+    grp.attrs['views'] = np.asarray(views).astype('S')
+    grp.attrs['factors'] = np.arange(1 if intercept else 0, Z.shape[1])
+    if storage.get('r2_per_feature', False):
+        total_grp = grp.create_group("r2_total_per_feature")
+        factor_grp = grp.create_group("r2_per_feature")
+        for m in range(len(W)):
+            total_grp.create_dataset(views[m], data=r2[m]['r2_total_per_feature'])
+            saveArray(factor_grp, views[m], r2[m]['r2_per_feature'], storage)
+
+def saveModel(model, outfile, train_opts, model_opts, view_names=None, sample_names=None, feature_names=None, storage=None):
     """ Method to save the model in an hdf5 file
     
     PARAMETERS
     ----------
     TO-FILL....
+    storage: dic
+        storage options (see saveArray and saveTrainingData)
     """
 
     # QC checks
@@ -435,20 +999,20 @@ def saveModel(model, outfile, train_opts, model_opts, view_names=None, sample_na
     assert len(np.unique(sample_names)) == len(sample_names), 'Sample names must be unique'
 
     # Create output directory
-    if not os.path.isdir(os.path.dirname(outfile)):
+    if os.path.dirname(outfile) != "" and not os.path.isdir(os.path.dirname(outfile)):
         print("Output directory does not exist, creating it...")
         os.makedirs(os.path.dirname(outfile))
 
     # For some reason h5py orders the datasets alphabetically, so we have to sort the likelihoods accordingly
     idx = sorted(range(len(view_names)), key=lambda k: view_names[k])
     tmp = [model_opts["likelihood"][idx[m]] for m in range(len(model_opts["likelihood"]))]
-    model_opts["likelihood"] = tmp
+    model_opts = dict(model_opts, likelihood=tmp)
 
     # Open HDF5 handler
     hdf5 = h5py.File(outfile,'w')
 
     # Save expectations
-    saveExpectations(model,hdf5,view_names)
+    saveExpectations(model,hdf5,view_names,storage)
 
     # Save parameters
     # saveParameters(model,hdf5,view_names)
@@ -463,7 +1027,17 @@ def saveModel(model, outfile, train_opts, model_opts, view_names=None, sample_na
     saveModelOpts(model_opts,hdf5)
 
     # Save training data
-    saveTrainingData(model, hdf5, view_names, sample_names, feature_names)
+    saveTrainingData(model, hdf5, view_names, sample_names, feature_names, storage)
+
+    # Save the terms to project new samples
+    saveProjection(model, hdf5, view_names, storage)
+
+    # Save the variance explained
+    saveVarianceExplained(model, hdf5, view_names, intercept=model_opts["learnIntercept"], storage=storage)
+
+    # Save the memory held by the nodes (imported here, as the nodes depend on this module)
+    from .memory import saveMemoryReport
+    saveMemoryReport(model, hdf5)
 
     # Close HDF5 file
     hdf5.close()
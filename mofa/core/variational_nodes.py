@@ -55,9 +55,15 @@ class Unobserved_Variational_Node(Variational_Node):
         Variational_Node.__init__(self, dim)
         self.P = None
         self.Q = None
+
+        # Counter that is increased every time the expectations change, used to invalidate cached products
+        self.version = 0
+
     def updateExpectations(self, dist="Q"):
         # Method to update expectations of the node
-        if dist == "Q": self.Q.updateExpectations()
+        if dist == "Q":
+            self.Q.updateExpectations()
+            self.version += 1
 
     def getExpectation(self, dist="Q"):
         # Method to get the first moment (expectation) of the node
@@ -77,15 +83,30 @@ class Unobserved_Variational_Node(Variational_Node):
         elif dist == "P": params = self.P.getParameters()
         return params
 
+    def getActiveFactors(self):
+        # Method to return a boolean vector indicating which factors are active (see deactivateFactors)
+        if not hasattr(self,"active"):
+            self.active = s.ones(self.dim[self.factors_axis], dtype=bool)
+        return self.active
+
+    def deactivateFactors(self, idx):
+        # Method to switch off factors without removing them from the arrays of the node
+        # Inactive factors are not updated and do not contribute to the lower bound
+        if hasattr(self,"factors_axis"):
+            self.getActiveFactors()[idx] = False
+            self.version += 1
+
     def removeFactors(self, idx, axis=None):
         # Method to remove entire factors from the nodes
 
         if hasattr(self,"factors_axis"): axis = self.factors_axis
-        if hasattr(self,"covariates"): self.covariates = self.covariates[s.arange(len(self.covariates)) != idx]
+        if hasattr(self,"covariates"): self.covariates = s.delete(self.covariates, idx)
+        if hasattr(self,"active"): self.active = s.delete(self.active, idx)
         if axis is not None:
             self.P.removeDimensions(axis=axis, idx=idx)
             self.Q.removeDimensions(axis=axis, idx=idx)
             self.updateDim(axis=axis, new_dim=self.dim[axis]-len(idx))
+            self.version += 1
 
 #######################################################
 ## Specific classes for unobserved variational nodes ##
@@ -63,6 +63,10 @@ learnIntercept=1
 # Random seed 
 seed=0 # if 0, the seed is automatically generated using the current time
 
+# Number of worker processes to split the features over
+# Recommendation: for large data sets use up to the number of cores; to use other hosts start 'mofa-worker' on them and use --workers instead
+nworkers=1
+
 
 ####################
 ## FINISH EDITING ##
@@ -85,6 +89,7 @@ cmd='mofa
 	--freqDrop $freqDrop
 	--dropR2 $dropR2
 	--seed $seed
+	--nworkers $nworkers
 '
 
 if [[ $header_rows -eq 1 ]]; then cmd="$cmd --header_rows"; fi
@@ -3,7 +3,7 @@ from setuptools import find_packages
 
 def setup_package():
   install_requires = ['pandas', 'scipy', 'numpy', 'sklearn', 'argparse', 'h5py']
-  console_scripts = [ 'mofa=mofa.core.init_asd:entry_point'],
+  console_scripts = [ 'mofa=mofa.core.init_asd:entry_point', 'mofa-worker=mofa.core.parallel:worker_entry_point', 'mofa-benchmark=mofa.core.benchmark:entry_point', 'mofa-microbenchmark=mofa.core.microbenchmark:entry_point', 'mofa-simulate=mofa.core.simulate:entry_point', 'mofa-sweep=mofa.core.sweep:entry_point'],
   metadata = dict(
       name = 'MOFA',
       version = '0.1',